@@ -8,11 +8,10 @@
 
 # Aim of the script
 	# Measure TLS area, T- and B-cells area inside, return data as a csv file
-	# Retrieve thresholding data as well for T- and B-cells channels
+	# Retrieve thresholding data as well for the TLS, T- and B-cells channels
 
 # /!\ Getting started /!\
 	# opening the images: "Split channels" must be unchecked
-	# in ImageJ, measurement results must include "Area" (Analyze -> Set Measurement...)
 	# before starting, check the directory for the results file (the script will ask you where you want to save it)
 	# running this script on one image is pretty fast, but it asks for user input for each image
 		# depending on the size of your dataset, this could take some time
@@ -20,128 +19,135 @@
 		# /!\ currently, every time you run this script, it will erase the content of the previous Results_area.csv and create a new one
 		# if you want to save the previous results, change the name of the file before running the script again
 		# or alternatively, don't forget to transfer the data to an Excel file before running the script again
+	# image_tools.py, threshold_tools.py, binary_masks.py and batch_tools.py have to be copied in the Fiji.app/jars/Lib folder (the script imports functions from them)
+	# to save memory on big stacks, open the images as virtual stacks (File -> Import -> TIFF Virtual Stack...), the planes are then read from the disk when needed
+	# to run the script unattended on a whole directory, use a config file with an [area_TLS] section (see batch_tools.py and batch_config_example.ini)
+		# keys: input_dir, output_dir, immune_channel, t_channel, b_channel, tls_threshold_method, cell_threshold_method (and workers to analyze several images at the same time, resume = true to finish a run that stopped, see batch_tools.py)
+		# in batch mode, the TLS ROIs are not checked by hand: every region found by the thresholding is kept
+	# to see how much Area CD3 and Area B220 depend on the threshold, set threshold_sweep to "true" (Initializing part, or key threshold_sweep in the config file)
+		# the areas inside the TLS for every threshold are written in Results_area_threshold_curves.csv (one histogram per channel, the analysis is not run again)
 
 # Have fun!
 
 ### Imports
 
 from ij import IJ, WindowManager, Prefs
-from ij.measure import ResultsTable
 from ij.plugin.frame import RoiManager
-from ij.plugin import ChannelSplitter, ZProjector
 from ij.process import AutoThresholder
 from ij.gui import WaitForUserDialog
 import csv
+from image_tools import project_channel
+from binary_masks import analyze_particles, Mask
+from threshold_tools import set_auto_threshold, threshold_text, threshold_curve, forget
+from batch_tools import load_config, setting, get_number, output_dir, images, show_image, manual_check, roi_manager, gather, Journal
 import os
 
 ###Initializing
 
-rm = RoiManager.getRoiManager()
+CONFIG = load_config("area_TLS", "area_TLS.js.py") # None unless a config file is given (batch mode)
+
+rm = roi_manager(CONFIG)
 DATA = []
-field_names = ['Name', 'Area TLS', 'Area CD3', 'Threshold CD3', 'Area B220', 'Threshold B220']
+field_names = ['Name', 'Area TLS', 'Threshold TLS', 'Area CD3', 'Threshold CD3', 'Area B220', 'Threshold B220']
+CURVES = [] # threshold sweep, one row per image, channel and threshold
+curve_names = ['Name', 'Channel', 'Threshold', 'Area']
+
+count = int(get_number(CONFIG, "count", "How many images to analyze ?", 1))
+
+immune_channel_number = int(setting(CONFIG, "immune_channel", 2))
+t_channel_number = int(setting(CONFIG, "t_channel", 3))
+b_channel_number = int(setting(CONFIG, "b_channel", 0))
+tls_threshold_method = setting(CONFIG, "tls_threshold_method", "Otsu")
+cell_threshold_method = setting(CONFIG, "cell_threshold_method", "Shanbhag")
+threshold_sweep = setting(CONFIG, "threshold_sweep", "false").lower() == "true" # change to "true" to get the CD3 and B220 areas for every threshold
 
-count = int(IJ.getNumber("How many images to analyze ?", 1))
+os.chdir(output_dir(CONFIG, "my_directory"))
 
-os.chdir("my_directory")
+# The results of each image are saved as soon as it is done (area_TLS_progress.pkl, see Journal in batch_tools)
+journal = Journal(CONFIG, "area_TLS", DATA = DATA, CURVES = CURVES)
 
 ### Analysis
 
-for _ in xrange(count):
+for whole in images(CONFIG, count, journal):
 	# Initializaing for the current image
 	
 	new_dict = {}
 	
-	whole = IJ.getImage()
 	title = whole.getTitle()
 	
-	channels = ChannelSplitter.split(whole)
-	
-	Immune_channel = channels[2]
-	T_channel = channels[3]
-	B_channel = channels[0]
+	# The channels are projected straight from the image, plane by plane, without splitting them (see project_channel in image_tools)
 	
 	# Borders of the TLS
 	
-	immune = ZProjector.run(Immune_channel,"sum")
-	immune.show()
-	IJ.setAutoThreshold(immune, "Otsu dark")
+	immune = project_channel(whole, immune_channel_number, "sum")
+	show_image(CONFIG, immune)
+	threshold_TLS = set_auto_threshold(immune, tls_threshold_method)
 	Prefs.blackBackground = True
 	IJ.run(immune, "Convert to Mask", "")
-	IJ.run(immune, "Analyze Particles...", "size=800.00-Infinity circularity=0.00-0.50 show=Overlay clear add")
+	# Particles of at least 800 (calibrated units) with a circularity up to 0.50, same ROIs as "Analyze Particles..." (see binary_masks)
+	analyze_particles(immune, rm, 800, max_circularity = 0.5, show = True)
 	ra = rm.getRoisAsArray()
+	# Showing the immune channel of the image itself for the check
+	whole.setC(immune_channel_number+1)
 	for ROI in ra:
-		Immune_channel.setRoi(ROI)
-	Immune_channel.show()
-	check = WaitForUserDialog("Time for a manual check", "The ROIs in the ROI Manager are going to be fused together to create the TLS ROI. \nIf some of those ROIs are inapropriate, delete them. \nIf a part of the TLS was not detected, please draw the corresponding ROI manually (and sorry for that). \nClick Ok when finished.")
-	check.show()
-	Immune_channel.close()
-	ra = rm.getRoisAsArray()
-	if len(ra) >1:
-		indexes = range(len(ra))
-		rm.setSelectedIndexes(indexes)
-		rm.runCommand(immune,"OR")
-		roi = immune.getRoi()
-		rm.addRoi(roi)
-		rm.setSelectedIndexes(range(len(ra)))
-		rm.runCommand(immune,"Delete")
+		whole.setRoi(ROI)
+	manual_check(CONFIG, "Time for a manual check", "The ROIs in the ROI Manager are going to be fused together to create the TLS ROI. \nIf some of those ROIs are inapropriate, delete them. \nIf a part of the TLS was not detected, please draw the corresponding ROI manually (and sorry for that). \nClick Ok when finished.")
+	whole.deleteRoi()
+	# The TLS is made of all the ROIs left in the Roi Manager (their "OR"), kept as a mask (see Mask in binary_masks)
+	tls = Mask.from_rois(rm.getRoisAsArray(), immune.getWidth(), immune.getHeight())
+	tls_roi = tls.roi() if threshold_sweep else None # a ROI is only needed for the threshold sweep
 		
 	# Measurement for T-cells
 	
-	t_cells = ZProjector.run(T_channel,"max")
-	IJ.setAutoThreshold(t_cells, "Shanbhag dark")
-	ImProc = t_cells.getProcessor()
-	lower_T = ImProc.getMinThreshold()
-	upper_T = ImProc.getMaxThreshold()
+	t_cells = project_channel(whole, t_channel_number, "max")
+	threshold_T = set_auto_threshold(t_cells, cell_threshold_method)
+	if tls_roi is not None:
+		# Area of CD3 inside the TLS for every threshold, before the mask replaces the pixels
+		for lower, area in threshold_curve(t_cells, tls_roi):
+			CURVES.append({'Name' : title[37:], 'Channel' : 'CD3', 'Threshold' : lower, 'Area' : area})
 	IJ.run(t_cells, "Convert to Mask", "")
-	IJ.run(t_cells, "Create Selection", "")
-	roi = t_cells.getRoi()
-	rm.addRoi(roi)
-	
-	rm.setSelectedIndexes([0,1])
-	rm.runCommand(t_cells,"AND")
-	roi = t_cells.getRoi()
-	rm.addRoi(roi)
-	rm.setSelectedIndexes([1])
-	rm.runCommand(t_cells,"Delete")
+	cd3 = Mask.from_image(t_cells) & tls # CD3 inside the TLS
 	
 	# Measurement for B-cells
 	
-	b_cells = ZProjector.run(B_channel,"max")
-	IJ.setAutoThreshold(b_cells, "Shanbhag dark")
-	ImProc = b_cells.getProcessor()
-	lower_B = ImProc.getMinThreshold()
-	upper_B = ImProc.getMaxThreshold()
+	b_cells = project_channel(whole, b_channel_number, "max")
+	threshold_B = set_auto_threshold(b_cells, cell_threshold_method)
+	if tls_roi is not None:
+		for lower, area in threshold_curve(b_cells, tls_roi):
+			CURVES.append({'Name' : title[37:], 'Channel' : 'B220', 'Threshold' : lower, 'Area' : area})
 	IJ.run(b_cells, "Convert to Mask", "")
-	IJ.run(b_cells, "Create Selection", "")
-	roi = b_cells.getRoi()
-	rm.addRoi(roi)
-	
-	rm.setSelectedIndexes([0,2])
-	rm.runCommand(b_cells,"AND")
-	roi = b_cells.getRoi()
-	rm.addRoi(roi)
-	rm.setSelectedIndexes([2])
-	rm.runCommand(b_cells,"Delete")
+	b220 = Mask.from_image(b_cells) & tls # B220 inside the TLS
 	
-	rm.setSelectedIndexes([0,1,2])
-	rm.runCommand(immune,"Measure")
+	if CONFIG is None:
+		# The TLS, CD3 and B220 selections are left in the Roi Manager to have a look at them
+		rm.reset()
+		for mask in (tls, cd3, b220):
+			roi = mask.roi()
+			if roi is not None:
+				rm.addRoi(roi)
 	
-	immune.close()
-	whole.close()
+	for image in (immune, t_cells, b_cells):
+		forget(image)
 	
 	# Save results
 	
-	table = ResultsTable.getResultsTable()
-	areas = [area for area in table.getColumn(0)]
-	
 	new_dict['Name'] = title[37:]
-	new_dict['Area TLS'] = areas[0]
-	new_dict['Area CD3'] = areas[1]
-	new_dict['Area B220'] = areas[2]
-	new_dict['Threshold CD3'] = str(lower_T)+'/'+str(upper_T)
-	new_dict['Threshold B220'] = str(lower_B)+'/'+str(upper_B)
+	new_dict['Area TLS'] = tls.area(immune)
+	new_dict['Area CD3'] = cd3.area(immune)
+	new_dict['Area B220'] = b220.area(immune)
+	new_dict['Threshold TLS'] = threshold_text(threshold_TLS)
+	new_dict['Threshold CD3'] = threshold_text(threshold_T)
+	new_dict['Threshold B220'] = threshold_text(threshold_B)
 	
 	DATA.append(new_dict)
+	
+	immune.close()
+	whole.close()
+
+# Results of the other worker processes (batch mode with workers only)
+
+DATA = gather(CONFIG, "DATA", DATA)
+CURVES = gather(CONFIG, "CURVES", CURVES)
 
 ### Saving whole results in csv file
 
@@ -150,4 +156,12 @@ writer = csv.DictWriter(csvfile, fieldnames = field_names)
 writer.writeheader()
 writer.writerows(DATA)
 csvfile.close()
-	
\ No newline at end of file
+
+### Saving the threshold sweep next to it
+
+if threshold_sweep:
+	csvfile = open('Results_area_threshold_curves.csv', 'w')
+	writer = csv.DictWriter(csvfile, fieldnames = curve_names)
+	writer.writeheader()
+	writer.writerows(CURVES)
+	csvfile.close()
@@ -11,89 +11,115 @@
 
 # /!\ Getting started /!\
 	# opening the images: "Split channels" must be unchecked
-	# in ImageJ, measurement results must include "Area" (Analyze -> Set Measurement...)
 	# before starting, check the directory for the results file
 	# results are saved in a text file called results_area_tumor.txt (can be modified)
 		# /!\ currently, every time you run this script, it will erase the content of the previous results file and create a new one
 		# if you want to save the previous results, change the name of the file before running the script again
-	# check which channel you want to use (start counting from 0 instead of 1) and change that in the initializing for the current image part
+	# the threshold used for each image is saved next to it, in Thresholds_area_tumor.txt
+	# the area of each part of the tumor (particle) is saved in Components_area_tumor.txt, the tumor area is their sum
+	# check which channel you want to use (start counting from 0 instead of 1) and change that in the initializing part
+	# image_tools.py, threshold_tools.py, binary_masks.py and batch_tools.py have to be copied in the Fiji.app/jars/Lib folder (the script imports functions from them)
+	# to run the script unattended on a whole directory, use a config file with an [area_tumor] section (see batch_tools.py and batch_config_example.ini)
+		# keys: input_dir, output_dir, tumor_channel, threshold_method (and workers to analyze several images at the same time, resume = true to finish a run that stopped, see batch_tools.py)
+	# for very big sections (whole slides) that fill Fiji's memory or take minutes, set tile_size (e.g. 1024) in the config file or in the initializing part:
+		# the tumor channel is then thresholded and analyzed by tiles of tile_size rows, several at the same time, without copying it (see tiled_particles in binary_masks)
+		# the threshold comes from the histogram of the whole image, and the parts of the tumor cut by a tile border are put back together: the area is the same as without tiles
+		# no mask is made, so there is no manual check in this mode
 
 # Have fun!
 
 ### Imports
 
 from ij import IJ, WindowManager, Prefs
-from ij.measure import ResultsTable
-from ij.plugin.frame import RoiManager
-from ij.plugin import ChannelSplitter
 from ij.process import AutoThresholder
 from ij.gui import WaitForUserDialog
+from image_tools import Channels
+from binary_masks import analyze_particles, label_areas, tiled_particles
+from threshold_tools import set_auto_threshold, auto_threshold, streamed_histogram, threshold_text, forget
+from batch_tools import load_config, setting, get_number, output_dir, images, show_image, manual_check, gather, Journal
 import os
 
 ###Initializing
 
-rm = RoiManager.getRoiManager()
+CONFIG = load_config("area_tumor") # None unless a config file is given (batch mode)
 
 DATA = {}
+COMPONENTS = {} # image title -> area of each particle of the tumor
+THRESHOLDS = {} # image title -> threshold used for the tumor ("lower/upper")
 
-count = int(IJ.getNumber("How many images to analyze ?", 1))
+count = int(get_number(CONFIG, "count", "How many images to analyze ?", 1))
 
-os.chdir("my_directory")
+tumor_channel_number = int(setting(CONFIG, "tumor_channel", 0))
+threshold_method = setting(CONFIG, "threshold_method", "Otsu")
+tile_size = int(setting(CONFIG, "tile_size", 0)) # 0: the whole image at once
+
+os.chdir(output_dir(CONFIG, "my_directory"))
+
+# The results of each image are saved as soon as it is done (area_tumor_progress.pkl, see Journal in batch_tools)
+journal = Journal(CONFIG, "area_tumor", DATA = DATA, THRESHOLDS = THRESHOLDS, COMPONENTS = COMPONENTS)
 
 ### Analysis
 
-for _ in xrange(count):
+for whole in images(CONFIG, count, journal):
 	# Initializing for the current image
 
-	whole = IJ.getImage()
 	title = whole.getTitle()
 
-	channels = ChannelSplitter.split(whole)
+	channels = Channels(whole) # each channel is only made when it is used, the pixels are shared with whole when it is in memory (see Channels)
 
-	tumor_channel = channels[0]
+	tumor_channel = channels[tumor_channel_number]
 
 	# Borders of the tumor
 
-	tumor = tumor_channel.duplicate()
-	tumor.show()
-	IJ.setAutoThreshold(tumor, "Otsu dark")
-	Prefs.blackBackground = True
-	IJ.run(immune, "Convert to Mask", "")
-	check = WaitForUserDialog("Time for a manual check", "This is for you to check the threshold, you can delete that part once you're confident in the thresholding method.")
-	check.show()
-	IJ.run(immune, "Analyze Particles...", "size=300-Infinity circularity=0.00-1.00 show=Overlay clear add")
-	check = WaitForUserDialog("Time for a manual check", "Check the areas that the script detected (useful for debugging).")
-	check.show()
-	#Calculating area
-	ra = rm.getRoisAsArray()
-	if len(ra) >1:
-		#Combining teh ROIs if several have been detected
-		indexes = range(len(ra))
-		rm.setSelectedIndexes(indexes)
-		rm.runCommand(tumor,"OR")
-		roi = immune.getRoi()
-		rm.addRoi(roi)
-		rm.setSelectedIndexes(range(len(ra)))
-		rm.runCommand(tumor,"Delete")
-		rm.setSelectedIndexes([0])
-		rm.runCommand(tumor,"Measure")
-		table = ResultsTable.getResultsTable()
-		area = table.getColumn(0)[0]
-		DATA[title] = area
-	elif len(ra) == 1:
-		rm.setSelectedIndexes([0])
-		rm.runCommand(tumor,"Measure")
-		table = ResultsTable.getResultsTable()
-		area = table.getColumn(0)[0]
-		DATA[title] = area
+	if tile_size > 0:
+		# Tiles of tile_size rows, the threshold is computed on the whole image (see streamed_histogram in threshold_tools)
+		streamed_histogram(tumor_channel, tile_size)
+		thresholds = auto_threshold(tumor_channel, threshold_method)
+		THRESHOLDS[title] = threshold_text(thresholds)
+		particles = tiled_particles(tumor_channel, thresholds[0], thresholds[1], 300, size = tile_size)
+		COMPONENTS[title] = [particle['area'] for particle in particles]
+		DATA[title] = sum(COMPONENTS[title])
+		forget(tumor_channel)
 	else:
-		DATA[title] = 0
-
-	tumor.close()
+		tumor = tumor_channel.duplicate()
+		show_image(CONFIG, tumor)
+		THRESHOLDS[title] = threshold_text(set_auto_threshold(tumor, threshold_method))
+		Prefs.blackBackground = True
+		IJ.run(tumor, "Convert to Mask", "")
+		manual_check(CONFIG, "Time for a manual check", "This is for you to check the threshold, you can delete that part once you're confident in the thresholding method.")
+		# Particles of at least 300 (calibrated units), shown on the image for the check (see analyze_particles in binary_masks)
+		labels, particles = analyze_particles(tumor, None, 300, show = CONFIG is None)
+		manual_check(CONFIG, "Time for a manual check", "Check the areas that the script detected (useful for debugging).")
+		#Calculating area: pixels of the particles kept (holes included, like their ROIs) times the area of a pixel
+		calibration = tumor.getCalibration()
+		COMPONENTS[title] = label_areas(labels, len(particles), calibration.pixelWidth*calibration.pixelHeight)
+		DATA[title] = sum(COMPONENTS[title])
+		forget(tumor)
+		tumor.close()
+
+	channels.close()
 	whole.close()
 
+# Results of the other worker processes (batch mode with workers only)
+
+DATA = gather(CONFIG, "DATA", DATA)
+THRESHOLDS = gather(CONFIG, "THRESHOLDS", THRESHOLDS)
+COMPONENTS = gather(CONFIG, "COMPONENTS", COMPONENTS)
+
 ### Saving whole results in csv file
 
 results = open('Results_area_tumor.txt', 'w')
 results.write(str(DATA))
-results.close()
\ No newline at end of file
+results.close()
+
+# Thresholds used for each image
+
+results = open('Thresholds_area_tumor.txt', 'w')
+results.write(str(THRESHOLDS))
+results.close()
+
+# Area of each particle of the tumor
+
+results = open('Components_area_tumor.txt', 'w')
+results.write(str(COMPONENTS))
+results.close()
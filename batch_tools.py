@@ -0,0 +1,405 @@
+###Introduction
+
+# Hi!
+
+# Characteristics
+	# written for Jython (Python 2.7 in ImageJ 2.9.0)
+	# contact for help: solenedeutsch@gmail.com
+
+# Aim of the script
+	# Gathers what the Fiji scripts need to run either as usual (dialogs, active image) or unattended (batch mode, driven by a config file)
+	# This file is not meant to be run on its own: the other scripts import it.
+
+# Getting started
+	# copy this file into the Fiji.app/jars/Lib folder so that Fiji can find it, then restart Fiji
+	# the scripts run as usual when no config file is given
+	# to run a script in batch mode, give the path of a config file in the IMAGE_ANALYSIS_CONFIG environment variable, for example:
+		# IMAGE_ANALYSIS_CONFIG=/data/batch_config.ini ./ImageJ-linux64 --headless --console --run area_tumor.py
+	# the config file is an ini file with one section per script (see batch_config_example.ini), every section needs:
+		# input_dir : directory containing the images to analyze (every file with one of the extensions, in alphabetical order)
+		# extensions : file extensions to analyze, separated by commas (default .tif,.tiff,.lif,.czi,.nd2)
+		# output_dir : directory where the result files are written
+	# the other keys of a section replace the dialogs of the script (the name of the key is given next to each dialog in the scripts)
+	# in batch mode, no window is opened and the manual checks (WaitForUserDialog) are skipped
+	# with workers = n in the config file, the images are shared between n Fiji processes running at the same time (one per core is a good start)
+		# each process has its own Roi Manager and writes its own results in output_dir/worker_0, output_dir/worker_1...
+		# the main process waits for the others, gathers their results and writes the usual result files in output_dir
+		# (the results shared by the workers of a previous run are removed first, and two workers giving the same key stop the script)
+		# fiji : path of the Fiji executable (default: the one running the script), script_dir : folder containing the script
+		# (default: the folder Fiji was started from, the script is looked for when the config is read, before the scripts change folder)
+		# worker_memory : memory given to each process (e.g. 4g, default: Fiji's setting)
+	# the images are opened as virtual stacks (planes read from the disk when needed), add virtual = false to the section to load them completely
+	# the results of each image are saved as soon as the image is done, in a progress file next to the result files (e.g. area_tumor_progress.pkl)
+		# if a run stops before the end, run it again with resume = true in the section: the images already done are skipped,
+		# their results are taken from the progress file and the result files are written with all the images
+		# without resume = true, the progress file of the previous run is erased at the start
+
+# Have fun!
+
+###Imports
+
+from ij import IJ, WindowManager
+from ij.macro import Interpreter
+from ij.plugin.frame import RoiManager
+from ij.gui import WaitForUserDialog
+from java.lang import System
+import ConfigParser
+import subprocess
+import pickle
+import os
+
+###Config
+
+CONFIG_VARIABLE = "IMAGE_ANALYSIS_CONFIG"
+WORKER_VARIABLE = "IMAGE_ANALYSIS_WORKER"
+EXTENSIONS = ".tif,.tiff,.lif,.czi,.nd2"
+
+def variable(name):
+	'''
+	Value of an environment variable or Java property, None if it is not set.
+	'''
+	value = System.getProperty(name)
+	if value is None:
+		value = System.getenv(name)
+	if value is None or value == "":
+		return None
+	return value
+
+def config_path():
+	'''
+	Path of the config file (IMAGE_ANALYSIS_CONFIG environment variable or Java property), None if there is none.
+	'''
+	return variable(CONFIG_VARIABLE)
+
+def worker_index():
+	'''
+	Number of the current worker process (IMAGE_ANALYSIS_WORKER, set by run_workers), None for the main process.
+	'''
+	index = variable(WORKER_VARIABLE)
+	if index is None:
+		return None
+	return int(index)
+
+def load_config(section, script = None):
+	'''
+	Reads the section of the config file corresponding to the script (e.g. "area_tumor").
+	script : file name of the script, needed to start worker processes (default: section+".py")
+	Returns a dictionary {key : value as a string}, or None when no config file is given (the script then runs as usual, with dialogs).
+	The batch mode of ImageJ is turned on as soon as a config file is found (no window is displayed).
+	'''
+	path = config_path()
+	if path is None:
+		return None
+	parser = ConfigParser.SafeConfigParser()
+	if not parser.read(path):
+		raise IOError("Config file not found: "+path)
+	if not parser.has_section(section):
+		raise ValueError("No ["+section+"] section in "+path)
+	config = dict(parser.items(section))
+	config.setdefault("extensions", EXTENSIONS)
+	config.setdefault("output_dir", os.getcwd())
+	config.setdefault("workers", "1")
+	config.setdefault("script", script if script is not None else section+".py")
+	# The path of the script is found now: the scripts change the current folder (os.chdir) before the workers are started
+	config["script_path"] = os.path.abspath(os.path.join(config.get("script_dir", os.getcwd()), config["script"]))
+	if int(config["workers"]) > 1 and not os.path.isfile(config["script_path"]):
+		raise IOError("Script not found for the workers: "+config["script_path"]+" (add script_dir = folder of the script to the ["+section+"] section)")
+	index = worker_index()
+	if index is not None:
+		# Each worker writes in its own folder
+		config["output_dir"] = os.path.join(config["output_dir"], "worker_"+str(index))
+		if not os.path.isdir(config["output_dir"]):
+			os.makedirs(config["output_dir"])
+	Interpreter.setBatchMode(True)
+	return config
+
+def get_number(config, key, prompt, default):
+	'''
+	Same as IJ.getNumber(prompt, default), but takes the value of key in the config file in batch mode.
+	'''
+	if config is None:
+		return IJ.getNumber(prompt, default)
+	return float(config.get(key, default))
+
+def get_string(config, key, prompt, default):
+	'''
+	Same as IJ.getString(prompt, default), but takes the value of key in the config file in batch mode.
+	'''
+	if config is None:
+		return IJ.getString(prompt, default)
+	return config.get(key, default)
+
+def setting(config, key, default):
+	'''
+	Value of key in the config file in batch mode, default otherwise (for the values written in the scripts instead of asked in a dialog).
+	The value is given as a string in batch mode, convert it if needed.
+	'''
+	if config is None:
+		return default
+	return config.get(key, default)
+
+def output_dir(config, default):
+	'''
+	Directory for the result files: output_dir of the config file in batch mode, default otherwise.
+	'''
+	if config is None:
+		return default
+	return config["output_dir"]
+
+###Images
+
+def input_files(config):
+	'''
+	List of the files to analyze in batch mode (files of input_dir with one of the extensions, in alphabetical order).
+	A worker process only gets its share of the files (one file out of workers, starting at its number).
+	'''
+	extensions = tuple([extension.strip().lower() for extension in config["extensions"].split(",")])
+	directory = config["input_dir"]
+	files = [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.lower().endswith(extensions)]
+	index = worker_index()
+	if index is not None:
+		files = files[index::int(config["workers"])]
+	return files
+
+def open_file(path, virtual = True):
+	'''
+	Opens every image (series) of a file without displaying it. Returns a list of images.
+	virtual : the planes are only read from the disk when they are needed (virtual stack), so a z-projection
+		(see project_channel in image_tools) never holds the whole stack in memory
+	'''
+	if path.lower().endswith((".tif", ".tiff")):
+		if virtual:
+			return [IJ.openVirtual(path)]
+		return [IJ.openImage(path)]
+	# Bio-Formats for the microscope formats (.lif, .czi...), all the series of the file are opened
+	from loci.plugins import BF
+	ImporterOptions = __import__("loci.plugins.in", globals(), locals(), ["ImporterOptions"]).ImporterOptions # "in" can't be written in an import line
+	options = ImporterOptions()
+	options.setId(path)
+	options.setOpenAllSeries(True)
+	options.setVirtual(virtual)
+	return list(BF.openImagePlus(options))
+
+def images(config, count, journal = None):
+	'''
+	Gives the images to analyze one at a time.
+	Batch mode: every image of every file of input_dir (count is not used), each image is closed once the loop moves on.
+		With several workers, the main process gives no image: it runs the workers and waits for them (see run_workers and gather).
+	Otherwise: the active image, count times (the script closes it after the analysis, so the next one comes in front).
+	journal : progress file of the script (see Journal), the results of each image are saved in it as soon as the loop moves on,
+		and the images it already contains are skipped when resuming
+	'''
+	if config is None:
+		for _ in xrange(count):
+			imp = IJ.getImage()
+			title = imp.getTitle()
+			yield imp
+			if journal is not None:
+				journal.save(title)
+		return
+	if int(config["workers"]) > 1 and worker_index() is None:
+		run_workers(config)
+		return
+	for path in input_files(config):
+		number = 0
+		for imp in open_file(path, config.get("virtual", "true").lower() == "true"):
+			name = os.path.basename(path)+" #"+str(number) # the same image in every run (file and series number)
+			number += 1
+			if journal is not None and name in journal.done:
+				imp.close()
+				continue
+			WindowManager.setTempCurrentImage(imp)
+			yield imp
+			if journal is not None:
+				journal.save(name)
+			imp.changes = False
+			imp.close()
+			imp.flush()
+
+def show_image(config, imp):
+	'''
+	Displays imp, or in batch mode only makes it the current image (for the commands working on the active image).
+	'''
+	if config is None:
+		imp.show()
+	else:
+		WindowManager.setTempCurrentImage(imp)
+
+def manual_check(config, title, message):
+	'''
+	Waits for the user to check something (WaitForUserDialog). Skipped in batch mode.
+	'''
+	if config is None:
+		check = WaitForUserDialog(title, message)
+		check.show()
+
+def roi_manager(config):
+	'''
+	The Roi Manager: the usual window, or in batch mode the hidden one that ImageJ uses for "Analyze Particles..." (add).
+	'''
+	if config is None:
+		return RoiManager.getRoiManager()
+	return Interpreter.getBatchModeRoiManager()
+
+###Progress
+
+class Journal(object):
+	'''
+	Progress file of a script: the results added by each image (new keys of the DATA dictionaries, new items of the lists) are appended to it
+	as soon as the image is done, so a run that stops keeps everything done so far and can be resumed (see images).
+	'''
+	def __init__(self, config, name, directory = None, **data):
+		'''
+		name : name of the script (the file is name+"_progress.pkl")
+		directory : folder of the progress file (default: output_dir in batch mode, current folder otherwise)
+		data : the result containers of the script, e.g. DATA = DATA, THRESHOLDS = THRESHOLDS (dictionaries or lists, filled in place)
+		With resume = true in the config file, the containers get the results of the images already done, which are not analyzed again.
+		'''
+		if directory is None:
+			directory = output_dir(config, os.getcwd())
+		self.path = os.path.join(directory, name+"_progress.pkl")
+		self.data = data
+		self.done = set()
+		if config is not None and config.get("resume", "false").lower() == "true":
+			self.load()
+		elif os.path.isfile(self.path):
+			os.remove(self.path)
+		self.seen = {}
+		for key in self.data.keys():
+			self.seen[key] = self.snapshot(self.data[key])
+
+	def snapshot(self, container):
+		'''
+		What container holds now: its length for a list, a copy of its (key, value) pairs for a dictionary.
+		'''
+		if isinstance(container, list):
+			return len(container)
+		return dict(container)
+
+	def added(self, key):
+		'''
+		Results added to the container key since the last snapshot: new items of a list, new or replaced keys of a dictionary.
+		'''
+		container, seen = self.data[key], self.seen[key]
+		if isinstance(container, list):
+			return container[seen:]
+		return dict([(name, value) for name, value in container.items() if name not in seen or seen[name] is not value])
+
+	def save(self, image):
+		'''
+		Appends the results of image (name of the image, see images) to the progress file, written to the disk right away.
+		'''
+		record = (image, dict([(key, self.added(key)) for key in self.data.keys()]))
+		saved = open(self.path, "ab")
+		pickle.dump(record, saved)
+		saved.flush()
+		os.fsync(saved.fileno())
+		saved.close()
+		for key in self.data.keys():
+			self.seen[key] = self.snapshot(self.data[key])
+		self.done.add(image)
+
+	def load(self):
+		'''
+		Puts the results of the progress file back in the containers and lists the images already done.
+		A record cut by a crash (end of the file) is ignored: its image is analyzed again.
+		'''
+		if not os.path.isfile(self.path):
+			return
+		saved = open(self.path, "r+b")
+		try:
+			while True:
+				end = saved.tell()
+				try:
+					image, parts = pickle.load(saved)
+				except Exception: # end of the file, or a record cut by a crash (pickle raises various errors then)
+					# A cut record is removed, so that the next records can be read
+					saved.seek(end)
+					saved.truncate()
+					break
+				for key in parts.keys():
+					if key not in self.data:
+						continue
+					if isinstance(self.data[key], list):
+						self.data[key].extend(parts[key])
+					else:
+						self.data[key].update(parts[key])
+				self.done.add(image)
+		finally:
+			saved.close()
+
+###Worker processes
+
+def run_workers(config):
+	'''
+	Starts one Fiji process per worker on the same script and config file, and waits until they are all finished.
+	The results shared by the workers of a previous run (see gather) are removed first, so that they are never taken for new ones.
+	'''
+	fiji = config.get("fiji", System.getProperty("ij.executable"))
+	script = config["script_path"]
+	for index in xrange(int(config["workers"])):
+		folder = shared_dir(config, index)
+		if os.path.isdir(folder):
+			for name in os.listdir(folder):
+				if name.endswith(".pkl"):
+					os.remove(os.path.join(folder, name))
+	command = [fiji, "--headless", "--console"]
+	if "worker_memory" in config:
+		command.append("--mem="+config["worker_memory"])
+	command += ["--run", script]
+	processes = []
+	for index in xrange(int(config["workers"])):
+		environment = dict(os.environ)
+		environment[CONFIG_VARIABLE] = config_path()
+		environment[WORKER_VARIABLE] = str(index)
+		processes.append(subprocess.Popen(command, env = environment))
+	for index in xrange(len(processes)):
+		if processes[index].wait() != 0:
+			print("worker "+str(index)+" failed, its images are missing from the results (see "+config["output_dir"]+"/worker_"+str(index)+")")
+
+def shared_dir(config, index):
+	'''
+	Folder where worker index leaves its results for the main process (see gather).
+	'''
+	if worker_index() is not None:
+		return os.path.join(config["output_dir"], "shared") # output_dir is already the folder of the worker
+	return os.path.join(config["output_dir"], "worker_"+str(index), "shared")
+
+def gather(config, name, data):
+	'''
+	Shares the results of the worker processes (data = DATA dictionary or list of the script, name = file name for it).
+	In a worker: saves data for the main process. In the main process: adds the data of every worker to data.
+	Two workers giving the same key (or a worker giving a key of data) stop the script with an error instead of one result replacing the other,
+	the results of the workers stay in their folders.
+	Does nothing when the script does not run with several workers. Returns data.
+	'''
+	if config is None or int(config["workers"]) < 2:
+		return data
+	index = worker_index()
+	if index is not None:
+		folder = shared_dir(config, index)
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+		saved = open(os.path.join(folder, name+".pkl"), "wb")
+		pickle.dump(data, saved)
+		saved.close()
+		return data
+	origin = dict([(key, "main process") for key in data]) if isinstance(data, dict) else {}
+	for index in xrange(int(config["workers"])):
+		path = os.path.join(shared_dir(config, index), name+".pkl")
+		if not os.path.isfile(path):
+			print("worker "+str(index)+" gave no "+name+", its images are missing from the results")
+			continue
+		saved = open(path, "rb")
+		part = pickle.load(saved)
+		saved.close()
+		if isinstance(data, dict):
+			twice = [key for key in part if key in origin]
+			if twice:
+				raise ValueError(name+": worker "+str(index)+" gives keys already given by "+origin[twice[0]]+" ("+", ".join([str(key) for key in twice[:5]])+(", ..." if len(twice) > 5 else "")+")")
+			for key in part:
+				origin[key] = "worker "+str(index)
+			data.update(part)
+		else:
+			data.extend(part)
+	return data
@@ -0,0 +1,920 @@
+###Introduction
+
+# Hi!
+
+# Characteristics
+	# written for Jython (Python 2.7 in ImageJ 2.9.0)
+	# contact for help: solenedeutsch@gmail.com
+
+# Aim of the script
+	# Fast work on binary masks (0 and 255) for the Fiji scripts: the clean-up chains (Despeckle, Dilate, Close...) run in one go on each slice, and the particles are found without "Analyze Particles..."
+	# The masks are exactly the ones given by the ImageJ commands, only faster.
+	# This file is not meant to be run on its own: the other scripts import it.
+
+# Getting started
+	# copy this file into the Fiji.app/jars/Lib folder so that Fiji can find it, then restart Fiji
+
+# Code details for curious people
+	# each row of a slice is packed into one Python number, one bit per pixel (1 = foreground)
+	# a filter then works on whole rows at once: shifting a row by one bit gives the left or right neighbours of all its pixels,
+	# and AND / OR between rows replace the comparisons of the pixels (dilate = OR of the neighbours, erode = AND, median = majority vote)
+	# a chain of operations is done on the packed rows, the slice is only read and written once
+	# the median counts the foreground pixels of the kernel for all the pixels of a row at once: the count is kept in a few rows of bits
+	# (bit k of the count of each pixel in row number k), added like numbers written in binary
+	# the slices of a stack are processed at the same time (see process_slices in image_tools)
+	# the image borders are handled like ImageJ: Despeckle repeats the edge pixels, Dilate and Erode see background outside the image
+	# the connected components (particles) are found on runs of foreground pixels (one run = pixels next to each other in a row) instead of pixels:
+	# the runs of two rows that touch are joined with a union-find, so a particle costs as many steps as it has runs, not pixels
+	# a very big plane can be thresholded and its particles found tile by tile (tiled_particles): the rows are joined from top to bottom across the tiles,
+	# so the particles cut by a tile border are put back together before the size filter, and a particle is finished (size filter, area) as soon as
+	# the row below it is reached: only the particles crossing the current row are kept in memory, not the runs of the whole plane
+	# a Mask keeps a binary plane as packed rows: AND / OR / XOR of two masks is one operation per row, and the area is the number of bits set,
+	# which replaces the AND / OR / XOR of the Roi Manager (ROIs are only made from a mask when they have to be shown)
+
+# Have fun!
+
+###Imports
+
+from ij import Prefs
+from ij.gui import PolygonRoi, Roi, Overlay
+from ij.process import ImageProcessor, ByteProcessor, ShortProcessor, FloatProcessor, ImageStatistics
+from ij.plugin.filter import ThresholdToSelection
+from ij.measure import Measurements
+from java.lang import System
+from java.util import Arrays
+from image_tools import process_slices, bands, band_processor
+import array
+import bisect
+import math
+import re
+import string
+
+###Packing
+
+def foreground_value(ip, black = None):
+	'''
+	Pixel value of the objects of a binary image, following the ImageJ binary commands.
+	black : "Black background" of Process -> Binary -> Options (default: the current setting)
+	'''
+	if black is None:
+		black = Prefs.blackBackground
+	foreground = 255 if black else 0
+	if ip.isInvertedLut():
+		foreground = 255-foreground
+	return foreground
+
+def bit_text(pixels, foreground = 255):
+	'''
+	The pixels of a binary slice (byte array) as a string of '1' (foreground) and '0', row after row.
+	'''
+	table = ''.join(['1' if value == foreground else '0' for value in xrange(256)])
+	return pixels.tostring().translate(table)
+
+def pack(pixels, width, height, foreground = 255):
+	'''
+	Packs the pixels of a binary slice (byte array) into a list of rows, pixel x of a row being bit x (1 = foreground).
+	'''
+	text = bit_text(pixels, foreground)
+	return [int(text[y*width:(y+1)*width][::-1], 2) for y in xrange(height)]
+
+def unpack(rows, pixels, width, foreground = 255):
+	'''
+	Writes packed rows (see pack) back into the byte array of a slice: foreground for the bits set, background (255-foreground) for the others.
+	'''
+	table = string.maketrans('01', chr(255-foreground)+chr(foreground))
+	text = ''.join([bin(row)[:1:-1].ljust(width, '0') for row in rows]).translate(table)
+	System.arraycopy(array.array('b', text), 0, pixels, 0, len(text))
+
+###Operations on packed rows
+
+def dilate(rows, width):
+	'''
+	Same as Process -> Binary -> Dilate (count = 1): a pixel becomes foreground if one of its 8 neighbours is, nothing comes from outside the image.
+	'''
+	full = (1 << width)-1
+	line = [row | ((row << 1) & full) | (row >> 1) for row in rows]
+	last = len(rows)-1
+	result = []
+	for y in xrange(len(rows)):
+		row = line[y]
+		if y > 0:
+			row |= line[y-1]
+		if y < last:
+			row |= line[y+1]
+		result.append(row)
+	return result
+
+def erode(rows, width):
+	'''
+	Same as Process -> Binary -> Erode (count = 1): a pixel stays foreground only if its 8 neighbours are, outside the image is background.
+	'''
+	line = [row & (row << 1) & (row >> 1) for row in rows]
+	last = len(rows)-1
+	result = []
+	for y in xrange(len(rows)):
+		if y == 0 or y == last:
+			result.append(0)
+		else:
+			result.append(line[y] & line[y-1] & line[y+1])
+	return result
+
+def despeckle(rows, width):
+	'''
+	Same as Process -> Noise -> Despeckle (3x3 median) on a binary slice: a pixel takes the value of the majority of its 3x3 neighbourhood.
+	The edge pixels are repeated outside the image, like ImageJ.
+	'''
+	full = (1 << width)-1
+	right_edge = 1 << (width-1)
+	last = len(rows)-1
+	# Each column of 3 pixels sorted once: low (AND of the 3), middle (majority of the 3), high (OR of the 3)
+	low, middle, high = [], [], []
+	for y in xrange(len(rows)):
+		up, row, down = rows[max(y-1, 0)], rows[y], rows[min(y+1, last)]
+		low.append(up & row & down)
+		middle.append((up & row) | (up & down) | (row & down))
+		high.append(up | row | down)
+	result = []
+	for y in xrange(len(rows)):
+		columns = []
+		for sorted_row in (low[y], middle[y], high[y]):
+			# Columns on the left and on the right of each pixel (edge column repeated)
+			left = ((sorted_row << 1) & full) | (sorted_row & 1)
+			right = (sorted_row >> 1) | (sorted_row & right_edge)
+			columns.append((left, sorted_row, right))
+		# Median of 9 = median of (largest of the lows, median of the middles, smallest of the highs)
+		a = columns[0][0] | columns[0][1] | columns[0][2]
+		b = (columns[1][0] & columns[1][1]) | (columns[1][0] & columns[1][2]) | (columns[1][1] & columns[1][2])
+		c = columns[2][0] & columns[2][1] & columns[2][2]
+		result.append((a & b) | (a & c) | (b & c))
+	return result
+
+def opening(rows, width, iterations):
+	'''
+	Process -> Binary -> Open: iterations erosions, then iterations dilations.
+	'''
+	for _ in xrange(iterations):
+		rows = erode(rows, width)
+	for _ in xrange(iterations):
+		rows = dilate(rows, width)
+	return rows
+
+def closing(rows, width, iterations):
+	'''
+	Process -> Binary -> Close: iterations dilations, then iterations erosions.
+	'''
+	for _ in xrange(iterations):
+		rows = dilate(rows, width)
+	for _ in xrange(iterations):
+		rows = erode(rows, width)
+	return rows
+
+###Median
+
+def kernel_lines(radius):
+	'''
+	Lines of the circular kernel of Process -> Filters -> Median... (RankFilters): list of (dy, half width), the line dy covers dx = -half width to half width.
+	'''
+	if radius >= 1.5 and radius < 1.75:
+		radius = 1.75
+	elif radius >= 2.5 and radius < 2.85:
+		radius = 2.85
+	r2 = int(radius*radius)+1
+	k_radius = int(math.sqrt(r2+1e-10))
+	return [(dy, int(math.sqrt(r2-dy*dy+1e-10))) for dy in xrange(-k_radius, k_radius+1)]
+
+def shifted(row, width, dx):
+	'''
+	Row of the pixels dx columns away (x+dx for each pixel x), the edge pixels being repeated outside the image.
+	'''
+	full = (1 << width)-1
+	if dx < 0:
+		# Pixel x-k comes to x, the first k pixels take the value of pixel 0
+		k = -dx
+		return ((row << k) & full) | (full & ((1 << k)-1) if row & 1 else 0)
+	if dx > 0:
+		# Pixel x+k comes to x, the last k pixels take the value of pixel width-1
+		return (row >> dx) | (full & ~(full >> dx) if (row >> (width-1)) & 1 else 0)
+	return row
+
+def add(a, b):
+	'''
+	Adds two counts kept as rows of bits (a[k] = bit k of the count of every pixel).
+	'''
+	result = []
+	carry = 0
+	for k in xrange(max(len(a), len(b))):
+		x = a[k] if k < len(a) else 0
+		y = b[k] if k < len(b) else 0
+		result.append(x ^ y ^ carry)
+		carry = (x & y) | (carry & (x ^ y))
+	if carry:
+		result.append(carry)
+	return result
+
+def at_least(count, value):
+	'''
+	Row of the pixels whose count (rows of bits, see add) is at least value.
+	'''
+	result = -1 # every pixel (count = value)
+	for k in xrange(max(len(count), value.bit_length())):
+		bit = count[k] if k < len(count) else 0
+		if (value >> k) & 1:
+			result = bit & result
+		else:
+			result = bit | result
+	return result
+
+def median(rows, width, radius):
+	'''
+	Same as Process -> Filters -> Median... on a binary slice: a pixel is foreground if most pixels of the circular kernel are (RankFilters kernel, edges repeated).
+	The count of each kernel line is made once per row and added for every row it is used by.
+	'''
+	lines = kernel_lines(radius)
+	majority = sum([2*half+1 for dy, half in lines])//2+1
+	last = len(rows)-1
+	# Count of each line width for every row
+	counts = {}
+	for half in set([half for dy, half in lines]):
+		counts[half] = []
+		for row in rows:
+			count = []
+			for dx in xrange(-half, half+1):
+				count = add(count, [shifted(row, width, dx)])
+			counts[half].append(count)
+	full = (1 << width)-1
+	result = []
+	for y in xrange(len(rows)):
+		total = []
+		for dy, half in lines:
+			total = add(total, counts[half][min(max(y+dy, 0), last)])
+		result.append(at_least(total, majority) & full)
+	return result
+
+def binary_median(imp, radius, stack = True):
+	'''
+	Replaces IJ.run(imp, "Median...", "radius=... stack") on a binary image (0 and 255), in place, several slices at the same time.
+	stack : False to filter only the current slice, like the command without "stack"
+	'''
+	width, height = imp.getWidth(), imp.getHeight()
+	def median_slice(planes, index):
+		pixels = planes.getPixels(index)
+		unpack(median(pack(pixels, width, height), width, radius), pixels, width)
+	process_slices(imp, median_slice, None if stack else [imp.getCurrentSlice()])
+	imp.updateAndDraw()
+
+OPERATIONS = {"despeckle" : despeckle, "dilate" : dilate, "erode" : erode}
+
+def run_steps(rows, width, steps):
+	'''
+	Runs a chain of operations on packed rows.
+	steps : list of (operation, iterations), operation being "despeckle", "dilate", "erode", "open" or "close"
+	'''
+	for operation, iterations in steps:
+		if operation == "open":
+			rows = opening(rows, width, iterations)
+		elif operation == "close":
+			rows = closing(rows, width, iterations)
+		elif operation in OPERATIONS:
+			for _ in xrange(iterations):
+				rows = OPERATIONS[operation](rows, width)
+		else:
+			raise ValueError("Unknown binary operation: "+operation)
+	return rows
+
+###Images
+
+def morphology(imp, steps, black = None):
+	'''
+	Runs a chain of binary operations on every slice of imp (binary image, modified in place), in one go per slice, several slices at the same time.
+	steps : list of (operation, iterations), e.g. [("despeckle", 3), ("dilate", 1), ("close", 7)] replaces
+		3 x IJ.run(imp, "Despeckle", "stack"), IJ.run(imp, "Options...", "iterations=1 count=1 black do=Dilate stack")
+		and IJ.run(imp, "Options...", "iterations=7 count=1 black do=Close stack")
+	black : "black" written in the Options... commands (True) or not (False). Like the Options dialog, it sets Prefs.blackBackground,
+		which decides which pixels are the objects (see foreground_value). None keeps the current setting.
+	'''
+	if black is not None:
+		Prefs.blackBackground = black
+	width, height = imp.getWidth(), imp.getHeight()
+	foreground = foreground_value(imp.getProcessor())
+	def morphology_slice(stack, index):
+		pixels = stack.getPixels(index)
+		unpack(run_steps(pack(pixels, width, height, foreground), width, steps), pixels, width, foreground)
+	process_slices(imp, morphology_slice)
+	imp.updateAndDraw()
+
+###Masks
+
+class Mask(object):
+	'''
+	Binary plane of width x height pixels kept as packed rows (see pack), for the AND / OR / XOR of the Roi Manager without ROIs:
+	mask1 & mask2, mask1 | mask2, mask1 ^ mask2 and ~mask give new masks, count() and area(imp) measure them.
+	'''
+	def __init__(self, width, height, rows = None):
+		self.width = width
+		self.height = height
+		self.rows = rows if rows is not None else [0]*height
+
+	@staticmethod
+	def from_image(imp, black = None):
+		'''
+		Mask of the objects of the current slice of a binary image (foreground as the binary commands, see foreground_value).
+		Same pixels as IJ.run(imp, "Create Selection", "").
+		'''
+		ip = imp.getProcessor()
+		return Mask(ip.getWidth(), ip.getHeight(), pack(ip.getPixels(), ip.getWidth(), ip.getHeight(), foreground_value(ip, black)))
+
+	@staticmethod
+	def full(width, height):
+		'''
+		Mask of the whole plane, like "Select All".
+		'''
+		return Mask(width, height, [(1 << width)-1]*height)
+
+	@staticmethod
+	def from_roi(roi, width, height):
+		'''
+		Pixels of roi (any ImageJ selection, the parts outside the plane are left out), the same pixels that are measured with the ROI.
+		'''
+		mask = Mask(width, height)
+		mask.add_roi(roi, '|')
+		return mask
+
+	@staticmethod
+	def from_rois(rois, width, height, operation = '|'):
+		'''
+		Combines a list of ROIs like selecting them in the Roi Manager and using "OR" (operation = '|') or "XOR" (operation = '^').
+		'''
+		mask = Mask(width, height)
+		for roi in rois:
+			mask.add_roi(roi, operation)
+		return mask
+
+	def add_roi(self, roi, operation = '|'):
+		'''
+		Adds the pixels of roi to the mask in place, with OR (operation = '|') or XOR ('^'). Only the rows of its bounding box are changed.
+		'''
+		bounds = roi.getBounds()
+		roi_mask = roi.getMask() # None for a rectangle
+		if roi_mask is None:
+			roi_rows = [(1 << bounds.width)-1]*bounds.height
+		else:
+			roi_rows = pack(roi_mask.getPixels(), bounds.width, bounds.height, 255)
+		inside = (1 << self.width)-1
+		for dy in xrange(bounds.height):
+			y = bounds.y+dy
+			if 0 <= y < self.height:
+				row = roi_rows[dy] << bounds.x if bounds.x >= 0 else roi_rows[dy] >> -bounds.x
+				if operation == '^':
+					self.rows[y] ^= row & inside
+				else:
+					self.rows[y] |= row & inside
+
+	def __and__(self, other):
+		return Mask(self.width, self.height, [a & b for a, b in zip(self.rows, other.rows)])
+
+	def __or__(self, other):
+		return Mask(self.width, self.height, [a | b for a, b in zip(self.rows, other.rows)])
+
+	def __xor__(self, other):
+		return Mask(self.width, self.height, [a ^ b for a, b in zip(self.rows, other.rows)])
+
+	def __invert__(self):
+		inside = (1 << self.width)-1
+		return Mask(self.width, self.height, [row ^ inside for row in self.rows])
+
+	def count(self):
+		'''
+		Number of pixels of the mask.
+		'''
+		return sum([bin(row).count('1') for row in self.rows])
+
+	def area(self, imp):
+		'''
+		Calibrated area of the mask on imp (same value as "Measure" with the corresponding ROI).
+		'''
+		calibration = imp.getCalibration()
+		return self.count()*calibration.pixelWidth*calibration.pixelHeight
+
+	def mean(self, imp):
+		'''
+		Mean intensity of the current slice of imp inside the mask (same value as imp.getStatistics().mean with the corresponding ROI).
+		'''
+		ip = imp.getProcessor()
+		ip.setRoi(0, 0, self.width, self.height)
+		ip.setMask(self.processor())
+		stats = ImageStatistics.getStatistics(ip, Measurements.MEAN, imp.getCalibration())
+		ip.resetRoi()
+		return stats.mean
+
+	def processor(self):
+		'''
+		The mask as a binary image (ByteProcessor, 255 inside and 0 outside).
+		'''
+		ip = ByteProcessor(self.width, self.height)
+		unpack(self.rows, ip.getPixels(), self.width, 255)
+		return ip
+
+	def roi(self):
+		'''
+		Selection of the pixels of the mask (same as "Create Selection"), only needed to show the mask or to give it to ImageJ. None if the mask is empty.
+		'''
+		if not any(self.rows):
+			return None
+		ip = self.processor()
+		ip.setThreshold(255, 255, ImageProcessor.NO_LUT_UPDATE)
+		return ThresholdToSelection().convert(ip)
+
+###Connected components
+
+def row_runs(text, width, height, value = '1'):
+	'''
+	Runs of value ('1' or '0') in each row of a bit text (see bit_text): list of rows, each a list of (start, end) with end excluded.
+	'''
+	pattern = re.compile(value+'+')
+	rows = []
+	for y in xrange(height):
+		offset = y*width
+		rows.append([(run.start()-offset, run.end()-offset) for run in pattern.finditer(text, offset, offset+width)])
+	return rows
+
+def find(parent, i):
+	'''
+	Root of run i in the union-find (the first run of its component in raster order).
+	'''
+	while parent[i] != i:
+		parent[i] = parent[parent[i]]
+		i = parent[i]
+	return i
+
+def join_runs(rows, diagonal):
+	'''
+	Groups the runs of rows (see row_runs) into connected components.
+	diagonal : True for 8-connected components (like Analyze Particles), False for 4-connected ones
+	Returns (runs, components): runs = list of (y, start, end) in raster order, components[i] = component number of run i,
+	the components being numbered from 0 in the order of their first pixel (top to bottom, left to right).
+	'''
+	reach = 1 if diagonal else 0
+	runs = []
+	parent = []
+	previous = []
+	for y in xrange(len(rows)):
+		current = []
+		for start, end in rows[y]:
+			index = len(runs)
+			runs.append((y, start, end))
+			parent.append(index)
+			current.append((start, end, index))
+		join_rows(parent, previous, current, reach)
+		previous = current
+	return runs, numbering(parent, range(len(runs)))
+
+def union(parent, a, b):
+	'''
+	Joins the groups of a and b in the union-find parent, the smallest root being kept (first in raster order).
+	'''
+	a, b = find(parent, a), find(parent, b)
+	if a < b:
+		parent[b] = a
+	elif b < a:
+		parent[a] = b
+
+def join_rows(parent, above, below, reach):
+	'''
+	Joins the runs of two rows next to each other that touch. above, below : lists of (start, end, index in parent).
+	reach : 1 if diagonal neighbours touch (8-connected), 0 otherwise
+	'''
+	j = 0
+	for start, end, index in below:
+		while j < len(above) and above[j][1]+reach <= start:
+			j += 1
+		k = j
+		while k < len(above) and above[k][0] < end+reach:
+			union(parent, index, above[k][2])
+			k += 1
+
+def numbering(parent, items):
+	'''
+	Final component number of each of items (indexes in parent, in raster order): 0, 1, 2... in the order of their first appearance.
+	'''
+	numbers = {}
+	components = []
+	for item in items:
+		root = find(parent, item)
+		if root not in numbers:
+			numbers[root] = len(numbers)
+		components.append(numbers[root])
+	return components
+
+def first_runs(rows):
+	'''
+	Index of the first run of each row of rows (see row_runs) in the list of all the runs (see join_runs).
+	'''
+	firsts = []
+	count = 0
+	for row in rows:
+		firsts.append(count)
+		count += len(row)
+	return firsts
+
+def run_at(rows, starts, x, y):
+	'''
+	Position of the run of row y containing pixel x in rows (see row_runs), starts[y] being the list of the run starts of row y. None if there is none.
+	'''
+	i = bisect.bisect_right(starts[y], x)-1
+	if i >= 0 and rows[y][i][1] > x:
+		return i
+	return None
+
+def trace_outline(text, width, height, y, end):
+	'''
+	Outline of the particle whose first run (top row) ends at end (excluded) in row y, as traced by the wand of Analyze Particles:
+	the corners of the pixel borders around the particle, clockwise, starting after the top right corner of the first run (which comes last).
+	Returns (xpoints, ypoints).
+	'''
+	def inside(x, y):
+		return 0 <= x < width and 0 <= y < height and text[y*width+x] == '1'
+	# Directions clockwise (right, down, left, up), and the pixel on their right side from a corner (x, y)
+	moves = ((1, 0), (0, 1), (-1, 0), (0, -1))
+	right_side = ((0, 0), (-1, 0), (-1, -1), (0, -1))
+	start = (end, y)
+	x, y = end, y+1
+	direction = 1 # down, along the right border of the first run
+	xpoints, ypoints = [], []
+	while (x, y) != start:
+		left = (direction-1)%4
+		if inside(x+right_side[left][0], y+right_side[left][1]):
+			new = left # diagonal neighbours are connected (8-connected particles)
+		elif inside(x+right_side[direction][0], y+right_side[direction][1]):
+			new = direction
+		else:
+			new = (direction+1)%4
+		if new != direction:
+			xpoints.append(x)
+			ypoints.append(y)
+		direction = new
+		x, y = x+moves[direction][0], y+moves[direction][1]
+	xpoints.append(start[0])
+	ypoints.append(start[1])
+	return xpoints, ypoints
+
+def particle_tree(rows, owner, background, hole_owner, width, height):
+	'''
+	Everything Analyze Particles needs to know about the particles of a binary slice, from its runs already grouped (see join_runs):
+	rows, owner : foreground runs of each row and 8-connected component of every run
+	background, hole_owner : background runs of each row and 4-connected component of every run
+	Returns a dictionary with:
+		'runs' : list of the foreground runs (y, start, end) in raster order
+		'size', 'first', 'bounds' : for each particle, its number of pixels (holes excluded), its first run and its bounds [x min, y min, x max+1, y max+1]
+		'holes' : list of the background runs (y, start, end) in raster order, 'hole_owner' : hole of each of them
+		'hole_size' : number of pixels of each hole (background not touching the image border)
+		'enclosing' : particle around each hole (None for the background touching the border)
+		'parent' : particle around each particle (the one whose hole contains it, None if there is none)
+	'''
+	runs = [(y, start, end) for y in xrange(height) for start, end in rows[y]]
+	holes = [(y, start, end) for y in xrange(height) for start, end in background[y]]
+	n_particles = max(owner)+1 if owner else 0
+	n_holes = max(hole_owner)+1 if hole_owner else 0
+	# Size and bounds of every particle
+	size = [0]*n_particles
+	first = [None]*n_particles
+	bounds = [[width, height, -1, -1] for _ in xrange(n_particles)]
+	for index in xrange(len(runs)):
+		y, start, end = runs[index]
+		p = owner[index]
+		size[p] += end-start
+		if first[p] is None:
+			first[p] = index
+		box = bounds[p]
+		box[0] = min(box[0], start)
+		box[1] = min(box[1], y)
+		box[2] = max(box[2], end)
+		box[3] = y+1
+	# Holes: background (4-connected) that does not touch the image border, each belongs to the particle just above its first pixel
+	border = [False]*n_holes
+	hole_first = [None]*n_holes
+	hole_size = [0]*n_holes
+	for index in xrange(len(holes)):
+		y, start, end = holes[index]
+		h = hole_owner[index]
+		hole_size[h] += end-start
+		if hole_first[h] is None:
+			hole_first[h] = index
+		if y == 0 or y == height-1 or start == 0 or end == width:
+			border[h] = True
+	starts = [[start for start, end in row] for row in rows]
+	row_first = first_runs(rows)
+	enclosing = [None]*n_holes
+	for h in xrange(n_holes):
+		if border[h]:
+			hole_size[h] = 0
+		else:
+			y, start, end = holes[hole_first[h]]
+			enclosing[h] = owner[row_first[y-1]+run_at(rows, starts, start, y-1)]
+	# Particle inside each hole (the background just above its first pixel)
+	background_starts = [[start for start, end in row] for row in background]
+	background_first = first_runs(background)
+	parent = [None]*n_particles
+	for p in xrange(n_particles):
+		y, start, end = runs[first[p]]
+		if y > 0:
+			parent[p] = enclosing[hole_owner[background_first[y-1]+run_at(background, background_starts, start, y-1)]]
+	return {'runs' : runs, 'size' : size, 'first' : first, 'bounds' : bounds, 'holes' : holes, 'hole_owner' : hole_owner,
+		'hole_size' : hole_size, 'enclosing' : enclosing, 'parent' : parent}
+
+def fill_labels(tree, label):
+	'''
+	Gives the particles that were not kept (label 0) the label of the innermost particle kept around them, like ROIs painted one after the other.
+	label : label of each particle of tree (see particle_tree), changed in place
+	'''
+	parent = tree['parent']
+	for p in xrange(len(label)):
+		if label[p] == 0 and parent[p] is not None:
+			label[p] = label[parent[p]]
+
+def label_components(pixels, width, height, foreground = 255, min_size = 0, max_size = float("inf"), min_circularity = 0.0, max_circularity = 1.0, filled = False):
+	'''
+	Finds the particles (8-connected components) of a binary slice (byte array) in one pass over its runs, with the filters of Analyze Particles.
+	min_size, max_size : limits of the particle size in pixels (pixels of the particle itself, holes and particles inside them excluded, like Analyze Particles)
+	min_circularity, max_circularity : limits of 4pi*size/perimeter^2 (perimeter = getLength() of the traced ROI, see particle_roi)
+	filled : the holes of the particles get their label as well, like the ROIs of Analyze Particles painted in a label image (see labels_from_rois in image_tools)
+	Returns (labels, particles): labels = label image (the particles kept get the values 1, 2... in the order of Analyze Particles, 0 elsewhere),
+	particles = list of dictionaries, one per particle kept, with 'label', 'size' (pixels), 'perimeter' (pixels), 'circularity',
+	'bounds' (x, y, width, height) and 'outline' (xpoints, ypoints of the traced outline, see particle_roi).
+	'''
+	text = bit_text(pixels, foreground)
+	rows = row_runs(text, width, height, '1')
+	background = row_runs(text, width, height, '0')
+	owner = join_runs(rows, True)[1]
+	hole_owner = join_runs(background, False)[1]
+	tree = particle_tree(rows, owner, background, hole_owner, width, height)
+	runs, size = tree['runs'], tree['size']
+	# Filters, in the same order as Analyze Particles
+	label = [0]*len(size)
+	particles = []
+	check_shape = min_circularity > 0.0 or max_circularity != 1.0
+	for p in xrange(len(size)):
+		if size[p] < min_size or size[p] > max_size:
+			continue
+		y, start, end = runs[tree['first'][p]]
+		xpoints, ypoints = trace_outline(text, width, height, y, end)
+		# Perimeter given by ImageJ for the traced ROI, as used by Analyze Particles
+		perimeter = PolygonRoi(xpoints, ypoints, len(xpoints), Roi.TRACED_ROI).getLength()
+		circularity = 4.0*math.pi*size[p]/(perimeter*perimeter) if perimeter > 0 else 0.0
+		if circularity > 1.0 and max_circularity <= 1.0:
+			circularity = 1.0
+		if check_shape and (circularity < min_circularity or circularity > max_circularity):
+			continue
+		label[p] = len(particles)+1
+		box = tree['bounds'][p]
+		particles.append({'label' : label[p], 'size' : size[p], 'perimeter' : perimeter, 'circularity' : circularity,
+			'bounds' : (box[0], box[1], box[2]-box[0], box[3]-box[1]), 'outline' : (xpoints, ypoints)})
+	# Label image
+	if filled:
+		fill_labels(tree, label)
+	if len(particles) < 65536:
+		labels = ShortProcessor(width, height)
+		value = lambda l: l if l < 32768 else l-65536 # 16-bit values are stored as signed numbers
+	else:
+		labels = FloatProcessor(width, height)
+		value = float
+	label_pixels = labels.getPixels()
+	for index in xrange(len(runs)):
+		l = label[owner[index]]
+		if l:
+			y, start, end = runs[index]
+			Arrays.fill(label_pixels, y*width+start, y*width+end, value(l))
+	if filled:
+		holes, enclosing = tree['holes'], tree['enclosing']
+		for index in xrange(len(holes)):
+			p = enclosing[hole_owner[index]]
+			if p is not None and label[p]:
+				y, start, end = holes[index]
+				Arrays.fill(label_pixels, y*width+start, y*width+end, value(label[p]))
+	return labels, particles
+
+def particle_roi(particle):
+	'''
+	Traced ROI of a particle found by label_components (same shape as the ROI added by Analyze Particles).
+	'''
+	xpoints, ypoints = particle['outline']
+	return PolygonRoi(xpoints, ypoints, len(xpoints), Roi.TRACED_ROI)
+
+def analyze_particles(imp, rm = None, min_size = 0, max_size = float("inf"), min_circularity = 0.0, max_circularity = 1.0, show = False, filled = True):
+	'''
+	Replaces IJ.run(imp, "Analyze Particles...", "size=min_size-max_size circularity=min_circularity-max_circularity show=Nothing clear add")
+	on the current slice of a binary image (the objects are found like the binary commands, see foreground_value).
+	min_size, max_size : calibrated units (e.g. micron^2), as in the command
+	rm : Roi Manager to fill with the ROIs of the particles (emptied first), None to make no ROI at all
+	show : shows the ROIs on imp (show=Overlay)
+	Returns (labels, particles) as label_components (filled label image by default), with the calibrated 'area' of each particle added.
+	'''
+	calibration = imp.getCalibration()
+	pixel_area = calibration.pixelWidth*calibration.pixelHeight
+	ip = imp.getProcessor()
+	labels, particles = label_components(ip.getPixels(), imp.getWidth(), imp.getHeight(), foreground_value(ip),
+		min_size/pixel_area, max_size/pixel_area, min_circularity, max_circularity, filled)
+	for particle in particles:
+		particle['area'] = particle['size']*pixel_area
+	if rm is not None or show:
+		rois = [particle_roi(particle) for particle in particles]
+		if rm is not None:
+			rm.reset()
+			for roi in rois:
+				rm.addRoi(roi)
+		if show:
+			overlay = Overlay()
+			for roi in rois:
+				overlay.add(roi)
+			imp.setOverlay(overlay)
+	return labels, particles
+
+def label_areas(labels, count, pixel_area = 1.0):
+	'''
+	Area of each label 1..count of a label image (see label_components), from one histogram of the image instead of one ROI per label.
+	pixel_area : area of one pixel (pixelWidth*pixelHeight of the calibration) to get calibrated areas, 1 for pixels
+	Returns a list of count areas, the area of the label l being at index l-1.
+	'''
+	if isinstance(labels, ShortProcessor):
+		counts = labels.getHistogram() # one bin per 16-bit value
+	else:
+		counts = [0]*(count+1)
+		for value in labels.getPixels():
+			counts[int(value)] += 1
+	return [counts[l]*pixel_area for l in xrange(1, count+1)]
+
+###Tiles
+
+class RowScan(object):
+	'''
+	Particles of a binary plane given one row at a time, with the size filter and the areas of analyze_particles (filled label image, no circularity filter).
+	Only the particles and holes that reach the last row given are kept in memory (with the runs of that row):
+	the others are finished as soon as the row below them is joined, and only the particles kept are remembered.
+	Each open particle or hole is a record [first y, first x, size, inherited pixels, run above the first run, x min, x max+1, y max+1, touches the border],
+	the inherited pixels being the ones that get its label in the filled label image (its holes, and the particles not kept inside them, see fill_labels).
+	'''
+	def __init__(self, width, height, min_size = 0, max_size = float("inf")):
+		'''
+		min_size, max_size : limits of the particle size in pixels
+		'''
+		self.width, self.height = width, height
+		self.min_size, self.max_size = min_size, max_size
+		self.parent = {} # union-find of the runs of the open particles and holes (run number -> run number, the root being the first run)
+		self.open = {} # root -> record of the open particles and holes
+		self.previous = ([], []) # runs (start, end, run number) of the last row given: foreground, background
+		self.runs = 0
+		self.y = 0
+		self.kept = [] # (first y, first x, size, bounds, pixels with the inherited ones) of the particles kept
+
+	def find(self, i):
+		'''
+		Root of run i (see find).
+		'''
+		return find(self.parent, i)
+
+	def new_runs(self, runs, other, hole):
+		'''
+		Numbers the runs (start, end) of the current row and makes their records. other : runs of the other kind in the row above.
+		'''
+		y = self.y
+		starts = [start for start, end, number in other]
+		numbered = []
+		for start, end in runs:
+			number = self.runs
+			self.runs += 1
+			self.parent[number] = number
+			# Run of the other kind just above the first pixel (only used if this run is the first of its particle or hole)
+			i = bisect.bisect_right(starts, start)-1
+			above = other[i][2] if i >= 0 and other[i][1] > start else None
+			border = hole and (y == 0 or y == self.height-1 or start == 0 or end == self.width)
+			self.open[number] = [y, start, end-start, 0, above, start, end, y+1, border]
+			numbered.append((start, end, number))
+		return numbered
+
+	def union(self, a, b):
+		'''
+		Joins the particles (or holes) of runs a and b, their records are added up in the one of the first run.
+		'''
+		a, b = self.find(a), self.find(b)
+		if a == b:
+			return
+		if b < a:
+			a, b = b, a
+		self.parent[b] = a
+		first, other = self.open[a], self.open.pop(b)
+		first[2] += other[2]
+		first[3] += other[3]
+		first[5] = min(first[5], other[5])
+		first[6] = max(first[6], other[6])
+		first[7] = max(first[7], other[7])
+		first[8] = first[8] or other[8]
+
+	def join(self, above, below, reach):
+		'''
+		Joins the runs of two rows that touch (see join_rows).
+		'''
+		j = 0
+		for start, end, number in below:
+			while j < len(above) and above[j][1]+reach <= start:
+				j += 1
+			k = j
+			while k < len(above) and above[k][0] < end+reach:
+				self.union(number, above[k][2])
+				k += 1
+
+	def close(self, above, below, hole):
+		'''
+		Finishes the particles (or holes) of the row above that do not go on in the row below.
+		'''
+		going_on = set([self.find(number) for start, end, number in below])
+		for root in sorted(set([self.find(number) for start, end, number in above])):
+			if root not in going_on:
+				self.finish(root, hole)
+
+	def finish(self, root, hole):
+		'''
+		A particle is kept, or gives its pixels to the particle around it (through the hole it is in, see fill_labels);
+		a hole gives its pixels to the particle around it, unless it touches the border (it is not a hole then).
+		The particle or hole around is still open: it goes further down than what it surrounds.
+		'''
+		record = self.open.pop(root)
+		pixels = record[2]+record[3]
+		if not hole and self.min_size <= record[2] <= self.max_size:
+			self.kept.append((record[0], record[1], record[2], (record[5], record[0], record[6]-record[5], record[7]-record[0]), pixels))
+			return
+		if (hole and record[8]) or record[4] is None:
+			return
+		around = self.open.get(self.find(record[4]))
+		if around is not None:
+			around[3] += pixels
+
+	def add_row(self, runs, background):
+		'''
+		Gives the next row of the plane: runs of foreground (8-connected) and background (4-connected) pixels, lists of (start, end) (see row_runs).
+		'''
+		above, above_background = self.previous
+		current = self.new_runs(runs, above_background, False)
+		current_background = self.new_runs(background, above, True)
+		self.join(above, current, 1)
+		self.join(above_background, current_background, 0)
+		# The particles first: a particle not kept gives its pixels to the hole around it before the hole is finished
+		self.close(above, current, False)
+		self.close(above_background, current_background, True)
+		self.previous = (current, current_background)
+		self.y += 1
+
+	def compact(self):
+		'''
+		Forgets the runs of the union-find that are not needed anymore (only the roots of the open particles and holes are kept).
+		'''
+		for record in self.open.values():
+			if record[4] is not None:
+				record[4] = self.find(record[4])
+				if record[4] not in self.open:
+					record[4] = None # finished: only possible for the background touching the border, whose pixels are not counted
+		self.previous = tuple([[(start, end, self.find(number)) for start, end, number in row] for row in self.previous])
+		self.parent = dict([(root, root) for root in self.open.keys()])
+
+	def particles(self, pixel_area = 1.0):
+		'''
+		Finishes the scan (after the last row) and returns the particles kept, as tiled_particles.
+		'''
+		self.close(self.previous[0], [], False)
+		self.close(self.previous[1], [], True)
+		self.previous = ([], [])
+		particles = []
+		for first_y, first_x, size, bounds, pixels in sorted(self.kept):
+			particles.append({'label' : len(particles)+1, 'size' : size, 'bounds' : bounds, 'area' : pixels*pixel_area})
+		return particles
+
+def tiled_particles(imp, lower, upper, min_size = 0, max_size = float("inf"), size = 1024):
+	'''
+	Same particles as "Convert to Mask" with the threshold lower-upper on the current plane of imp, then analyze_particles (filled label image, no circularity filter),
+	without making the mask of the whole plane: the tiles of size rows (see bands in image_tools) are thresholded and cut in runs several at the same time,
+	then their rows are given to a RowScan from top to bottom, which only keeps the particles still open at the last row.
+	Only one tile per thread is in memory at a time.
+	min_size, max_size : calibrated units (e.g. micron^2)
+	Returns a list of dictionaries, one per particle kept in the order of Analyze Particles, with 'label', 'size' (pixels of the particle itself),
+	'bounds' (x, y, width, height) and 'area' (calibrated area of the particle with its holes, the same as label_areas on the label image of analyze_particles).
+	'''
+	ip = imp.getProcessor()
+	width, height = ip.getWidth(), ip.getHeight()
+	calibration = imp.getCalibration()
+	pixel_area = calibration.pixelWidth*calibration.pixelHeight
+	parts = bands(height, size)
+	scan = RowScan(width, height, min_size/pixel_area, max_size/pixel_area)
+	group = max(1, Prefs.getThreads())
+	for first in xrange(0, len(parts), group):
+		tiles = {}
+		def find_runs(stack, index):
+			y, rows_count = parts[index]
+			band = band_processor(ip, y, rows_count)
+			band.setThreshold(lower, upper, ImageProcessor.NO_LUT_UPDATE)
+			text = bit_text(band.createMask().getPixels()) # pixels from lower to upper included, like "Convert to Mask"
+			tiles[index] = (row_runs(text, width, rows_count, '1'), row_runs(text, width, rows_count, '0'))
+		process_slices(imp, find_runs, range(first, min(first+group, len(parts))))
+		for index in sorted(tiles.keys()):
+			rows, background = tiles.pop(index)
+			for y in xrange(len(rows)):
+				scan.add_row(rows[y], background[y])
+		scan.compact()
+	return scan.particles(pixel_area)
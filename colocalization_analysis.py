@@ -7,7 +7,7 @@
 	# contact for help: solenedeutsch@gmail.com
 
 # Aim of the script
-	# Running a colocalization analysis between two channels and retrieving the result as a text file
+	# Running a colocalization analysis between two channels and retrieving the result as a .npz file (columns, see result_store.py)
 		# the data can then be analyzed using the colocalization_stat.py python script
 
 # /!\ Getting started /!\
@@ -15,6 +15,12 @@
 	# this script is currently only suited for z-stacks
 	# this script can currently handle only one marker to analyze in the colocalization with the vessels
 	# if there are a lot of images to be analyzed, run the script on the HIVE to avoid memory issues
+		# (the vessels are cropped one at a time around their bounding box, so the number of vessels per image does not matter much anymore)
+	# image_tools.py, colocalization_tools.py, binary_masks.py, result_store.py and batch_tools.py have to be copied in the Fiji.app/jars/Lib folder (the script imports functions from them)
+	# to run the script unattended on a whole directory, use a config file with a [colocalization_analysis] section (see batch_tools.py and batch_config_example.ini)
+		# keys: input_dir, output_dir, vessel_channel, coloc_channel (numbers as in the "C=" of the split channel titles), format, psf, randomizations, seed
+		# (and workers to analyze several images at the same time, resume = true to finish a run that stopped, see batch_tools.py)
+		# in batch mode the images are opened from the files (no need to split the channels), each vessel is named after the image title
 	# in ImageJ, measurement has to include "Stack position" and "Min Max intensity" (Analyze -> Set Measurement...)
 	# a first try to ensure the thresholding works correctly is necessary for every new dataset
 	# before starting : check the naming part in run_coloc() and modify according to your data
@@ -39,13 +45,30 @@ from ij.plugin import ImageCalculator, ZProjector
 from ij.measure import ResultsTable
 from ij.plugin.frame import RoiManager
 from ij.gui import WaitForUserDialog
+from image_tools import crop_vessels, crop_like, gaussian_blur, Channels
+from binary_masks import morphology, binary_median, analyze_particles
+from colocalization_tools import masked_pairs, masked_blocks, value_range, colocalize
+from result_store import write_results
+from batch_tools import load_config, setting, get_number, get_string, output_dir, images, roi_manager, gather, Journal
 import os
+import csv
+import json
+import math
 
 ### Global variables
 
-DATA = {}
+CONFIG = load_config("colocalization_analysis") # None unless a config file is given (batch mode)
 
-os.chdir("my_directory")
+DATA = {} # key -> ColocResult (see colocalization_tools)
+
+MARGIN = 25 # number of pixels kept around each vessel when cropping, so that the filters see the same neighbourhood as on the whole image
+
+# Costes significance test (Coloc 2 used psf=3 costes_randomisations=10), the same SEED gives the same p-values
+PSF = int(setting(CONFIG, "psf", 3))
+RANDOMIZATIONS = int(setting(CONFIG, "randomizations", 200))
+SEED = int(setting(CONFIG, "seed", 0))
+
+os.chdir(output_dir(CONFIG, "my_directory"))
 
 ### Part 1: colocalization analysis
 
@@ -63,61 +86,45 @@ def select_vessel(OriImage):
 	IJ.setAutoThreshold(Thresholded, "Moments dark")
 	IJ.run(Thresholded, "Make Binary", "method=Moments background=Dark calculate")
 	Filtered = Thresholded.duplicate()
-	IJ.run(Filtered, "Median...", "radius=2")
+	binary_median(Filtered, 2, False) # current slice only, like "Median..." without "stack" (see binary_masks)
 	IJ.run(Filtered, "Make Binary", "method=Otsu background=Dark calculate")
 	ic = ImageCalculator()
 	FinalIg = ic.run("Subtract create stack", Thresholded, Filtered)
 	# 'Cleaning up'
-	for _ in range(7):
-		IJ.run(FinalIg, "Despeckle", "stack")
-	IJ.run(FinalIg, "Options...", "iterations=2 count=1 do=Dilate stack")
-	IJ.run(FinalIg, "Options...", "iterations=10 count=1 do=Close stack")
+	# 7 x Despeckle, Dilate x2 and Close x10 in one go per slice (see binary_masks), without "black" as the Options... commands it replaces
+	morphology(FinalIg, [("despeckle", 7), ("dilate", 2), ("close", 10)], black = False)
 	# z-projection
 	FinalIg = ZProjector.run(FinalIg,"max")
 	return FinalIg
 
 def define_ROI(vessels, OriImage, control = False):
 	'''
-	Takes the z-projection and returns a list of z-stacks, each containing a single vessel.
-	Both parameters are images, returns a list of images.
+	Takes the z-projection and gives the vessels one at a time, each as a z-stack cropped around a single vessel (plus MARGIN pixels).
+	Both parameters are images. The vessel z-stacks are only made when the loop gets to them (see crop_vessels in image_tools).
 	'''
 	# Isolate individual vessels
-	rm = RoiManager.getRoiManager()
-	IJ.run(vessels, "Analyze Particles...", "size=30-Infinity show=Nothing display clear add stack")
-	table = ResultsTable.getResultsTable()
-	n_roi = rm.getCount() # number of ROIs (=number of vessels detected)
-	n_slices = int(table.getValue("Slice", n_roi-1)) # number of slices per z-stack
-	list_vessels = []
+	rm = roi_manager(CONFIG)
+	analyze_particles(vessels, rm, 30) # the ROIs of the vessels go to the Roi Manager (see binary_masks)
 	ra = rm.getRoisAsArray()
-	# Apply ROI and clear outside to keep only the vessel part
-	for i in range(n_roi):
-		single_vessel = OriImage.duplicate()
-		single_vessel.setRoi(ra[i])
-		IJ.setBackgroundColor(0,0,0)
-		IJ.run(single_vessel, "Clear Outside", "stack")
-		IJ.run(single_vessel, "Select None", "stack")
-		list_vessels.append(single_vessel)
-		if control:
-			single_vessel.show()
-			myWait = WaitForUserDialog("Time to look at the data", "Check if the detected shape corresponds to an actual vessel.\nIf it is not the case, you might want to change the thresholding method.")
-			myWait.show()
-			single_vessel.changes = False
-			single_vessel.close()
-	return list_vessels
+	# Crop around each ROI and clear outside to keep only the vessel part
+	return crop_vessels(OriImage, ra, control, "Check if the detected shape corresponds to an actual vessel.\nIf it is not the case, you might want to change the thresholding method.", MARGIN)
 
-def blur_image(current_image):
+def blur_image(current_image, copy = True):
 	'''
-	Adds a Gaussian filter to try and remove a bit of noise.
-	Parameter is an image, returns an image.
+	Adds a Gaussian filter to try and remove a bit of noise (same as "Gaussian Blur... sigma=2 stack", several slices at the same time).
+	Parameter is an image, returns an image. With copy = False, current_image itself is blurred (for an image that is not needed anymore).
 	'''
-	duplicate_image = current_image.duplicate()
-	IJ.run(duplicate_image, "Gaussian Blur...", "sigma=2 stack")
-	return duplicate_image
+	if copy:
+		current_image = current_image.duplicate()
+	gaussian_blur(current_image, 2)
+	return current_image
 
 def coloc(current_vessel, current_chan1):
 	'''
-	Runs the colocalization analysis on the the two channels current_vessel and current_chan1.
-	Results of the analysis are displayed in both a colocalization results window, and the log window.
+	Prepares the colocalization analysis on the the two channels current_vessel and current_chan1.
+	Returns the pixel values of both (blurred) channels inside the refined vessel mask, as a joint histogram (see masked_pairs in colocalization_tools),
+	and cut in blocks of PSF pixels for the Costes significance test (see masked_blocks).
+	The analysis itself is done by colocalize (see analyze_image).
 	List of relevant variables :
 		OriImage = original image containing the vessel staining
 		Thresholded = same image to be thresholded using the triangle method
@@ -130,60 +137,85 @@ def coloc(current_vessel, current_chan1):
 	IJ.setAutoThreshold(Thresholded, "Triangle dark")
 	IJ.run(Thresholded, "Make Binary", "method=Otsu background=Dark calculate")
 	Filtered = Thresholded.duplicate()
-	IJ.run(Filtered, "Median...", "radius=2 stack")
+	binary_median(Filtered, 2) # every slice at the same time (see binary_masks)
 	IJ.run(Filtered, "Make Binary", "method=Otsu background=Dark calculate")
 	ic = ImageCalculator()
 	FinalIg = ic.run("Subtract create stack", Thresholded, Filtered)
-	IJ.run(FinalIg, "Options...", "iterations=5 count=1 do=Close stack")
-	for _ in range(5):
-		IJ.run(FinalIg, "Despeckle", "stack")
-	IJ.run(FinalIg, "Options...", "iterations=5 count=1 do=Dilate stack")
+	# Close x5, 5 x Despeckle and Dilate x5 in one go per slice (see binary_masks)
+	morphology(FinalIg, [("close", 5), ("despeckle", 5), ("dilate", 5)], black = False)
 	Prefs.blackBackground = True
 	IJ.run(FinalIg, "Convert to Mask", "method=Otsu background=Light calculate")
-	IJ.run(FinalIg, "Invert LUT", "")
-	FinalIg.show()
-	ROI = FinalIg.getTitle()
 	# Applying Gaussian filters to remove some noise
-	current_vessel = blur_image(current_vessel)
-	current_vessel.show()
-	title_vessel = current_vessel.getTitle()
-	current_chan1.show()
-	title_chan1 = current_chan1.getTitle()
-	# Running the colocalization analysis
-	IJ.run("Coloc 2", "channel_1=["+title_chan1+"] channel_2=["+title_vessel+"] roi_or_mask=["+ROI+"] threshold_regression=Costes manders'_correlation psf=3 costes_randomisations=10")
-	# Closing useless windows
+	blurred_vessel = blur_image(current_vessel, False) # the vessel crop is not used after this
+	# Channel 1 = other staining, channel 2 = vessel (same order as in Coloc 2)
+	pairs = masked_pairs(current_chan1, blurred_vessel, FinalIg)
+	blocks = masked_blocks(current_chan1, blurred_vessel, FinalIg, PSF)
+	# Closing useless images
+	blurred_vessel.changes = False
+	blurred_vessel.close()
 	FinalIg.changes = False
 	FinalIg.close()
+	return pairs, blocks
 
-def retrieve_data(isolate_vessels, image_name, vessel_number):
+def analyze_image(curr_vessel, active_chan1, current_dict_key, control, total_vessels):
 	'''
-	Stores Manders tM1 and tM2 values (from the colocalization analysis of image_name) in the data dictionary, then adds the mean pixel intensity as well
-	key -> image_name (short for readability)
-	value -> list containing tM1 value and tM2 value
+	Colocalization of every vessel of one image.
+	curr_vessel, active_chan1 : vessel channel and other channel (z-stacks)
+	current_dict_key : short name of the image, the vessels are named current_dict_key_0, current_dict_key_1...
+	The results are stored in DATA and the vessel names are added to total_vessels.
 	'''
-	# Creates an entry in the dictionary
-	DATA[image_name] = []
-	# Retrieves text from the log window
-	logText = IJ.getLog()
-	list_log = logText.split("\n")
-	# Takes specifically Manders' M1 and M2 values
-	for i in range(len(list_log)):
-		if "Manders" in list_log[i] and "tM" in list_log[i]:
-			for k in range(len(list_log[i])):
-				if list_log[i][k] == ",":
-					value = list_log[i][k+2:]
-					# Adds values to the correct dictionary entry
-					DATA[image_name].append(value)
-	# Closes the log window to clear it for the next image
-	IJ.selectWindow("Log")
-	IJ.run("Close")
+	# Making a blurred version of the first channel
+	blur_current_chan1 = blur_image(active_chan1)
+	# Selecting the vessels in the image
+	isolate_vessels = select_vessel(curr_vessel)
+	current_vessel_list = define_ROI(isolate_vessels, curr_vessel, control)
+	type_min, type_max = value_range(blur_current_chan1)
+	# Each vessel is analyzed as soon as its pixels are read, so that only the pixels of one vessel are kept at a time
+	for k, current_vessel in enumerate(current_vessel_list):
+		current_dict_key_vessel = current_dict_key + "_"+ str(k) # image code name
+		current_vessel.setTitle(current_dict_key_vessel)
+		total_vessels.append(current_vessel.getTitle())
+		current_chan1 = crop_like(blur_current_chan1, current_vessel) # same region of the other channel
+		pairs, blocks = coloc(current_vessel, current_chan1)
+		current_chan1.changes = False
+		current_chan1.close()
+		# Storing the results in the dictionary, the pixels of the vessel are dropped
+		DATA[current_dict_key_vessel] = colocalize(pairs, type_min, type_max, current_dict_key_vessel, blocks, RANDOMIZATIONS, SEED)
+	# Closing useless windows
+	blur_current_chan1.changes = False
+	blur_current_chan1.close()
+	isolate_vessels.changes = False
+	isolate_vessels.close()
 
 def run_colocalization():
 	'''
 	Runs the entire colocalization process for a batch of images.
-	Colocalization data is stored in the DATA dictionnary and in a text file.
+	Colocalization data is stored in the DATA dictionnary and in the result files (see save_results).
 	Additionally: returns a list containing the names of the individual vessels, and another containing all the images names (format = that of the t-cell channel).
 	'''
+	# Adding a list containing every vessel code name
+	total_vessels = []
+	if CONFIG is not None:
+		# Batch mode: every image of the input directory, channels given in the config file
+		format = setting(CONFIG, "format", "python")
+		vessel_channel = int(setting(CONFIG, "vessel_channel", 2))
+		coloc_channel = int(setting(CONFIG, "coloc_channel", 1))
+		# The results of each image are saved as soon as it is done (colocalization_analysis_progress.pkl, see Journal in batch_tools)
+		journal = Journal(CONFIG, "colocalization_analysis", DATA = DATA, total_vessels = total_vessels)
+		for whole in images(CONFIG, 0, journal):
+			channels = Channels(whole) # only the two channels used are made, the pixels are shared with whole when it is in memory (see Channels)
+			# The channel numbers start from 0, as in the "C=" of the split channel titles (same channels as the interactive mode)
+			for name, number in (("vessel_channel", vessel_channel), ("coloc_channel", coloc_channel)):
+				if number < 0 or number >= len(channels):
+					raise ValueError(name+" = "+str(number)+" but "+whole.getTitle()+" has "+str(len(channels))+" channels (C=0 to C="+str(len(channels)-1)+")")
+			analyze_image(channels[vessel_channel], channels[coloc_channel], whole.getTitle(), False, total_vessels)
+			channels.close()
+			print(whole.getTitle()+" done")
+		# Results of the other worker processes (only with workers)
+		gather(CONFIG, "DATA", DATA)
+		total_vessels = gather(CONFIG, "total_vessels", total_vessels)
+		save_results(format)
+		return total_vessels
 	# Number of time to run the colocalization (= number of images to analyze)
 	count = int(IJ.getNumber("How many images to analyze ?", 1))
 	control = bool(IJ.getString("Do you want to control the detection of vessel shapes? (True or False)", "False"))
@@ -207,9 +239,9 @@ def run_colocalization():
 		for images in panel_description:
 			for image_number in range(int(images[4:])):
 				image_list.append(images[0:3]+"_"+str(int(image_number)+1))
-	# Adding a list containing every vessel code name
-	total_vessels = []
 
+	# The results of each image are saved as soon as it is done (colocalization_analysis_progress.pkl in the current folder, see Journal in batch_tools)
+	journal = Journal(CONFIG, "colocalization_analysis", DATA = DATA, total_vessels = total_vessels)
 	# Colocalization of each images
 	for i in range(count):
 		# Construction of image titles
@@ -220,34 +252,36 @@ def run_colocalization():
 		# Channels to be analyzed
 		curr_vessel = current_image_name+" - C="+vessel_channel
 		current_chan1 = current_image_name+" - C="+coloc_channel
-		# Making a blurred version of the first channel
 		IJ.selectWindow(current_chan1)
 		active_chan1 = IJ.getImage()
-		blur_current_chan1 = blur_image(active_chan1)
-		# Selecting the vessels in the image
 		IJ.selectWindow(curr_vessel)
 		curr_vessel = IJ.getImage()
-		isolate_vessels = select_vessel(curr_vessel)
-		current_vessel_list = define_ROI(isolate_vessels, curr_vessel, control)
-		# Apply colocalization analysis to each vessels
-		for k in xrange(len(current_vessel_list)):
-			current_dict_key_vessel = current_dict_key + "_"+ str(k) # image code name
-			current_vessel_list[k].setTitle(current_dict_key_vessel)
-			total_vessels.append(current_vessel_list[k].getTitle())
-			coloc(current_vessel_list[k], blur_current_chan1) # performing colocalization analysis
-			retrieve_data(isolate_vessels, current_dict_key_vessel, k) # storing values in the dictionary
-		# Closing useless windows
-		blur_current_chan1.changes = False
-		blur_current_chan1.close()
+		analyze_image(curr_vessel, active_chan1, current_dict_key, control, total_vessels)
+		journal.save(current_image_name)
 		# Sort of a timer
 		print(str(count-i-1)+" images remaining")
+	save_results(format)
+	return total_vessels
+
+def save_results(format):
+	'''
+	Writes DATA in the result files, format = "python" (.npz file and JSON details file) or "excel" (csv file).
+	'''
 	# Printing data to check the results
 	print(DATA)
 	print("finished colocalization")
 	#Saving the data in the proper format
 	if format == "python":
-		file = open("result_file_colocalization.txt", "w") #change the name here
-		file.write(str(DATA))
+		# key -> [tM1, tM2], the format read by colocalization_stat
+		write_results("result_file_colocalization.npz", dict([(key, DATA[key].as_list()) for key in DATA.keys()]), "colocalization") #change the name here
+		# key -> every value of the analysis (thresholds, Pearson's R, Costes p-value, number of randomizations and seed)
+		# as JSON (json.load), the missing values (NaN) are written as null
+		details = {}
+		for key in DATA.keys():
+			values = DATA[key].as_dict()
+			details[key] = dict([(field, None if isinstance(value, float) and math.isnan(value) else value) for field, value in values.items()])
+		file = open("result_file_colocalization_details.json", "w") #change the name here
+		json.dump(details, file, indent = 1, sort_keys = True)
 		file.close()
 	else:
 		field_names = ['Name', 'tM1', 'tM2']
@@ -255,14 +289,13 @@ def run_colocalization():
 		for key in DATA.keys():
 			new_dict = {}
 			new_dict['Name'] = key
-			new_dict['tM1'] = DATA[key][0]
-			new_dict['tM2'] = DATA[key][1]
+			new_dict['tM1'] = DATA[key].tM1
+			new_dict['tM2'] = DATA[key].tM2
 			excel_data.append(new_dict)
 		csvfile = open('excel_results_colocalization.csv', 'w') #change the name here
 		writer = csv.DictWriter(csvfile, fieldnames = field_names)
 		writer.writeheader()
 		writer.writerows(excel_data)
 		csvfile.close()
-	return total_vessels
 
 run_colocalization()
\ No newline at end of file
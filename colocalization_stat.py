@@ -4,6 +4,7 @@
 #Python version : 3.8
 
 #This script assumes the existence of a file containing a dictionary where the keys are images names and the values are a list of relevant stats
+#(.npz file written by colocalization_analysis, or text file of an older run: result_store.py has to be next to this script)
 
 #Expected image name format : P1*1 where P1 is the name of the panel, 1 is the number of the image taken for that panel, and * represents any character exept a blank space
 
@@ -14,8 +15,9 @@
 ##Importations
 
 import os #handles paths and working directories
+import re #finds the panel names in the image names
 import pandas as pd #handles dataframe format (tables)
-import ast #special formatting
+from result_store import load_columns #reading result files (each file is read once, see load_results)
 import matplotlib.pyplot as plt #handles graphs
 import numpy as np #useful math
 
@@ -23,39 +25,12 @@ import numpy as np #useful math
 
 
 def data_handling(file_name, number):
-    #retrieve saved data
+    #retrieve saved data (only the image names and the two coefficients, already as numbers)
+    columns = load_columns(file_name, ['key', 'tM1', 'tM2'], 'colocalization')
 
-    file = open(file_name, "r")
-    data = file.readlines()
-    res = ast.literal_eval(data[0])
-    file.close()
-
-    #create and edit dataframe from dictionary
-    df = pd.DataFrame(res.items())
-    df.columns = ['Image', 'Values'] #column names
-    df['Values'] = df['Values'].apply(str)
-    df[['tM1', 'tM2']] = df['Values'].str.split(",", expand = True) #split the list to give the separate values
-
-    df['tM1'] = df['tM1'].apply(list) #easiest way to edit a string
-    df['tM2'] = df['tM2'].apply(list)
-
-    for i in range(len(df['Values'])): #keeps only the numbers
-                                        #there has to be a better way to do this
-        df['tM1'][i][1] =''
-        df['tM1'][i][0] =''
-        df['tM1'][i][-1] =''
-        df['tM2'][i][-1] =''
-        df['tM2'][i][1] =''
-        df['tM2'][i][0] =''
-        df['Image'][i] = str(number) + df['Image'][i]
-
-    df['tM1'] = df['tM1'].apply(''.join) #and back to a string
-    df['tM2'] = df['tM2'].apply(''.join)
-
-    df.drop('Values', inplace=True, axis=1)
-
-    df['tM1'] = df['tM1'].apply(float) #and finally we get proper number format
-    df['tM2'] = df['tM2'].apply(float)
+    #create dataframe from the columns
+    df = pd.DataFrame({'Image' : columns['key'], 'tM1' : columns['tM1'], 'tM2' : columns['tM2']})
+    df['Image'] = str(number) + df['Image'] #file number in front of the image names
 
     #get the panel names (yes this could have been automated)
 
@@ -63,29 +38,28 @@ def data_handling(file_name, number):
     if type == "y":
         list_image = list(df['Image'])
     else:
-        list_image = list(str.split(input("Name of panels again please (expected format is P1spaceP2) : "), " "))
-
-    #another dataframe to stock relevant statistic data
-    stats = pd.DataFrame()
-    whole = pd.DataFrame()
-
-    #fill the dataframe for each panel
-    for panel in list_image:
-        boolean = []
-        for i in range(len(df['Image'])):
-            if panel in df['Image'][i]:
-                boolean.append(True)
-            else :
-                boolean.append(False)
-        #temporary dataframe which contains the dataframe information about all the images of a certain panel
-        intermediate = df.iloc[boolean]
-        whole = pd.concat([whole, intermediate])
-        mean_M1 = intermediate['tM1'].mean() #calculates the mean
-        mean_M2 = intermediate['tM2'].mean()
-        stdev_M1 = intermediate['tM1'].var()**0.5 #calculates the standard deviation
-        stdev_M2 = intermediate['tM2'].var()**0.5
-        #add proper data to the stats dataframe
-        stats[panel] = [mean_M1, mean_M2, stdev_M1, stdev_M2]
+        list_image = input("Name of panels again please (expected format is P1spaceP2) : ").split() #no empty names with extra spaces (an empty name would take every image)
+
+    #panel of each image, found once: the first panel name found in the image name (the longest one if several start at the same place, so that P1 does not take the images of P10)
+    #/!\ an image whose name contains several panel names only goes to one panel,
+    #before it was counted in every panel whose name it contains
+    if type == "y":
+        df['Panel'] = df['Image']
+    else:
+        panels = sorted(set(list_image), key = len, reverse = True)
+        df['Panel'] = df['Image'].str.extract('(' + '|'.join([re.escape(panel) for panel in panels]) + ')', expand = False)
+
+    #mean and standard deviation of every panel at once
+    groups = df.groupby('Panel')[['tM1', 'tM2']]
+    means = groups.mean().reindex(list_image)
+    stdevs = groups.std().reindex(list_image) #same as var()**0.5
+
+    #dataframe to stock relevant statistic data, one column per panel
+    stats = pd.DataFrame([means['tM1'].values, means['tM2'].values, stdevs['tM1'].values, stdevs['tM2'].values], columns = list_image)
+    #images of all the panels, panel after panel
+    order = pd.Categorical(df['Panel'], categories = list(dict.fromkeys(list_image)))
+    kept = df[order.codes >= 0]
+    whole = kept.iloc[np.argsort(order.codes[order.codes >= 0], kind = 'stable')][['Image', 'tM1', 'tM2']]
 
     #adds row names
     stats.index = ['Mean tM1', 'Mean tM2', 'St-Dev tM1', 'St-Dev tM2']
@@ -0,0 +1,456 @@
+###Introduction
+
+# Hi!
+
+# Characteristics
+	# written for Jython (Python 2.7 in ImageJ 2.9.0)
+	# contact for help: solenedeutsch@gmail.com
+
+# Aim of the script
+	# Colocalization engine used by colocalization_analysis: Costes auto-threshold regression, Manders' tM1 and tM2, Pearson's R
+	# The calculations follow the ones of the Coloc 2 plugin, but are done directly on the pixel values (no window, no Log).
+	# The Costes thresholds were checked against a pixel by pixel transcription of the Coloc 2 regression (AutoThresholdRegression, SimpleStepper) on synthetic stacks
+	# This file is not meant to be run on its own: colocalization_analysis imports it.
+
+# Getting started
+	# copy this file into the Fiji.app/jars/Lib folder so that Fiji can find it, then restart Fiji
+
+# Code details for curious people
+	# the pixels of a vessel are summed up in a joint histogram {(value channel 1, value channel 2) : number of pixels}
+	# every calculation then goes through the distinct pairs of values only, which are far fewer than the pixels for 8-bit and 16-bit images
+	# the Costes randomizations are spread over all the cores given to ImageJ (Edit -> Options -> Memory & Threads), Jython threads run in parallel
+	# /!\ the shuffles are not the ones of Coloc 2 (other generator, blocks drawn in another way): the p-values are close to the ones of Coloc 2
+		# with enough randomizations, not identical. With the same seed, a run with more randomizations starts with the same shuffles (see costes_significance)
+
+# Have fun!
+
+###Imports
+
+from ij import Prefs
+from java.util import Random
+from java.util.concurrent import Callable, Executors
+import bisect
+import jarray
+import math
+import random
+
+###Reading the pixels
+
+def value_range(imp):
+	'''
+	Returns the smallest and largest value that the pixels of imp can take (depends on the bit depth).
+	'''
+	depth = imp.getBitDepth()
+	if depth == 8:
+		return 0.0, 255.0
+	if depth == 16:
+		return 0.0, 65535.0
+	return -3.4028234663852886e38, 3.4028234663852886e38
+
+def masked_pairs(imp1, imp2, mask, pairs = None):
+	'''
+	Reads the pixels of imp1 and imp2 (same size and number of slices) that are inside mask (pixels different from 0).
+	Returns the joint histogram of the two channels in the mask: {(value in imp1, value in imp2) : number of pixels}.
+	If pairs is given, the pixels are added to it.
+	'''
+	if pairs is None:
+		pairs = {}
+	stack1 = imp1.getStack()
+	stack2 = imp2.getStack()
+	stack_mask = mask.getStack()
+	for n in xrange(1, stack1.getSize()+1):
+		pixels1 = stack1.getProcessor(n).convertToFloatProcessor().getPixels()
+		pixels2 = stack2.getProcessor(n).convertToFloatProcessor().getPixels()
+		inside = stack_mask.getProcessor(n).convertToFloatProcessor().getPixels()
+		for i in xrange(len(inside)):
+			if inside[i] != 0:
+				key = (pixels1[i], pixels2[i])
+				pairs[key] = pairs.get(key, 0) + 1
+	return pairs
+
+###Coefficients
+
+def pearson(pairs, threshold1 = None, threshold2 = None):
+	'''
+	Pearson's R of the pixels in pairs (joint histogram, see masked_pairs).
+	If thresholds are given, only the pixels below them are used (value1 <= threshold1 or value2 <= threshold2, as in Coloc 2).
+	Returns NaN when R cannot be calculated (no pixel, or one channel constant).
+	'''
+	n = sum1 = sum2 = sum11 = sum22 = sum12 = 0.0
+	for (value1, value2), count in pairs.iteritems():
+		if threshold1 is not None and value1 > threshold1 and value2 > threshold2:
+			continue
+		n += count
+		sum1 += count*value1
+		sum2 += count*value2
+		sum11 += count*value1*value1
+		sum22 += count*value2*value2
+		sum12 += count*value1*value2
+	if n == 0:
+		return float("nan")
+	denominator = (sum11 - sum1*sum1/n)*(sum22 - sum2*sum2/n)
+	if denominator <= 0:
+		return float("nan")
+	return (sum12 - sum1*sum2/n)/math.sqrt(denominator)
+
+def manders(pairs, threshold1, threshold2):
+	'''
+	Thresholded Manders' coefficients of the pixels in pairs (joint histogram, see masked_pairs).
+	tM1 = intensity of channel 1 where both channels are above their threshold / intensity of channel 1 above its threshold
+	tM2 = same for channel 2
+	Returns (tM1, tM2).
+	'''
+	total1 = total2 = coloc1 = coloc2 = 0.0
+	for (value1, value2), count in pairs.iteritems():
+		above1 = value1 >= threshold1
+		above2 = value2 >= threshold2
+		if above1:
+			total1 += count*value1
+			if above2:
+				coloc1 += count*value1
+		if above2:
+			total2 += count*value2
+			if above1:
+				coloc2 += count*value2
+	tM1 = coloc1/total1 if total1 != 0 else float("nan")
+	tM2 = coloc2/total2 if total2 != 0 else float("nan")
+	return tM1, tM2
+
+###Costes threshold
+
+def java_round(value):
+	'''
+	Rounds like Java's Math.round (halves go up), used by Coloc 2 for the thresholds.
+	'''
+	return math.floor(value + 0.5)
+
+class BelowThresholds(object):
+	'''
+	Pearson's R of the pixels of a joint histogram (see masked_pairs) below two thresholds that move, same pixels as pearson(pairs, threshold1, threshold2).
+	The sums of the pixels above both thresholds are kept and only updated with the pairs of values that cross a threshold when it moves:
+	while the thresholds go down one way (as in costes_threshold), each pair is added at most once, whatever the number of steps.
+	Integer pixel values (8-bit and 16-bit images) are summed as Python integers, so the sums are exact however many times they are updated.
+	'''
+	def __init__(self, pairs):
+		integers = all([value1 % 1 == 0 and value2 % 1 == 0 for value1, value2 in pairs.iterkeys()])
+		convert = int if integers else float
+		entries = [(convert(value1), convert(value2), count) for (value1, value2), count in pairs.iteritems()]
+		self.total = self.sums(entries)
+		self.above = [0]*6 # n, sum1, sum2, sum11, sum22, sum12 of the pixels above both thresholds
+		self.by1 = sorted(entries)
+		self.values1 = [entry[0] for entry in self.by1]
+		self.by2 = sorted(entries, key = lambda entry: entry[1])
+		self.values2 = [entry[1] for entry in self.by2]
+		# Pairs by1[start1:] are above threshold 1, by2[start2:] above threshold 2 (no pixel is above at first)
+		self.start1 = self.start2 = len(entries)
+		self.threshold1 = self.threshold2 = float("inf")
+
+	def sums(self, entries, sign = 1, sums = None):
+		'''
+		Adds (sign = 1) or removes (sign = -1) entries (value1, value2, count) to the sums [n, sum1, sum2, sum11, sum22, sum12].
+		'''
+		if sums is None:
+			sums = [0]*6
+		for value1, value2, count in entries:
+			count *= sign
+			sums[0] += count
+			sums[1] += count*value1
+			sums[2] += count*value2
+			sums[3] += count*value1*value1
+			sums[4] += count*value2*value2
+			sums[5] += count*value1*value2
+		return sums
+
+	def move(self, threshold1, threshold2):
+		'''
+		Sets the thresholds: the pairs that cross threshold 1 are added to (or removed from) the pixels above both thresholds
+		if they are above threshold 2, then the same for threshold 2 with the new threshold 1.
+		'''
+		start1 = bisect.bisect_right(self.values1, threshold1)
+		if start1 < self.start1:
+			self.sums([entry for entry in self.by1[start1:self.start1] if entry[1] > self.threshold2], 1, self.above)
+		elif start1 > self.start1:
+			self.sums([entry for entry in self.by1[self.start1:start1] if entry[1] > self.threshold2], -1, self.above)
+		self.start1, self.threshold1 = start1, threshold1
+		start2 = bisect.bisect_right(self.values2, threshold2)
+		if start2 < self.start2:
+			self.sums([entry for entry in self.by2[start2:self.start2] if entry[0] > threshold1], 1, self.above)
+		elif start2 > self.start2:
+			self.sums([entry for entry in self.by2[self.start2:start2] if entry[0] > threshold1], -1, self.above)
+		self.start2, self.threshold2 = start2, threshold2
+
+	def pearson(self):
+		'''
+		Pearson's R of the pixels below the thresholds, NaN when it cannot be calculated (as pearson).
+		'''
+		n, sum1, sum2, sum11, sum22, sum12 = [total - above for total, above in zip(self.total, self.above)]
+		if n == 0:
+			return float("nan")
+		denominator = (n*sum11 - sum1*sum1)*(n*sum22 - sum2*sum2)
+		if denominator <= 0:
+			return float("nan")
+		return (n*sum12 - sum1*sum2)/math.sqrt(denominator)
+
+def costes_threshold(pairs, type_min, type_max, max_steps = 1000000):
+	'''
+	Costes auto-threshold regression, as threshold_regression=Costes in Coloc 2 (AutoThresholdRegression with its SimpleStepper).
+	The regression line channel2 = slope*channel1 + intercept is fitted (orthogonal regression). The threshold then walks down one unit at a time
+	from the largest value of channel 1 (channel 2 if the line is steep, |slope| >= 1), the other threshold following the line,
+	until Pearson's R of the pixels below the thresholds is negative or larger than at the step before, or the threshold goes below 1.
+	A NaN R does not stop the walk (Coloc 2 tests it with Double.NaN == value, which is always false).
+	Each step only updates the sums with the pixels that cross a threshold (see BelowThresholds), instead of going through all the pixels again.
+	type_min, type_max : range of the pixel values (see value_range)
+	Returns (threshold1, threshold2, slope, intercept) of the last step, or None if there is no regression line (fewer than 2 pixels, or no covariance).
+	'''
+	n = sum1 = sum2 = 0.0
+	max1 = max2 = None
+	for (value1, value2), count in pairs.iteritems():
+		n += count
+		sum1 += count*value1
+		sum2 += count*value2
+		if max1 is None or value1 > max1:
+			max1 = value1
+		if max2 is None or value2 > max2:
+			max2 = value2
+	if n < 2:
+		return None
+	mean1 = sum1/n
+	mean2 = sum2/n
+	# Same sums as Coloc 2: the covariance comes from the variance of channel1+channel2
+	var1 = var2 = combined = 0.0
+	for (value1, value2), count in pairs.iteritems():
+		var1 += count*(value1-mean1)*(value1-mean1)
+		var2 += count*(value2-mean2)*(value2-mean2)
+		combined += count*((value1+value2)-(mean1+mean2))*((value1+value2)-(mean1+mean2))
+	var1 /= n-1
+	var2 /= n-1
+	combined /= n-1.0
+	covariance = 0.5*(combined - (var1 + var2))
+	if covariance == 0:
+		return None
+	slope = (var2 - var1 + math.sqrt((var2-var1)*(var2-var1) + 4*covariance*covariance))/(2*covariance)
+	intercept = mean2 - slope*mean1
+	# The threshold walks on channel 1 if the line leans towards the channel 1 axis, on channel 2 otherwise
+	if -1 < slope < 1:
+		mapping = lambda t: (t, t*slope + intercept)
+		threshold = max1
+	else:
+		mapping = lambda t: ((t - intercept)/slope, t)
+		threshold = max2
+	below = BelowThresholds(pairs)
+	last_r = float("inf") # Double.MAX_VALUE in Coloc 2
+	steps = 0
+	finished = False
+	while not finished and steps <= max_steps:
+		value1, value2 = mapping(threshold)
+		threshold1 = min(max(java_round(value1), type_min), type_max)
+		threshold2 = min(max(java_round(value2), type_min), type_max)
+		below.move(threshold1, threshold2)
+		r = below.pearson()
+		threshold -= 1.0
+		steps += 1
+		finished = threshold < 1.0 or r < 0.0 or r > last_r
+		last_r = r
+	return threshold1, threshold2, slope, intercept
+
+###Costes significance test
+
+def masked_blocks(imp1, imp2, mask, psf = 3):
+	'''
+	Cuts the images in blocks of psf x psf pixels x psf slices (fewer slices if the stack is thinner), only whole blocks are kept.
+	Returns a dictionary used by costes_significance:
+		'count' : number of blocks, 'size' : number of pixels of a block (psf*psf*depth)
+		'channel1' : channel 1 values, block after block (size values per block, in a Java float array: 4 bytes per pixel)
+		'channel2' : same for channel 2
+		'inside' : (block, positions in the block of the mask pixels) for each block that contains mask pixels
+	'''
+	width = imp1.getWidth()
+	height = imp1.getHeight()
+	depth = min(psf, imp1.getStackSize())
+	nx = width//psf
+	ny = height//psf
+	nz = imp1.getStackSize()//depth
+	size = psf*psf*depth
+	n_blocks = nx*ny*nz
+	channel1 = jarray.zeros(n_blocks*size, 'f')
+	channel2 = jarray.zeros(n_blocks*size, 'f')
+	inside = {}
+	stack1 = imp1.getStack()
+	stack2 = imp2.getStack()
+	stack_mask = mask.getStack()
+	for z in xrange(nz*depth):
+		pixels1 = stack1.getProcessor(z+1).convertToFloatProcessor().getPixels()
+		pixels2 = stack2.getProcessor(z+1).convertToFloatProcessor().getPixels()
+		in_mask = stack_mask.getProcessor(z+1).convertToFloatProcessor().getPixels()
+		for y in xrange(ny*psf):
+			for x in xrange(nx*psf):
+				i = y*width + x
+				block = ((z//depth)*ny + y//psf)*nx + x//psf
+				position = ((z%depth)*psf + y%psf)*psf + x%psf
+				channel1[block*size + position] = pixels1[i]
+				channel2[block*size + position] = pixels2[i]
+				if in_mask[i] != 0:
+					inside.setdefault(block, []).append(position)
+	return {'count' : n_blocks, 'size' : size, 'channel1' : channel1, 'channel2' : channel2, 'inside' : sorted(inside.items())}
+
+def block_pearson(blocks, order):
+	'''
+	Pearson's R of the mask pixels when the channel 1 block order[b] is put at the place of block b (channel 2 and the mask do not move).
+	'''
+	channel1 = blocks['channel1']
+	channel2 = blocks['channel2']
+	size = blocks['size']
+	n = sum1 = sum2 = sum11 = sum22 = sum12 = 0.0
+	for b, positions in blocks['inside']:
+		start1 = order[b]*size
+		start2 = b*size
+		for position in positions:
+			value1 = channel1[start1 + position]
+			value2 = channel2[start2 + position]
+			sum1 += value1
+			sum2 += value2
+			sum11 += value1*value1
+			sum22 += value2*value2
+			sum12 += value1*value2
+		n += len(positions)
+	if n == 0:
+		return float("nan")
+	denominator = (sum11 - sum1*sum1/n)*(sum22 - sum2*sum2/n)
+	if denominator <= 0:
+		return float("nan")
+	return (sum12 - sum1*sum2/n)/math.sqrt(denominator)
+
+class RandomizationTask(Callable):
+	'''
+	Runs the randomizations first to last-1 of costes_significance (one task per thread).
+	Randomization i shuffles the blocks with its own generator (seeds[i]), so the results do not depend on the number of threads.
+	'''
+	def __init__(self, blocks, first, last, seeds):
+		self.blocks = blocks
+		self.first = first
+		self.last = last
+		self.seeds = seeds
+
+	def call(self):
+		values = []
+		for i in xrange(self.first, self.last):
+			order = range(self.blocks['count'])
+			random.Random(self.seeds[i]).shuffle(order)
+			values.append(block_pearson(self.blocks, order))
+		return values
+
+def costes_significance(blocks, randomizations, seed = 0, threads = None):
+	'''
+	Costes significance test: Pearson's R of the vessel compared to the one obtained after shuffling the blocks of channel 1 (see masked_blocks).
+	randomizations : number of shuffles, shared between threads (default: number of threads set in ImageJ)
+	seed : the same seed gives the same result. The seeds of the shuffles are drawn one after the other from java.util.Random(seed),
+		so the first shuffles are the same whatever the number of randomizations (more randomizations only add shuffles)
+	Returns (p_value, r, mean_random_r, sd_random_r), with p_value as defined by Coloc 2 (probability that a shuffled R is below the observed one,
+	from a normal law fitted on the shuffled values: close to 1 = significant colocalization).
+	'''
+	r = block_pearson(blocks, range(blocks['count']))
+	if randomizations < 1 or r != r:
+		return float("nan"), r, float("nan"), float("nan")
+	if threads is None:
+		threads = Prefs.getThreads()
+	threads = max(1, min(threads, randomizations))
+	generator = Random(seed)
+	seeds = [generator.nextLong() for i in xrange(randomizations)]
+	tasks = []
+	for t in xrange(threads):
+		tasks.append(RandomizationTask(blocks, t*randomizations//threads, (t+1)*randomizations//threads, seeds))
+	pool = Executors.newFixedThreadPool(threads)
+	try:
+		shuffled = []
+		for future in pool.invokeAll(tasks):
+			shuffled += [value for value in future.get() if value == value]
+	finally:
+		pool.shutdown()
+	if len(shuffled) < 2:
+		return float("nan"), r, float("nan"), float("nan")
+	mean = sum(shuffled)/len(shuffled)
+	sd = math.sqrt(sum([(value-mean)*(value-mean) for value in shuffled])/(len(shuffled)-1))
+	if sd == 0:
+		p_value = 1.0 if r > mean else 0.0
+	else:
+		p_value = 0.5*(1 + math.erf((r-mean)/(sd*math.sqrt(2))))
+	return p_value, r, mean, sd
+
+###Results
+
+class ColocResult(object):
+	'''
+	Result of the colocalization analysis of one vessel.
+	key : code name of the vessel
+	tM1, tM2 : thresholded Manders' coefficients
+	threshold1, threshold2 : Costes thresholds of channel 1 and channel 2
+	slope, intercept : regression line channel2 = slope*channel1 + intercept
+	pearson : Pearson's R (no threshold), pearson_below : Pearson's R below the thresholds
+	p_value, randomizations, seed : Costes significance test (see costes_significance), NaN, 0 and None if it was not run
+	Missing values (e.g. vessel without any pixel in the mask) are NaN.
+	'''
+	fields = ('key', 'tM1', 'tM2', 'threshold1', 'threshold2', 'slope', 'intercept', 'pearson', 'pearson_below', 'p_value', 'randomizations', 'seed')
+
+	def __init__(self, key, tM1 = float("nan"), tM2 = float("nan"), threshold1 = float("nan"), threshold2 = float("nan"), slope = float("nan"),
+		intercept = float("nan"), pearson = float("nan"), pearson_below = float("nan"), p_value = float("nan"), randomizations = 0, seed = None):
+		self.key = key
+		self.tM1 = tM1
+		self.tM2 = tM2
+		self.threshold1 = threshold1
+		self.threshold2 = threshold2
+		self.slope = slope
+		self.intercept = intercept
+		self.pearson = pearson
+		self.pearson_below = pearson_below
+		self.p_value = p_value
+		self.randomizations = randomizations
+		self.seed = seed
+
+	def as_list(self):
+		'''
+		[tM1, tM2] as strings with 3 decimals, the format of the result files read by colocalization_stat.
+		'''
+		return ["%.3f" % self.tM1, "%.3f" % self.tM2]
+
+	def as_dict(self):
+		'''
+		Every field of the result, {field name : value}.
+		'''
+		return dict([(field, getattr(self, field)) for field in self.fields])
+
+	def __repr__(self):
+		return "ColocResult(%s, tM1=%.3f, tM2=%.3f, p=%.3f)" % (self.key, self.tM1, self.tM2, self.p_value)
+
+###Batch
+
+def colocalize(pairs, type_min, type_max, key = None, blocks = None, randomizations = 0, seed = 0):
+	'''
+	Full colocalization analysis of one vessel (pairs = joint histogram, see masked_pairs).
+	blocks : blocks of the vessel (see masked_blocks), if given the Costes significance test is run with randomizations shuffles
+	Returns a ColocResult.
+	'''
+	regression = costes_threshold(pairs, type_min, type_max)
+	if regression is None:
+		result = ColocResult(key)
+	else:
+		threshold1, threshold2, slope, intercept = regression
+		tM1, tM2 = manders(pairs, threshold1, threshold2)
+		result = ColocResult(key, tM1, tM2, threshold1, threshold2, slope, intercept, pearson(pairs), pearson(pairs, threshold1, threshold2))
+	if blocks is not None:
+		result.p_value = costes_significance(blocks, randomizations, seed)[0]
+		result.randomizations = randomizations
+		result.seed = seed
+	return result
+
+def colocalize_all(samples, type_min, type_max, blocks = None, randomizations = 0, seed = 0):
+	'''
+	Runs colocalize on several vessels.
+	samples : dictionary {vessel key : joint histogram (see masked_pairs)}
+	blocks : dictionary {vessel key : blocks (see masked_blocks)}, if given the Costes significance test is run with randomizations shuffles
+	Returns a dictionary {vessel key : ColocResult}.
+	To keep the memory low, rather call colocalize on each vessel as soon as its blocks are made, so that they can be dropped.
+	'''
+	results = {}
+	for key in samples.keys():
+		results[key] = colocalize(samples[key], type_min, type_max, key, blocks[key] if blocks is not None else None, randomizations, seed)
+	return results
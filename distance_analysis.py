@@ -12,6 +12,8 @@
 
 # Getting started
     # Check that you're working in the directory where your text files are (os.getcwd() in the shell)
+    # The result files can be the .npz files of distance_measurement or the text files of older runs (result_store.py has to be next to this script)
+        # each file is read once per session, plotting again is fast (the text files are converted once and kept in a .result_cache folder next to them)
     # If the directory is wrong use os.chdir("my_right_directory") in the shell
     # This scripts calculate statistical significance but IT DOES NOT PLOT IT AUTOMATICALLY
         # According to the results of the satistical tests, change what you want to show on the plot in the indicated lines
@@ -25,7 +27,7 @@ import matplotlib.pyplot as plt #plotting graphs
 import numpy as np #useful maths
 import random as rd #generating random numbers
 import os #handle working directories
-import ast #data formatting
+from result_store import load_dict #reading result files (each file is read once, see load_results)
 import tkinter as tk #interactive windows
 import tkinter.filedialog as fd #retrieving files
 import scikit_posthocs as sp #stats
@@ -58,13 +60,10 @@ def select_files():
 
 def collect_data_from_file(file_title):
     '''
-    Opens a text file and retrieves the data as a dictionary.
+    Opens a result file (.npz or text file) and retrieves the data as a dictionary.
+    The file is only read the first time, the next plots take it from the cache (see load_results in result_store).
     '''
-    file = open(file_title, 'r')
-    content = file.readlines()
-    file.close()
-    data = ast.literal_eval(content[0])
-    return data
+    return load_dict(file_title, 'distance')
 
 def merge_dict_tot(ref, list_dict):
     '''
@@ -106,15 +105,22 @@ def merge_dict_info(vessel_info, distance_info):
                 whole[vessel] += distance_info[vessel]
     return whole
 
-def remove_doubles(dico, position):
+def remove_doubles(dico, position = None, seed = None):
     '''
-    Loops through every vessel of every image in the dico dictionnary.
+    Goes through every image of the dico dictionnary.
     key : vessel code name
     value : distance of the T-cell to that vessel
     If a T-cell appears more than once in an image, keeps only the vessel that is closest.
     Like this, every T-cell is only counted once in the analysis.
     Returns a dictionary, same key and values, with only the relevant information.
+    position : length of the common part of the names of the vessels from the same image
+        (None: everything before the last "_" of each name, the image titles can have any length)
+        /!\ before, the part before the last "_" of the first name was cut at the same length in every name, and an image took every name containing it:
+        the vessels of image titles of other lengths, or with "_" in them, can now be grouped differently
+        (one group per tumor number_image title, the names being written by distance_measurement as tumor number_image title_vessel number)
+    seed : seed of the random choice of a vessel for the T cells "too far" from every vessel (None: the random module as it is)
     '''
+    chooser = rd if seed is None else rd.Random(seed)
     #Creating new dictionary
     new = {}
     #Control: how many T cell are we counting before correction?
@@ -122,60 +128,30 @@ def remove_doubles(dico, position):
     for value in list(dico.values()):
             count+=len(value)
     print("Before correction : "+ str(count))
-    #Looping on every vessel
-    images_done = []
+    #Grouping the vessels of each image (which contains the same detected T cells), in one pass over the names
+    images = {}
     for vessel in dico.keys():
-        #Getting the common part of the name of the vessels from the same image
-        current_image = vessel[:position]
-        #Analyze grouped for every image (which contains the same detected T cells)
-        if current_image not in images_done:
-            images_done.append(current_image)
-            n_tcells = len(dico[vessel])
-            #Taking into account every vessel from that image
-            to_analyze = [key for key in dico.keys() if current_image in key]
-            #Applying correction to every T cell
-            for t_cell in reversed(range(n_tcells)):
-                previous = ""
-                positions = []
-                too_far = []
-                for vessel in to_analyze:
-                    #First time encountering a close vessel
-                    if dico[vessel][t_cell] != "too far" and previous == "":
-                        previous = dico[vessel][t_cell]
-                        positions.append((vessel, dico[vessel][t_cell]))
-                    #Encountering other close vessels
-                    elif dico[vessel][t_cell] != "too far" and previous != "":
-                        positions.append((vessel, dico[vessel][t_cell]))
-                    #Encountering a vessel far away
-                    else:
-                        too_far.append(vessel) #Name of the vessel
-                #If there are only "too far" vessels for that T cell
+        image = vessel[:position] if position is not None else vessel[:vessel.rindex("_")]
+        images.setdefault(image, []).append(vessel)
+    for to_analyze in images.values():
+        n_tcells = len(dico[to_analyze[0]])
+        #Distance of every T cell (columns) to every vessel (rows), "too far" as infinity
+        distances = np.array([[np.inf if value == "too far" else value for value in dico[vessel][:n_tcells]] for vessel in to_analyze], dtype = float).reshape(len(to_analyze), n_tcells)
+        #Closest vessel of each T cell (the first one if several are as close)
+        closest = distances.argmin(axis = 0)
+        too_far = np.isinf(distances.min(axis = 0))
+        #Same order as the T cells were always handled (last one first), so that the random choices and the lists are the same
+        for t_cell in reversed(range(n_tcells)):
+            if too_far[t_cell]:
                 # Randomly assigning that T cell to only one vessel
-                if previous == "":
-                    # Random assignment
-                    choosen = rd.choice(too_far)
-                    positions = [(choosen, "too far")]
-                # If there are several vessels close to that T cell
+                final_vessel = chooser.choice(to_analyze)
+                final_value = "too far"
+            else:
                 # Assigning that T cell to the closest vessel
-                if len(positions) > 1:
-                    min_dist = positions[0][1]
-                    min_vessel = positions[0][0]
-                    for i in range(1, len(positions)):
-                        if positions[i][1] < min_dist:
-                            min_dist = positions[i][1]
-                            min_vessel = positions[i][0]
-                    final_vessel = min_vessel
-                    final_value = min_dist
-                else:
-                    final_vessel = positions[0][0]
-                    final_value = positions[0][1]
-                #New dict with the corrected positions
-                if final_vessel in new.keys():
-                    #Case where the key already exists
-                    new[final_vessel].append(final_value)
-                else:
-                    #Case where the key doesn't already exist
-                    new[final_vessel] = [final_value]
+                final_vessel = to_analyze[closest[t_cell]]
+                final_value = dico[final_vessel][t_cell]
+            #New dict with the corrected positions
+            new.setdefault(final_vessel, []).append(final_value)
     #Control: how many T cells are we counting after correction?
     count = 0
     for value in list(new.values()):
@@ -351,8 +327,7 @@ def histo_average_distance():
         raw_data = collect_data_from_file(file)
         vessel_info, vessel_distance = split_dict_by_info(raw_data)
         #Correct T cell count
-        position = [pos for pos, char in enumerate(list(vessel_info.keys())[0]) if char == "_"][-1]
-        processed_data = remove_doubles(vessel_distance, position)
+        processed_data = remove_doubles(vessel_distance)
         #Get the average distance to each vessel
         graph_data = better_prep_data(processed_data)
         #Get proper data format for plotting
@@ -458,8 +433,7 @@ def histo_distribution():
         raw_data = collect_data_from_file(file)
         #T cell count correction
         vessel_info, vessel_distance = split_dict_by_info(raw_data)
-        position = [pos for pos, char in enumerate(list(vessel_info.keys())[0]) if char == "_"][-1]
-        processed_data = remove_doubles(vessel_distance, position)
+        processed_data = remove_doubles(vessel_distance)
         final_data = merge_dict_info(vessel_info, processed_data)
         #Split data into the two vessel categories
         for vessel in final_data.keys():
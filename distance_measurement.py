@@ -12,7 +12,7 @@
 # Getting started
 	# open the images you want to analyze with the "Split channel" box unchecked
 		# the results of one run will all be put in the same text file
-	# the results are written in a text file, in your choosen directory
+	# the results are written in a .npz file (columns, see result_store.py), in your choosen directory
 	# the results are formatted to be compatible with the distance_analysis script to analyze them
 	# a preliminary run with fewer images is required to make sure that all the thresholdings and detections are working correctly
 	# this script selects the active image, analyzes it, and closes it. Make sure no useless image is opened in front.
@@ -20,6 +20,16 @@
 	# you can change the name of the file at the bottom of the script (Saving results part)
 	# This script currently asks user to check that the T cells detected are indeed T cells (and same for the vessels).
 		# If you wnat to run the script without having to check, comment the lines where you see a WaitForUserDialog (2 of them)
+	# image_tools.py, threshold_tools.py, binary_masks.py, result_store.py and batch_tools.py have to be copied in the Fiji.app/jars/Lib folder (the script imports functions from them)
+	# to save memory on big stacks, open the images as virtual stacks (File -> Import -> TIFF Virtual Stack...), the planes are then read from the disk when needed
+	# to run the script unattended on a whole directory, use a config file with a [distance_measurement] section (see batch_tools.py and batch_config_example.ini)
+		# keys: input_dir, output_dir, vessel_channel, marker1_channel, tcell_channel, tumor_number, distance_mode, cellpose_model (and workers to analyze several images at the same time, resume = true to finish a run that stopped, see batch_tools.py)
+		# in batch mode, the T cells and vessels are not checked by hand
+	# the distances are computed with a distance map of each vessel (distance_mode = "transform" in the Initializing part)
+		# each T cell gets the 10µm layer that contains most of its pixels, exactly like the previous Roi layer method
+		# the exact distances (minimum and mean, in µm) of every T cell are written in a second file ending with _um.txt
+	# the thresholds used for the vessels are written in a file ending with _thresholds.txt
+		# set distance_mode = "layers" to go back to the Roi layer method (much slower on images with a lot of T cells)
 	
 # Have fun!
 
@@ -27,55 +37,42 @@
 
 from ij import IJ, Prefs
 from ij.plugin.frame import RoiManager
-from ij.plugin import ChannelSplitter, ZProjector, RoiEnlarger
+from ij.plugin import ZProjector, RoiEnlarger
+from ij.plugin.filter import EDM
 from ij.gui import WaitForUserDialog
 from ij.measure import ResultsTable
+from image_tools import labels_from_rois, label_regions, add_rois, measure_labels, crop_vessels, uncrop, project_channel, Channels
+from binary_masks import morphology, analyze_particles
+from threshold_tools import set_auto_threshold, threshold_text, forget
+from result_store import write_results
+from batch_tools import load_config, setting, get_number, get_string, images, show_image, manual_check, roi_manager, gather, Journal
+import math
+import os
 
 ###Preliminary functions
 
 def define_ROI(vessels, OriImage, show = False):
 	'''
-	Takes the z-projection and returns a list of z-stacks, each containing a single vessel.
-	Both parameters are images, returns a list of images.
+	Takes the z-projection and gives the vessels one at a time, each as an image cropped around a single vessel.
+	Both parameters are images. The vessel images are only made when the loop gets to them (see crop_vessels in image_tools).
 	'''
 	# Isolate individual vessels
-	rm = RoiManager.getRoiManager()
-	n_roi = rm.getCount() # number of ROIs (=number of vessels detected)
-	list_vessels = [] 
 	ra = rm.getRoisAsArray()
-	# Apply ROI and clear outside to keep only the vessel part
-	for i in range(n_roi):
-		single_vessel = OriImage.duplicate()
-		single_vessel.setRoi(ra[i])
-		IJ.setBackgroundColor(0,0,0)
-		IJ.run(single_vessel, "Clear Outside", "stack")
-		IJ.run(single_vessel, "Select None", "stack")
-		list_vessels.append(single_vessel)
-		if show:
-			single_vessel.show()
-			check = WaitForUserDialog("Time to look at the data", "Check vessel.")
-			check.show()
-			single_vessel.changes = False
-			single_vessel.close()
-	return list_vessels
+	# Crop around each ROI and clear outside to keep only the vessel part
+	return crop_vessels(OriImage, ra, show)
 
-def retrieve_data(isolate_vessels, marker_image, image_name):
+def retrieve_data(vessel_labels, whole_image, marker_channel, n_vessels):
 	'''
-	Retrieves information about the size of the vessel, and the intensity of the marker in marker_image in that vessel.
+	Retrieves information about the size of every vessel, and the intensity of the marker (channel marker_channel of whole_image) in each vessel.
+	vessel_labels : label image of the vessels (see analyze_particles in binary_masks)
+	Returns a list with one dictionary ('area', 'mean') per vessel.
 	'''
-	ra = rm.getRoisAsArray()
-	# Isolate the shape of the vessel in the image containing the marker staining
-	list_intensities = define_ROI(isolate_vessels, marker_image)
-	image_to_analyze = list_intensities[int(image_name[-1])]
-	# Z-projection
-	image_to_analyze = ZProjector.run(image_to_analyze,"max")
-	# Setting the ROI around the vessel
-	image_to_analyze.setRoi(ra[int(image_name[-1])])
-	# If it has't already been done, retrieves the size of the vessel
-	if len(DATA[image_name]) == 0:
-		DATA[image_name].append(image_to_analyze.getStatistics().area)
-	# Retrieves the intensity of the staining inside the vessel
-	DATA[image_name].append(image_to_analyze.getStatistics().mean)
+	# Z-projection of the marker channel, done once for all the vessels
+	image_to_analyze = project_channel(whole_image, marker_channel, "max")
+	# All the vessels are measured in one scan of the projection
+	stats = measure_labels(vessel_labels, image_to_analyze, n_vessels)
+	image_to_analyze.close()
+	return stats
 
 def finding_Tcells(t_chan):
 	'''
@@ -88,46 +85,24 @@ def finding_Tcells(t_chan):
 	Prefs.blackBackground = True
 	IJ.run(t_cells, "Convert to Mask", "method=Moments background=Dark calculate black")
 	t_cells = ZProjector.run(t_cells,"sum")
-	t_cells.show()
-	rm = RoiManager.getRoiManager()
+	show_image(CONFIG, t_cells)
 	not_empty = len(rm.getRoisAsArray())
 	if not_empty != 0:
 		rm.runCommand(t_cells, "Delete")
 	# Running cellpose for T cell detection
-	IJ.run("Cellpose Advanced (custom model)", "diameter=0 cellproba_threshold=-1.0 flow_threshold=0.6 anisotropy=1.0 diam_threshold=12.0 model_path=C:\Users\solde212\.cellpose\models\Tcells_GL261 model=Tcells_GL261 nuclei_channel=0 cyto_channel=1 dimensionmode=2D stitch_threshold=0 omni=false cluster=false additional_flags=")
+	IJ.run("Cellpose Advanced (custom model)", "diameter=0 cellproba_threshold=-1.0 flow_threshold=0.6 anisotropy=1.0 diam_threshold=12.0 model_path="+cellpose_model+" model=Tcells_GL261 nuclei_channel=0 cyto_channel=1 dimensionmode=2D stitch_threshold=0 omni=false cluster=false additional_flags=")
 	# Retrieving proper ROIs from cellpose
 	# cellpose outputs a mask that contains found areas, each filled with a different pixel intensity value (starts at 1, step=1)
 	mask = IJ.getImage()
-	IJ.run(mask, "Select All", "")
-	roi = mask.getRoi()
-	rm.addRoi(roi)
-	table = ResultsTable.getResultsTable()
-	IJ.run("Clear Results", "")
-	rm.runCommand(mask,"Measure")
-	max_int = table.getValue("Max", 0)
-	total_roi = range(1, int(max_int)+1)
-	rm.setSelectedIndexes([0])
-	rm.runCommand(mask, "Delete")
-	# Isolating T-cells
-	for value in total_roi:
-		temp = mask.duplicate()
-		IJ.setThreshold(temp, value, value)
-		IJ.run(temp, "Convert to Mask", "")
-		IJ.run(temp, "Create Selection", "")
-		roi = temp.getRoi()
-		rm.addRoi(roi)
-		temp.close()
+	# Isolating T-cells: the mask is read once, each Roi is then built inside the bounding box of its T cell
+	regions = label_regions(mask.getProcessor())
+	# Adding the Rois, named T_0, T_1... for clarity (useful for debugging)
+	add_rois(rm, [region['roi'] for region in regions], "T_")
 	# Clearing useless windows for the next image
-	IJ.selectWindow("Results")
-	IJ.run("Close")
+	mask.changes = False
 	mask.close()
-	# Adding Roi names for clarity (useful for debugging, can be commented out otherwise)
-	for i in xrange(len(rm.getRoisAsArray())):
-		rm.select(i)
-		rm.runCommand("Rename", "T_"+str(i))
 	# Manually checking that the ROIs are actuall T-cells
-	check = WaitForUserDialog("Time to look at the data", "Do those look like T cells ? \nIf not, modify the ROIs then click OK.")
-	check.show()
+	manual_check(CONFIG, "Time to look at the data", "Do those look like T cells ? \nIf not, modify the ROIs then click OK.")
 	t_cells.close()
 	return len(rm.getRoisAsArray())
 
@@ -137,11 +112,11 @@ def distance_to_vessels(vessel, vessel_key):
 	vessel_stack : image containing the vessel
 	vessel_key : code name of the vessel image
 	'''
-	# Analysis is performed on a z projection
-	rm = RoiManager.getRoiManager()
+	# Analysis is performed on a z projection, the layers need the whole image (T cells can be anywhere)
+	vessel = uncrop(vessel)
 	nb_tcells = len(rm.getRoisAsArray())
 	# Selecting the vessel inner area
-	IJ.setAutoThreshold(vessel, "Li dark")
+	THRESHOLDS[vessel_key] = threshold_text(set_auto_threshold(vessel, "Li"))
 	Prefs.blackBackground = True
 	IJ.run(vessel, "Convert to Mask", "")
 	IJ.run(vessel, "Create Selection", "")
@@ -217,8 +192,7 @@ def distance_to_vessels(vessel, vessel_key):
 		if DATA[vessel_key][value] == 6:
 			DATA[vessel_key][value] = "too far"
 	# Manually checking if the ROI is actually a vessel
-	myWait = WaitForUserDialog("Time to look at the data", "Does this region look like a vessel ? \nIf not, write it down then click OK.\nThe data concerning the fake vessel can then be removed by hand")
-	myWait.show()
+	manual_check(CONFIG, "Time to look at the data", "Does this region look like a vessel ? \nIf not, write it down then click OK.\nThe data concerning the fake vessel can then be removed by hand")
 	# Close useless windows and ROIs
 	ra = rm.getRoisAsArray()
 	for i in reversed(range(n_tcells, len(ra))):
@@ -226,84 +200,176 @@ def distance_to_vessels(vessel, vessel_key):
 	 	rm.runCommand(whole, "Delete")
 	vessel.changes = False
 	vessel.close()
+
+def tcell_pixels(labels, n_tcells):
+	'''
+	Reads the T-cell label image once and returns, for each T cell, the list of its pixel indexes (index = y*width + x).
+	labels : 16-bit label image (ImageProcessor) where the pixels of T cell i have the value i+1
+	'''
+	cells = [[] for _ in xrange(n_tcells)]
+	pixels = labels.getPixels()
+	for i in xrange(len(pixels)):
+		value = pixels[i] & 0xffff
+		if value != 0:
+			cells[value-1].append(i)
+	return cells
+
+def distance_to_vessels_edm(vessel, vessel_key, cells):
+	'''
+	Performs the distance analysis with a distance map of the vessel instead of Roi layers.
+	vessel : image containing the vessel
+	vessel_key : code name of the vessel image
+	cells : pixel indexes of each T cell (see tcell_pixels)
+	Each T cell gets the layer that contains most of its pixels (0 = inside the vessel, 1 to 5 = layers of layer_width pixels, "too far" otherwise).
+	The minimum and mean distance of each T cell (in µm) are stored in DISTANCES.
+	'''
+	# The distance map needs the whole image (T cells can be anywhere)
+	vessel = uncrop(vessel)
+	# Selecting the vessel inner area
+	THRESHOLDS[vessel_key] = threshold_text(set_auto_threshold(vessel, "Li"))
+	Prefs.blackBackground = True
+	IJ.run(vessel, "Convert to Mask", "")
+	# Distance (in pixels) from every pixel to the closest vessel pixel, 0 inside the vessel (vessel pixels = 255 = background of the map)
+	distances = EDM().makeFloatEDM(vessel.getProcessor(), -1, False).getPixels()
+	pixel_size = vessel.getCalibration().pixelWidth
+	DISTANCES[vessel_key] = []
+	for cell in cells:
+		# A T cell without any pixel (empty Roi) is ignored, like in the layer method
+		if len(cell) == 0:
+			continue
+		# Counting the T-cell pixels in each layer (the last one is everything further than the largest layer)
+		layers = [0]*(n_layers+2)
+		closest = distances[cell[0]]
+		total = 0.0
+		for i in cell:
+			d = distances[i]
+			layers[min(int(math.ceil(d/layer_width)), n_layers+1)] += 1
+			total += d
+			if d < closest:
+				closest = d
+		# Keeping the layer that contains most of the T cell (the furthest one if two layers are equal, like the layer method)
+		layer = 0
+		for k in xrange(len(layers)):
+			if layers[k] >= layers[layer]:
+				layer = k
+		if layer == n_layers+1:
+			DATA[vessel_key].append("too far")
+		else:
+			DATA[vessel_key].append(layer)
+		DISTANCES[vessel_key].append([closest*pixel_size, total/len(cell)*pixel_size])
+	# Manually checking if the ROI is actually a vessel
+	manual_check(CONFIG, "Time to look at the data", "Does this region look like a vessel ? \nIf not, write it down then click OK.\nThe data concerning the fake vessel can then be removed by hand")
+	vessel.changes = False
+	vessel.close()
 	
 ###Initializing
 
-rm = RoiManager.getRoiManager()
+CONFIG = load_config("distance_measurement") # None unless a config file is given (batch mode)
+
+rm = roi_manager(CONFIG)
 
 DATA = {}
+DISTANCES = {} # exact T-cell distances (µm), only filled with distance_mode = "transform"
+THRESHOLDS = {} # "vessels_"+image title -> threshold of the vessel detection, vessel key -> threshold of the vessel inner area ("lower/upper")
+
+distance_mode = "transform"
+#distance_mode = "layers" #Decomment to use the Roi layer method
+distance_mode = setting(CONFIG, "distance_mode", distance_mode)
+layer_width = 55 # width of each distance layer in pixels (=10µm)
+n_layers = 5
 
-count = int(IJ.getNumber("How many images to analyze ?", 1))
+cellpose_model = setting(CONFIG, "cellpose_model", "C:\Users\solde212\.cellpose\models\Tcells_GL261")
+
+count = int(get_number(CONFIG, "count", "How many images to analyze ?", 1))
 
 Dir = os.getcwd()
-intermediate = IJ.getString("Write directory for the result file (leave empty if current directory is wanted) :", "E:\\PROJECTS\Solene")
+intermediate = get_string(CONFIG, "output_dir", "Write directory for the result file (leave empty if current directory is wanted) :", "E:\\PROJECTS\Solene")
 if intermediate == "":
 	Wdir = Dir
 else :
 	Wdir = intermediate
 
-vessel_channel_number = int(IJ.getString("Enter number of channel for vessel staining", "2"))
-marker1_channel_number = int(IJ.getString("Enter the number of the channel you are interested in measuring", "1"))
-tcell_channel_number = int(IJ.getString("Enter the number of the T-cell channel", "0"))
+vessel_channel_number = int(get_string(CONFIG, "vessel_channel", "Enter number of channel for vessel staining", "2"))
+marker1_channel_number = int(get_string(CONFIG, "marker1_channel", "Enter the number of the channel you are interested in measuring", "1"))
+tcell_channel_number = int(get_string(CONFIG, "tcell_channel", "Enter the number of the T-cell channel", "0"))
+
+tumor_number = get_string(CONFIG, "tumor_number", "Enter tumor number (for file naming)", "")
 
-tumor_number = IJ.getString("Enter tumor number (for file naming)", "")
+# The results of each image are saved as soon as it is done (distance_measurement_progress.pkl, see Journal in batch_tools)
+journal = Journal(CONFIG, "distance_measurement", Wdir, DATA = DATA, DISTANCES = DISTANCES, THRESHOLDS = THRESHOLDS)
 	
 ### Analysis
 
-for _ in xrange(count):
+for whole in images(CONFIG, count, journal):
 	# Initializing for the current image
 	
 	intensity = {}
 	
-	whole = IJ.getImage()
-	
-	channels = ChannelSplitter.split(whole)
+	channels = Channels(whole) # only the T-cell channel is made, the pixels are shared with whole when it is in memory (see Channels)
 	
 	tcell_channel = channels[tcell_channel_number]
-	vwf_channel = channels[marker1_channel_number]
-	vessel_channel = channels[vessel_channel_number]
 	
-	# Choosing the vessels
+	# Choosing the vessels (the channel is projected straight from the image, see project_channel in image_tools)
 	
-	vessels = ZProjector.run(vessel_channel,"max")
+	vessels = project_channel(whole, vessel_channel_number, "max")
 	ori_vessel = vessels.duplicate()
-	IJ.setAutoThreshold(vessels, "Moments dark")
+	THRESHOLDS["vessels_"+whole.getTitle()] = threshold_text(set_auto_threshold(vessels, "Moments"))
 	Prefs.blackBackground = True
 	IJ.run(vessels, "Convert to Mask", "")
-	IJ.run(vessels, "Despeckle", "")
-	IJ.run(vessels, "Despeckle", "")
-	IJ.run(vessels, "Despeckle", "")
-	IJ.run(vessels, "Options...", "iterations=1 count=1 black do=Dilate")
-	IJ.run(vessels, "Options...", "iterations=7 count=1 black do=Close")
-	IJ.run(vessels, "Analyze Particles...", "size=30-Infinity show=Nothing clear add")
+	# 3 x Despeckle, Dilate and Close x7 in one go (see binary_masks)
+	morphology(vessels, [("despeckle", 3), ("dilate", 1), ("close", 7)], black = True)
+	# The vessels are labeled while they are found: the ROIs go to the Roi Manager and the label image is kept for the measurements (see binary_masks)
+	vessel_labels = analyze_particles(vessels, rm, 30)[0]
 	show = False
 	#show = True #Decomment to follow vessel detection
-	list_vessels = define_ROI(vessels, ori_vessel, show)
+	show = show and CONFIG is None # no manual check in batch mode
+	vessel_rois = rm.getRoisAsArray() # kept for the distance part (finding_Tcells replaces the vessel ROIs by the T cells)
+	#Get the size and intensity of the staining for all the vessels
+	stats = retrieve_data(vessel_labels, whole, marker1_channel_number, len(vessel_rois))
 	#Computing data for each vessel in the image
-	for k in xrange(len(list_vessels)):
-		vessel = list_vessels[k]
-		v_title = tumor_number+"_"+vessel.getTitle()[-1]+"_"+str(k)
-		DATA[v_title] = []
-		#Get the size and intensity of the staining
-		retrieve_data(vessel, vwf_channel, v_title)
+	#The vessels are named after the whole title of the image, so that two images never give the same names (all the .tif titles end with "f")
+	image_code = whole.getTitle()
+	for k, vessel in enumerate(define_ROI(vessels, ori_vessel, show)):
+		v_title = tumor_number+"_"+image_code+"_"+str(k)
+		DATA[v_title] = [stats[k]['area'], stats[k]['mean']]
 	#Detect T cells in the image
 	n_tcells = finding_Tcells(tcell_channel)
+	if distance_mode == "transform":
+		#Label image of the (checked) T cells, read once for all the vessels
+		tcell_labels = labels_from_rois(rm.getRoisAsArray()[:n_tcells], whole.getWidth(), whole.getHeight())
+		cells = tcell_pixels(tcell_labels, n_tcells)
 	#Calculate the distance
-	for s in xrange(len(list_vessels)):
-		vessel = list_vessels[s]
-		v_title = tumor_number+"_"+vessel.getTitle()[-1]+"_"+str(s)
-		distance_to_vessels(vessel, v_title)
+	for s, vessel in enumerate(crop_vessels(ori_vessel, vessel_rois)):
+		v_title = tumor_number+"_"+image_code+"_"+str(s)
+		if distance_mode == "transform":
+			distance_to_vessels_edm(vessel, v_title, cells)
+		else:
+			distance_to_vessels(vessel, v_title)
 	
 	# Closing current image
 	
+	forget(vessels)
+	channels.close()
 	whole.close()
 
+#Results of the other worker processes (batch mode with workers only)
+DATA = gather(CONFIG, "DATA", DATA)
+DISTANCES = gather(CONFIG, "DISTANCES", DISTANCES)
+THRESHOLDS = gather(CONFIG, "THRESHOLDS", THRESHOLDS)
+
 #Quick printing for debugging
 print(DATA)
 	
 ### Saving the data
 
-results = open(Wdir+"/new_distance_"+tumor_number+".txt", "w") 
-results.write(str(DATA))
-results.close()		
-	
\ No newline at end of file
+# vessel -> [area, intensity, distance of each T cell], read by distance_analysis
+write_results(Wdir+"/new_distance_"+tumor_number+".npz", DATA, "distance")
+
+if distance_mode == "transform":
+	results = open(Wdir+"/new_distance_"+tumor_number+"_um.txt", "w")
+	results.write(str(DISTANCES))
+	results.close()
+
+results = open(Wdir+"/new_distance_"+tumor_number+"_thresholds.txt", "w")
+results.write(str(THRESHOLDS))
+results.close()
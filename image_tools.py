@@ -0,0 +1,400 @@
+###Introduction
+
+# Hi!
+
+# Characteristics
+	# written for Jython (Python 2.7 in ImageJ 2.9.0)
+	# contact for help: solenedeutsch@gmail.com
+
+# Aim of the script
+	# Gathers the helper functions shared by the Fiji scripts (distance_measurement, subcluster_measurement, ...)
+	# This file is not meant to be run on its own: the other scripts import it.
+
+# Getting started
+	# copy this file into the Fiji.app/jars/Lib folder so that Fiji can find it, then restart Fiji
+	# if you modify this file, restart Fiji as well (Jython keeps the old version in memory otherwise)
+
+# Have fun!
+
+###Imports
+
+from ij import ImagePlus, ImageStack, Prefs
+from ij.process import ByteProcessor, ColorProcessor, ShortProcessor, FloatProcessor, ImageProcessor, Blitter
+from ij.plugin.filter import ThresholdToSelection, GaussianBlur
+from ij.gui import WaitForUserDialog
+from java.awt import Rectangle
+from java.lang import System
+from java.util.concurrent import Callable, Executors
+
+###Channels
+
+def channel_title(imp, channel):
+	'''
+	Title given by ChannelSplitter to a channel of imp (channel starts from 0): "C1-title", "C2-title"...
+	'''
+	return "C"+str(channel+1)+"-"+imp.getTitle()
+
+def channel_image(imp, channel):
+	'''
+	Returns one channel of imp (channel starts from 0) as an image, like ChannelSplitter.split(imp)[channel] (same title, LUT and calibration).
+	For an image in memory, the planes are not copied: the channel uses the pixels of imp.
+	For a virtual stack, stack.getPixels reads each plane of the channel from the disk into memory when the channel is made,
+	so the channel takes the memory of all its planes (and the planes are read again for each channel_image call).
+	'''
+	stack = imp.getStack()
+	planes = ImageStack(imp.getWidth(), imp.getHeight())
+	for t in xrange(1, imp.getNFrames()+1):
+		for z in xrange(1, imp.getNSlices()+1):
+			index = imp.getStackIndex(channel+1, z, t)
+			planes.addSlice(stack.getSliceLabel(index), stack.getPixels(index))
+	result = ImagePlus(channel_title(imp, channel), planes)
+	result.setDimensions(1, imp.getNSlices(), imp.getNFrames())
+	result.setCalibration(imp.getCalibration().copy())
+	if imp.isComposite():
+		lut = imp.getChannelLut(channel+1)
+		result.getProcessor().setLut(lut)
+		result.setDisplayRange(lut.min, lut.max)
+	else:
+		result.setDisplayRange(imp.getDisplayRangeMin(), imp.getDisplayRangeMax())
+	return result
+
+class Channels(object):
+	'''
+	Replaces ChannelSplitter.split(imp): channels[i] is channel i of imp, but each channel is only made the first time the script uses it,
+	so the unused channels cost neither memory nor time. A channel shares its pixels with imp when imp is in memory;
+	for a virtual stack its planes are read from the disk into memory when it is made (see channel_image).
+	/!\ the channels must not be modified in place (imp would be modified as well), duplicate them first.
+	'''
+	def __init__(self, imp):
+		self.imp = imp
+		self.made = {}
+
+	def __len__(self):
+		return self.imp.getNChannels()
+
+	def __getitem__(self, channel):
+		if channel < 0:
+			channel += len(self)
+		if channel < 0 or channel >= len(self):
+			raise IndexError("channel "+str(channel)+" does not exist in "+self.imp.getTitle())
+		if channel not in self.made:
+			self.made[channel] = channel_image(self.imp, channel)
+		return self.made[channel]
+
+	def close(self):
+		'''
+		Closes the channels that were made (the pixels of imp are kept).
+		'''
+		for channel in self.made.values():
+			channel.changes = False
+			channel.close()
+		self.made = {}
+
+###Projections
+
+def project_channel(imp, channel, method):
+	'''
+	Z-projection of one channel of imp (channel starts from 0, as in the list given by ChannelSplitter.split), without splitting the channels.
+	method : "max" (same type as imp), "sum" or "avg" (32-bit), same results and title as ZProjector.run on the split channel
+	The planes are read one at a time and added to the projection: with a virtual stack (File -> Import -> TIFF Virtual Stack,
+	or the batch mode of batch_tools), only one plane of the image is ever in memory.
+	Only the first time frame is projected.
+	'''
+	stack = imp.getStack()
+	n_slices = imp.getNSlices()
+	projection = None
+	for z in xrange(1, n_slices+1):
+		ip = stack.getProcessor(imp.getStackIndex(channel+1, z, 1))
+		if method == "max":
+			if projection is None:
+				projection = ip.duplicate()
+			else:
+				projection.copyBits(ip, 0, 0, Blitter.MAX)
+		else:
+			if projection is None:
+				projection = FloatProcessor(imp.getWidth(), imp.getHeight())
+			projection.copyBits(ip.convertToFloatProcessor(), 0, 0, Blitter.ADD)
+	if method == "avg":
+		projection.multiply(1.0/n_slices)
+	projection.resetMinAndMax()
+	result = ImagePlus(method.upper()+"_"+channel_title(imp, channel), projection)
+	result.setCalibration(imp.getCalibration().copy())
+	return result
+
+###Slices
+
+class SliceTask(Callable):
+	'''
+	Runs function(stack, index) on some slices of a stack (one task per thread, see process_slices).
+	'''
+	def __init__(self, function, stack, indexes):
+		self.function = function
+		self.stack = stack
+		self.indexes = indexes
+
+	def call(self):
+		for index in self.indexes:
+			self.function(self.stack, index)
+
+def process_slices(imp, function, indexes = None, threads = None):
+	'''
+	Runs function(stack, index) for every slice of imp (or only the slice numbers in indexes), several slices at the same time.
+	threads : number of slices processed at the same time (default: number of threads set in ImageJ, Edit -> Options -> Memory & Threads)
+	function must only change the slice it is given. Jython threads run in parallel, even for Python code.
+	'''
+	stack = imp.getStack()
+	if indexes is None:
+		indexes = range(1, stack.getSize()+1)
+	if threads is None:
+		threads = Prefs.getThreads()
+	threads = max(1, min(threads, len(indexes)))
+	if threads == 1:
+		for index in indexes:
+			function(stack, index)
+		return
+	pool = Executors.newFixedThreadPool(threads)
+	try:
+		for future in pool.invokeAll([SliceTask(function, stack, indexes[t::threads]) for t in xrange(threads)]):
+			future.get() # raises the errors of the threads
+	finally:
+		pool.shutdown()
+
+def bands(height, size):
+	'''
+	Cuts the rows of a plane into tiles of size rows spanning the whole width (the last one can be smaller), to work on a big plane piece by piece.
+	Returns a list of (first row, number of rows).
+	'''
+	return [(y, min(size, height-y)) for y in xrange(0, height, size)]
+
+def band_processor(ip, y, height):
+	'''
+	Copy of the rows y to y+height-1 of ip (see bands), with its own display range. The ROI of ip is not used, so several threads can copy bands of ip at the same time.
+	'''
+	width = ip.getWidth()
+	band = ip.createProcessor(width, height)
+	System.arraycopy(ip.getPixels(), y*width, band.getPixels(), 0, width*height)
+	band.resetMinAndMax()
+	return band
+
+###Filters
+
+def gaussian_blur(imp, sigma):
+	'''
+	Same as IJ.run(imp, "Gaussian Blur...", "sigma=... stack") (sigma in pixels), but done in place and on several slices at the same time.
+	Each slice is blurred as 32-bit (separable Gaussian of ImageJ, same accuracy as the command) and rounded back to the type of imp.
+	'''
+	def blur_slice(stack, index):
+		ip = stack.getProcessor(index)
+		accuracy = 0.002 if isinstance(ip, ByteProcessor) or isinstance(ip, ColorProcessor) else 0.0002
+		blur = GaussianBlur()
+		fp = None
+		for channel in xrange(ip.getNChannels()):
+			fp = ip.toFloat(channel, fp)
+			blur.blurGaussian(fp, sigma, sigma, accuracy)
+			ip.setPixels(channel, fp)
+	process_slices(imp, blur_slice)
+	imp.updateAndDraw()
+
+###Cropping
+
+def crop_rectangle(imp, bounds):
+	'''
+	Returns a copy of imp (every slice) limited to the rectangle bounds.
+	The position of the crop in imp is kept in the "crop_x", "crop_y", "full_width" and "full_height" properties of the new image.
+	'''
+	stack = imp.getStack()
+	cropped = ImageStack(bounds.width, bounds.height)
+	for n in xrange(1, stack.getSize()+1):
+		ip = stack.getProcessor(n)
+		ip.setRoi(bounds)
+		cropped.addSlice(stack.getSliceLabel(n), ip.crop())
+	crop = ImagePlus("DUP_"+imp.getTitle(), cropped)
+	crop.setDimensions(imp.getNChannels(), imp.getNSlices(), imp.getNFrames())
+	crop.setCalibration(imp.getCalibration().copy())
+	crop.setDisplayRange(imp.getDisplayRangeMin(), imp.getDisplayRangeMax())
+	crop.setProperty("crop_x", bounds.x)
+	crop.setProperty("crop_y", bounds.y)
+	crop.setProperty("full_width", imp.getWidth())
+	crop.setProperty("full_height", imp.getHeight())
+	return crop
+
+def roi_in_crop(roi, crop):
+	'''
+	Returns a copy of roi moved to the coordinates of crop (an image made by crop_rectangle or crop_to_roi).
+	'''
+	bounds = roi.getBounds()
+	local = roi.clone()
+	local.setLocation(bounds.x-crop.getProperty("crop_x"), bounds.y-crop.getProperty("crop_y"))
+	return local
+
+def crop_to_roi(imp, roi, clear = True, margin = 0):
+	'''
+	Returns a copy of imp (every slice) limited to the bounding box of roi, enlarged by margin pixels on each side.
+	If clear is True, everything outside roi is set to 0 (same as "Clear Outside" with a black background).
+	'''
+	bounds = roi.getBounds()
+	bounds.grow(margin, margin)
+	bounds = bounds.intersection(Rectangle(0, 0, imp.getWidth(), imp.getHeight()))
+	crop = crop_rectangle(imp, bounds)
+	if clear:
+		local = roi_in_crop(roi, crop)
+		stack = crop.getStack()
+		for n in xrange(1, stack.getSize()+1):
+			ip = stack.getProcessor(n)
+			ip.setValue(0)
+			ip.fillOutside(local)
+	return crop
+
+def crop_like(imp, crop):
+	'''
+	Returns a copy of imp limited to the same region as crop (an image made by crop_rectangle or crop_to_roi), nothing is cleared.
+	'''
+	return crop_rectangle(imp, Rectangle(crop.getProperty("crop_x"), crop.getProperty("crop_y"), crop.getWidth(), crop.getHeight()))
+
+def uncrop(crop):
+	'''
+	Puts a cropped image (made by crop_rectangle or crop_to_roi) back at its place in an image of the original size, filled with 0 around it.
+	'''
+	stack = crop.getStack()
+	width = crop.getProperty("full_width")
+	height = crop.getProperty("full_height")
+	full = ImageStack(width, height)
+	for n in xrange(1, stack.getSize()+1):
+		ip = stack.getProcessor(n)
+		whole = ip.createProcessor(width, height)
+		whole.insert(ip, crop.getProperty("crop_x"), crop.getProperty("crop_y"))
+		full.addSlice(stack.getSliceLabel(n), whole)
+	imp = ImagePlus(crop.getTitle(), full)
+	imp.setDimensions(crop.getNChannels(), crop.getNSlices(), crop.getNFrames())
+	imp.setCalibration(crop.getCalibration().copy())
+	imp.setDisplayRange(crop.getDisplayRangeMin(), crop.getDisplayRangeMax())
+	return imp
+
+def crop_vessels(imp, rois, show = False, message = "Check vessel.", margin = 0):
+	'''
+	Generator giving, one at a time, a copy of imp cropped around each roi, with the outside of the roi cleared (see crop_to_roi).
+	Each vessel image is only made when the loop asks for it and is closed when the loop moves on to the next one,
+	so that only one vessel is in memory at a time, whatever the number of vessels.
+	If show is True, each vessel is displayed for a manual check (message) before being analyzed.
+	'''
+	for roi in rois:
+		vessel = crop_to_roi(imp, roi, True, margin)
+		if show:
+			vessel.show()
+			check = WaitForUserDialog("Time to look at the data", message)
+			check.show()
+			vessel.hide()
+		yield vessel
+		vessel.changes = False
+		vessel.close()
+		vessel.flush()
+
+###Label images
+
+def labels_from_rois(rois, width, height):
+	'''
+	Paints a list of ROIs into a 16-bit label image: the pixels of rois[i] get the value i+1, the background stays 0.
+	width, height : size of the image the ROIs come from
+	Returns the label image (ImageProcessor).
+	'''
+	labels = ShortProcessor(width, height)
+	for i in xrange(len(rois)):
+		labels.setValue(i+1)
+		labels.fill(rois[i])
+	return labels
+
+def label_pixels(labels):
+	'''
+	Returns the pixel values of a label image as an array of floats (works for 8-bit, 16-bit and 32-bit label images).
+	'''
+	if isinstance(labels, FloatProcessor):
+		return labels.getPixels()
+	return labels.convertToFloatProcessor().getPixels()
+
+def label_regions(labels):
+	'''
+	Scans a label image (background = 0, each object filled with its own value, like the cellpose output) only once.
+	Returns a list with one dictionary per label value, sorted by value, containing:
+		'label' : pixel value of the object
+		'area' : number of pixels
+		'centroid' : (x, y) in pixels
+		'bounds' : (x, y, width, height) of the bounding box
+		'roi' : selection of the object (only computed inside its bounding box)
+	'''
+	width = labels.getWidth()
+	pixels = label_pixels(labels)
+	# For each label: [number of pixels, sum of x, sum of y, min x, min y, max x, max y]
+	found = {}
+	for i in xrange(len(pixels)):
+		value = int(pixels[i])
+		if value == 0:
+			continue
+		y, x = divmod(i, width)
+		region = found.get(value)
+		if region is None:
+			found[value] = [1, x, y, x, y, x, y]
+		else:
+			region[0] += 1
+			region[1] += x
+			region[2] += y
+			if x < region[3]:
+				region[3] = x
+			elif x > region[5]:
+				region[5] = x
+			region[6] = y # pixels are read line by line, so the last y is the largest
+	# Building the selections from the bounding boxes only
+	converter = ThresholdToSelection()
+	regions = []
+	for value in sorted(found.keys()):
+		count, sum_x, sum_y, x0, y0, x1, y1 = found[value]
+		labels.setRoi(Rectangle(x0, y0, x1-x0+1, y1-y0+1))
+		crop = labels.crop()
+		crop.setThreshold(value, value, ImageProcessor.NO_LUT_UPDATE)
+		roi = converter.convert(crop)
+		bounds = roi.getBounds()
+		roi.setLocation(x0+bounds.x, y0+bounds.y)
+		regions.append({'label' : value, 'area' : count, 'centroid' : (float(sum_x)/count, float(sum_y)/count), 'bounds' : (x0, y0, x1-x0+1, y1-y0+1), 'roi' : roi})
+	labels.resetRoi()
+	return regions
+
+def measure_labels(labels, imp, n_labels, lower = None, upper = 255):
+	'''
+	Measures every object of a label image in a single scan of imp (a 2D image, e.g. a z-projection, of the same size).
+	n_labels : number of objects (values 1 to n_labels, other values are ignored)
+	lower, upper : if lower is given, also measures the fraction of the pixels of each object with lower <= value <= upper
+		(same as "Measure" on the mask made with IJ.setThreshold(imp, lower, upper) and "Convert to Mask", divided by 255)
+	Returns a list with one dictionary per object (index = label-1) containing 'area' (calibrated, like "Measure"), 'mean' and 'fraction'.
+	'''
+	label_values = label_pixels(labels)
+	values = imp.getProcessor().convertToFloatProcessor().getPixels()
+	# For each label: [number of pixels, sum of the values, number of pixels above the threshold]
+	counts = [0]*(n_labels+1)
+	sums = [0.0]*(n_labels+1)
+	above = [0]*(n_labels+1)
+	for i in xrange(len(values)):
+		value = int(label_values[i])
+		if value == 0 or value > n_labels:
+			continue
+		counts[value] += 1
+		sums[value] += values[i]
+		if lower is not None and lower <= values[i] <= upper:
+			above[value] += 1
+	calibration = imp.getCalibration()
+	pixel_area = calibration.pixelWidth*calibration.pixelHeight
+	stats = []
+	for value in xrange(1, n_labels+1):
+		count = counts[value]
+		if count == 0:
+			stats.append({'area' : 0.0, 'mean' : float("nan"), 'fraction' : float("nan")})
+		else:
+			stats.append({'area' : count*pixel_area, 'mean' : sums[value]/count, 'fraction' : float(above[value])/count})
+	return stats
+
+def add_rois(rm, rois, prefix):
+	'''
+	Adds a list of ROIs to the Roi Manager, named prefix+index (index = position in the Roi Manager).
+	'''
+	start = rm.getCount()
+	for i in xrange(len(rois)):
+		rois[i].setName(prefix+str(start+i))
+		rm.addRoi(rois[i])
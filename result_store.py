@@ -0,0 +1,339 @@
+###Introduction
+
+# Hi!
+
+# Characteristics
+	# written for Jython (Python 2.7 in ImageJ 2.9.0) and Python 3.8 (numpy is needed to read the files, not to write them)
+	# contact for help: solenedeutsch@gmail.com
+
+# Aim of the script
+	# Result files in columns: the Fiji scripts write their results (DATA) in a .npz file instead of a one line text file,
+	# and the analysis scripts read the columns they need without parsing the whole text
+	# This file is not meant to be run on its own: the other scripts import it (except to convert old text files, see below).
+
+# Getting started
+	# copy this file into the Fiji.app/jars/Lib folder so that Fiji can find it, then restart Fiji
+	# keep a copy next to the analysis scripts (distance_analysis, subcluster_graphs, colocalization_stat) as well
+	# to convert the text files of previous runs (dictionary written with str(DATA)), in a terminal:
+		# python result_store.py distance new_distance_1.txt new_distance_2.txt ...
+		# the kinds of files are distance, subcluster and colocalization (see SCHEMAS), each file.txt gives file.npz next to it
+	# the analysis scripts read both the .npz files and the old text files
+
+# Code details for curious people
+	# a .npz file is a zip of numpy arrays (.npy files), it can be opened with numpy.load
+	# the file contains one array per column: 'key' (names of the vessels/images) and one array per value of the lists of DATA
+	# the lists of different lengths (e.g. distances of the T cells to each vessel) are kept in two arrays, like Arrow:
+	# 'name.values' (all the values one after the other) and 'name.offsets' (the values of row i are values[offsets[i]:offsets[i+1]])
+	# '__schema__' describes the columns (json text), the words written instead of numbers (e.g. "too far") are stored as codes
+	# the .npy files are written by hand (header + little-endian numbers), so Fiji does not need numpy
+
+# Have fun!
+
+###Imports
+
+import json
+import numbers
+import os
+import struct
+import sys
+import zipfile
+
+###Schemas
+
+# Columns of the result files: 'columns' = one column per value at the start of the lists of DATA,
+# 'list' = name of the column holding the remaining values (lists of any length), 'codes' = numbers stored instead of words
+SCHEMAS = {
+	'distance' : {'columns' : ['area', 'mean'], 'list' : 'distances', 'codes' : {'too far' : 6}},
+	'subcluster' : {'columns' : ['area', 'mean_plvap', 'fraction_plvap', 'mean_vwf', 'fraction_vwf']},
+	'colocalization' : {'columns' : ['tM1', 'tM2']},
+}
+
+###Writing
+
+def npy(values, kind):
+	'''
+	A 1D array as the content of a .npy file. kind : 'f' (64-bit floats), 'i' (64-bit integers) or 'S' (texts, stored as utf-8).
+	'''
+	if kind == 'S':
+		texts = [value.encode('utf-8') if not isinstance(value, bytes) else value for value in values]
+		size = max([len(text) for text in texts] + [1])
+		descr = '|S'+str(size)
+		data = b''.join([text+b'\0'*(size-len(text)) for text in texts])
+	else:
+		descr = '<f8' if kind == 'f' else '<i8'
+		data = struct.pack('<'+str(len(values))+('d' if kind == 'f' else 'q'), *values)
+	header = "{'descr': '"+descr+"', 'fortran_order': False, 'shape': ("+str(len(values))+",), }"
+	# The header is padded with spaces so that the data starts at a multiple of 64 bytes
+	header += ' '*(63-(10+len(header))%64)+'\n'
+	return b'\x93NUMPY\x01\x00'+struct.pack('<H', len(header))+header.encode('ascii')+data
+
+def column_kind(values, codes):
+	'''
+	Kind of array for a column (see npy): integers, floats, or texts if there is a word that is not in codes.
+	'''
+	kind = 'i'
+	for value in values:
+		if isinstance(value, numbers.Integral) or value in codes:
+			continue
+		if isinstance(value, numbers.Real):
+			kind = 'f'
+			continue
+		try:
+			float(value)
+			kind = 'f'
+		except (TypeError, ValueError):
+			return 'S'
+	return kind
+
+def encode(values, kind, codes):
+	'''
+	Values of a column as numbers (codes for the words) or texts, following kind (see column_kind).
+	'''
+	if kind == 'S':
+		return [value if isinstance(value, type(u'')) or isinstance(value, bytes) else str(value) for value in values]
+	number = float if kind == 'f' else int
+	return [codes[value] if value in codes else number(value) for value in values]
+
+def write_results(path, data, kind):
+	'''
+	Writes data (dictionary, key -> list of values like DATA in the Fiji scripts) in a .npz file, with the columns of SCHEMAS[kind].
+	The order of the keys is kept.
+	'''
+	schema = SCHEMAS[kind]
+	names = schema['columns']
+	codes = schema.get('codes', {})
+	keys = list(data.keys())
+	rows = [data[key] if isinstance(data[key], list) else [data[key]] for key in keys]
+	arrays = [('key', npy(keys, 'S'))]
+	description = {'kind' : kind, 'rows' : len(keys), 'columns' : []}
+	for i in range(len(names)):
+		values = [row[i] if len(row) > i else float('nan') for row in rows]
+		column = column_kind(values, codes)
+		arrays.append((names[i], npy(encode(values, column, codes), column)))
+		description['columns'].append({'name' : names[i], 'kind' : column})
+	if 'list' in schema:
+		values = []
+		offsets = [0]
+		for row in rows:
+			values.extend(row[len(names):])
+			offsets.append(len(values))
+		column = column_kind(values, codes)
+		arrays.append((schema['list']+'.values', npy(encode(values, column, codes), column)))
+		arrays.append((schema['list']+'.offsets', npy(offsets, 'i')))
+		description['columns'].append({'name' : schema['list'], 'kind' : column, 'list' : True})
+	description['codes'] = codes
+	arrays.append(('__schema__', npy([json.dumps(description)], 'S')))
+	archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+	try:
+		for name, content in arrays:
+			archive.writestr(name+'.npy', content)
+	finally:
+		archive.close()
+
+def convert_text(path, kind):
+	'''
+	Converts a result file of a previous run (one line, str(DATA)) to a .npz file next to it. Returns the path of the new file.
+	'''
+	new_path = os.path.splitext(path)[0]+'.npz'
+	write_results(new_path, read_text(path), kind)
+	return new_path
+
+###Reading
+
+def read_text(path):
+	'''
+	The dictionary of an old result file (one line, str(DATA)).
+	'''
+	import ast
+	file = open(path, 'r')
+	content = file.readline()
+	file.close()
+	return ast.literal_eval(content)
+
+def schema(path):
+	'''
+	Description of the columns of a .npz result file (see write_results).
+	'''
+	import numpy as np
+	with np.load(path) as archive:
+		return json.loads(archive['__schema__'][0].decode('utf-8'))
+
+def read_columns(path, names = None, kind = None):
+	'''
+	Reads some columns of a result file (all of them if names is None), only those are read from the .npz file.
+	Returns a dictionary, name -> numpy array ('key' -> names of the rows as texts); a list column gives a list with one array per row.
+	kind : kind of file (see SCHEMAS), only needed for the old text files, which are converted in memory
+	'''
+	if not path.endswith('.npz'):
+		text_data = read_text(path)
+		if names is None:
+			names = ['key']+SCHEMAS[kind]['columns']+([SCHEMAS[kind]['list']] if 'list' in SCHEMAS[kind] else [])
+		return columns_from_dict(text_data, kind, names)
+	return read_archive(path, names)[1]
+
+def read_archive(path, names = None):
+	'''
+	Description (see schema) and columns (see read_columns) of a .npz result file, opened once.
+	'''
+	import numpy as np
+	with np.load(path) as archive:
+		description = json.loads(archive['__schema__'][0].decode('utf-8'))
+		lists = [column['name'] for column in description['columns'] if column.get('list')]
+		if names is None:
+			names = ['key']+[column['name'] for column in description['columns']]
+		columns = {}
+		for name in names:
+			if name == 'key' or (name not in lists and archive[name].dtype.kind == 'S'):
+				columns[name] = np.char.decode(archive[name], 'utf-8')
+			elif name in lists:
+				values = archive[name+'.values']
+				offsets = archive[name+'.offsets']
+				columns[name] = np.split(values, offsets[1:-1]) if len(offsets) > 1 else []
+			else:
+				columns[name] = archive[name]
+	return description, columns
+
+def columns_from_dict(data, kind, names):
+	'''
+	Same columns as read_columns from a dictionary of results (old text files).
+	'''
+	import numpy as np
+	schema = SCHEMAS[kind]
+	codes = schema.get('codes', {})
+	fixed = schema['columns']
+	rows = [value if isinstance(value, list) else [value] for value in data.values()]
+	columns = {}
+	for name in names:
+		if name == 'key':
+			columns[name] = np.array(list(data.keys()), dtype = str)
+		elif name in fixed:
+			i = fixed.index(name)
+			values = [row[i] if len(row) > i else float('nan') for row in rows]
+			column = column_kind(values, codes)
+			columns[name] = np.array(encode(values, column, codes), dtype = {'i' : np.int64, 'f' : np.float64, 'S' : str}[column])
+		else:
+			tails = [row[len(fixed):] for row in rows]
+			column = column_kind([value for tail in tails for value in tail], codes)
+			columns[name] = [np.array(encode(tail, column, codes), dtype = {'i' : np.int64, 'f' : np.float64, 'S' : str}[column]) for tail in tails]
+	return columns
+
+def read_dict(path, kind = None):
+	'''
+	Reads a result file (.npz or old text file) as the dictionary DATA of the Fiji script that wrote it (key -> list of values, words instead of codes).
+	kind : kind of file (see SCHEMAS), only needed for the old text files
+	'''
+	if not path.endswith('.npz'):
+		return read_text(path)
+	description, columns = read_archive(path)
+	return dict_from_columns(description, columns)
+
+def dict_from_columns(description, columns):
+	'''
+	The dictionary DATA (see read_dict) from all the columns of a .npz result file and their description (see read_archive).
+	'''
+	words = dict([(code, word) for word, code in description['codes'].items()])
+	fixed = [column['name'] for column in description['columns'] if not column.get('list')]
+	lists = [column['name'] for column in description['columns'] if column.get('list')]
+	table = [columns[name].tolist() for name in fixed]
+	tails = [[array.tolist() for array in columns[name]] for name in lists]
+	keys = columns['key'].tolist()
+	data = {}
+	for row in range(len(keys)):
+		values = [column[row] for column in table]
+		for tail in tails:
+			values += [words.get(value, value) for value in tail[row]]
+		data[keys[row]] = values
+	return data
+
+###Cache
+
+CACHE = {} # (path, modification time, size) -> (description, columns) of a result file, see load_results
+CACHE_DIR = '.result_cache' # folder next to the old text files, where they are kept once converted to .npz
+
+def file_key(path):
+	'''
+	Identifies a result file and its content for the cache: absolute path, modification time and size.
+	'''
+	path = os.path.abspath(path)
+	info = os.stat(path)
+	return (path, info.st_mtime, info.st_size)
+
+def cached_path(key):
+	'''
+	Path of the converted copy of an old text file (see load_results): in CACHE_DIR next to it, named after the file, its modification time and size.
+	'''
+	folder = os.path.join(os.path.dirname(key[0]), CACHE_DIR)
+	return os.path.join(folder, os.path.basename(key[0])+'.'+repr(key[1]).replace('.', '_')+'.'+str(key[2])+'.npz')
+
+def load_results(path, kind = None):
+	'''
+	Description and columns of a result file (see read_archive), each file being read at most once:
+	the columns are kept in memory (CACHE) until the file changes, and an old text file is converted once to a .npz file in CACHE_DIR,
+	which is read instead of the text the next times (also in a new session), as long as the text file is not modified.
+	kind : kind of file (see SCHEMAS), only needed for the old text files
+	The arrays are shared between the calls: copy them before modifying them in place.
+	'''
+	key = file_key(path)
+	if key in CACHE:
+		return CACHE[key]
+	source = key[0]
+	if not source.endswith('.npz'):
+		source = cached_path(key)
+		if not os.path.isfile(source):
+			source = convert_cached(key, kind)
+	# Older versions of the file are not needed anymore
+	for old in [cached for cached in CACHE.keys() if cached[0] == key[0]]:
+		del CACHE[old]
+	CACHE[key] = read_archive(source)
+	return CACHE[key]
+
+def convert_cached(key, kind):
+	'''
+	Converts the old text file of key (see file_key) to its .npz copy in CACHE_DIR (see cached_path), and removes the copies of its previous versions.
+	If the folder cannot be written, the copy is made in a temporary folder and only used for this session. Returns the path of the copy.
+	'''
+	import tempfile
+	if kind is None:
+		raise ValueError('the kind of file (see SCHEMAS) is needed to read '+key[0])
+	path = cached_path(key)
+	folder = os.path.dirname(path)
+	try:
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+		prefix = os.path.basename(key[0])+'.'
+		for name in os.listdir(folder):
+			if name.startswith(prefix) and name.endswith('.npz') and name[len(prefix):].count('.') == 2:
+				os.remove(os.path.join(folder, name))
+		# Written under another name first, so that a copy cut by a crash is never used
+		temporary = path+'.part'
+		write_results(temporary, read_text(key[0]), kind)
+		os.rename(temporary, path)
+	except (IOError, OSError):
+		path = os.path.join(tempfile.mkdtemp(), os.path.basename(path))
+		write_results(path, read_text(key[0]), kind)
+	return path
+
+def load_columns(path, names = None, kind = None):
+	'''
+	Same as read_columns, from the cache (see load_results): repeated calls on the same file do not read it again.
+	'''
+	columns = load_results(path, kind)[1]
+	if names is None:
+		return dict(columns)
+	return dict([(name, columns[name]) for name in names])
+
+def load_dict(path, kind = None):
+	'''
+	Same as read_dict, from the cache (see load_results). The dictionary is made again at each call, so it can be modified.
+	'''
+	description, columns = load_results(path, kind)
+	return dict_from_columns(description, columns)
+
+###Converter
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3 or sys.argv[1] not in SCHEMAS:
+		print('usage: python result_store.py '+'|'.join(sorted(SCHEMAS.keys()))+' file.txt [file.txt ...]')
+		sys.exit(1)
+	for text_path in sys.argv[2:]:
+		print(text_path+' -> '+convert_text(text_path, sys.argv[1]))
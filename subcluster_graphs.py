@@ -13,12 +13,14 @@
     # Choose the graph you want to plot
     # Type the corresponding function's name in the command shell
         # Example: histo_marker_intensity("plvap", True)
+    # The result files can be the .npz files of subcluster_measurement or the text files of older runs (result_store.py has to be next to this script)
+        # each file is read once per session, plotting again is fast (the text files are converted once and kept in a .result_cache folder next to them)
 
 # Have fun!
 
 ### Imports
 
-import ast #Data formatting
+from result_store import load_columns #Reading result files (each file is read once, see load_results)
 import matplotlib.pyplot as plt #Graph plotting
 import tkinter as tk #interactive windows
 import tkinter.filedialog as fd #retrieving files
@@ -89,35 +91,24 @@ def select_regions_files():
 
 def collect_intensity(file_title):
     '''
-    Opens a text file, retrieves the data as a dictionary and returns lists of values from the dictionary.
+    Opens a result file (.npz or text file) and returns lists of values, one per vessel.
+    The file is only read the first time, data_for_stats and the next plots take it from the cache (see load_results in result_store).
     '''
-    #Open file
-    file = open(file_title, 'r')
-    content = file.readlines()
-    file.close()
-    #Proper data format
-    data = ast.literal_eval(content[0])
-    #Retrieve interesting data
-    int_vwf = [data[i][-2] for i in list(data.keys())]
-    int_plvap = [data[i][1] for i in list(data.keys())]
-    area = [data[i][0] for i in list(data.keys())]
-    area_plvap = [data[i][2] for i in list(data.keys())]
-    area_vwf = [data[i][-1] for i in list(data.keys())]
+    names = ['area', 'mean_plvap', 'mean_vwf', 'fraction_plvap', 'fraction_vwf']
+    columns = load_columns(file_title, names, 'subcluster')
+    area, int_plvap, int_vwf, area_plvap, area_vwf = [columns[name].tolist() for name in names]
     return area, int_plvap, int_vwf, area_plvap, area_vwf
 
 def data_for_stats(files):
     '''
     Open the results files and retrieve all data for each areas in the brain
     '''
+    names = ['area', 'mean_plvap', 'fraction_plvap', 'mean_vwf', 'fraction_vwf'] #same order as the values of the result files
     total_stat = [[] for _ in range(5)]
     for file_title in files:
-        file = open(file_title, 'r')
-        content = file.readlines()
-        file.close()
-        data = ast.literal_eval(content[0])
-        for vessel in data.keys():
-            for i in range(len(data[vessel])):
-                total_stat[i].append(data[vessel][i])
+        columns = load_columns(file_title, names, 'subcluster')
+        for i in range(len(names)):
+            total_stat[i] += columns[names[i]].tolist()
     return total_stat
 
 def barplot_annotate_brackets(num1, num2, data, center, height, yerr=None, dh=.05, barh=.05, fs=None, maxasterix=None):
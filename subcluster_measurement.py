@@ -12,10 +12,15 @@
 # Getting started
 	# open the images you want to analyze with the "Split channel" box unchecked
 		# /!\ open only what you want to analyze, the results of one run will all be put in the same text file
-	# the results are written in a text file, in your choosen directory
+	# the results are written in a .npz file (columns, see result_store.py), in your choosen directory
 	# the results are formatted to be compatible with the subcluster_graphs script to analyze them
+	# the thresholds used for each image are written in a second file ending with _thresholds.txt
 	# a preliminary run with fewer images is required to make sure that all the thresholdings and detections are working correctly
 	# this script selects the active image, analyzes it, and closes it. Make sure no useless image is open.
+	# image_tools.py, threshold_tools.py, binary_masks.py, result_store.py and batch_tools.py have to be copied in the Fiji.app/jars/Lib folder (the script imports functions from them)
+	# to save memory on big stacks, open the images as virtual stacks (File -> Import -> TIFF Virtual Stack...), the planes are then read from the disk when needed
+	# to run the script unattended on a whole directory, use a config file with a [subcluster_measurement] section (see batch_tools.py and batch_config_example.ini)
+		# keys: input_dir, output_dir, vessel_channel, marker1_channel, marker2_channel, experiment_type, tumor_number (and workers to analyze several images at the same time, resume = true to finish a run that stopped, see batch_tools.py)
 	
 # Have fun!
 
@@ -23,147 +28,128 @@
 
 from ij import IJ, Prefs
 from ij.plugin.frame import RoiManager
-from ij.plugin import ChannelSplitter, ZProjector
 from ij.gui import WaitForUserDialog
-from ij.measure import ResultsTable
+from image_tools import crop_vessels, measure_labels, project_channel
+from binary_masks import morphology, analyze_particles, Mask
+from threshold_tools import set_auto_threshold, threshold_text, forget
+from result_store import write_results
+from batch_tools import load_config, get_number, get_string, images, roi_manager, gather, Journal
 
 ###Preliminary functions
 
-def define_ROI(vessels, OriImage, show = False):
+def define_ROI(OriImage):
 	'''
-	Takes the z-projection and returns a list of z-stacks, each containing a single vessel.
-	Both parameters are images, returns a list of images.
+	Names the vessels of the Roi Manager as the cropped vessel images used to be named (end of the title of the crop of OriImage, then the vessel number),
+	without cropping them: the names are then read with rm.getName. Returns the number of vessels.
 	'''
-	# Isolate individual vessels
-	rm = RoiManager.getRoiManager()
 	n_roi = rm.getCount() # number of ROIs (=number of vessels detected)
-	list_vessels = [] 
-	ra = rm.getRoisAsArray()
-	# Apply ROI and clear outside to keep only the vessel part
-	for i in range(n_roi):
-		single_vessel = OriImage.duplicate()
-		single_vessel.setRoi(ra[i])
-		IJ.setBackgroundColor(0,0,0)
-		IJ.run(single_vessel, "Clear Outside", "stack")
-		IJ.run(single_vessel, "Select None", "stack")
-		list_vessels.append(single_vessel)
-		if show:
-			single_vessel.show()
-			check = WaitForUserDialog("Time to look at the data", "Check vessel.")
-			check.show()
-			single_vessel.changes = False
-			single_vessel.close()
-	return list_vessels
-
-def retrieve_data(isolate_vessels, marker_image, image_name, threshold_min):
+	crop_title = "DUP_"+OriImage.getTitle() # title of a vessel cropped from OriImage (see crop_to_roi in image_tools)
+	for k in xrange(n_roi):
+		rm.rename(k, crop_title[-12:]+"_"+str(k))
+	return n_roi
+
+def retrieve_data(vessel_labels, marker_image, n_vessels, threshold_min):
 	'''
+	Measures all the vessels at once in marker_image (z-projection), using the label image of the vessels (see analyze_particles in binary_masks).
+	Returns a list with, for each vessel, its area, the mean intensity of the marker and the fraction of the vessel above threshold_min.
 	'''
-	list_intensities = define_ROI(isolate_vessels, marker_image)
-	image_to_analyze = list_intensities[int(image_name[-1])]
-	rm.setSelectedIndexes([int(image_name[-1])])
-	rm.runCommand(image_to_analyze,"Measure")
-	IJ.setThreshold(image_to_analyze, threshold_min, 255)
-	Prefs.blackBackground = True
-	IJ.run(image_to_analyze, "Convert to Mask", "")
-	IJ.run(image_to_analyze, "Divide...", "value=255.000")
-	rm.setSelectedIndexes([int(image_name[-1])])
-	rm.runCommand(image_to_analyze,"Measure")
+	return measure_labels(vessel_labels, marker_image, n_vessels, threshold_min, 255)
 	
 def set_threshold(image):
-	IJ.run(image, "Select All", "")
-	roi = image.getRoi()
-	rm.addRoi(roi)
-	ra = rm.getRoisAsArray()
-	rm.setSelectedIndexes(range(len(ra)))
-	rm.runCommand(image,"XOR")
-	threshold = image.getStatistics().mean
-	rm.runCommand(image,"Deselect")
-	rm.setSelectedIndexes([len(ra)])
-	rm.runCommand(image, "Delete")
-	return threshold
+	'''
+	Mean intensity of image outside the vessels: "XOR" of the vessel ROIs of the Roi Manager and "Select All", done on masks (see Mask in binary_masks).
+	'''
+	outside = Mask.from_rois(rm.getRoisAsArray(), image.getWidth(), image.getHeight(), '^') ^ Mask.full(image.getWidth(), image.getHeight())
+	return outside.mean(image)
 
 	
 ###Initializing
 
-rm = RoiManager.getRoiManager()
+CONFIG = load_config("subcluster_measurement") # None unless a config file is given (batch mode)
+
+rm = roi_manager(CONFIG)
 
 DATA = {}
+THRESHOLDS = {} # image title -> thresholds used for the vessels and the two markers
 
-count = int(IJ.getNumber("How many images to analyze ?", 1))
+count = int(get_number(CONFIG, "count", "How many images to analyze ?", 1))
 
 Dir = "E:\\PROJECTS\Solene"
-intermediate = IJ.getString("Write directory for the result file (leave empty if current directory is wanted) :", "E:\\PROJECTS\Solene\P1SD12")
+intermediate = get_string(CONFIG, "output_dir", "Write directory for the result file (leave empty if current directory is wanted) :", "E:\\PROJECTS\Solene\P1SD12")
 if intermediate == "":
 	Wdir = Dir
 else :
 	Wdir = intermediate
 
-vessel_channel_number = int(IJ.getString("Enter number of channel for vessel staining", "3"))
-marker1_channel_number = int(IJ.getString("Enter the number of the channel your interested in measuring", "1"))
-marker2_channel_number = int(IJ.getString("Enter the number of the other channel your interested in", "2"))
+vessel_channel_number = int(get_string(CONFIG, "vessel_channel", "Enter number of channel for vessel staining", "3"))
+marker1_channel_number = int(get_string(CONFIG, "marker1_channel", "Enter the number of the channel your interested in measuring", "1"))
+marker2_channel_number = int(get_string(CONFIG, "marker2_channel", "Enter the number of the other channel your interested in", "2"))
+
+experiment_type = get_string(CONFIG, "experiment_type", "Enter experiment type (will be part of the result file's title)", "tumor")
+tumor_number = get_string(CONFIG, "tumor_number", "Enter tumor number", "")
 
-experiment_type = IJ.getString("Enter experiment type (will be part of the result file's title)", "tumor")
-tumor_number = IJ.getString("Enter tumor number", "")
+# The results of each image are saved as soon as it is done (subcluster_measurement_progress.pkl, see Journal in batch_tools)
+journal = Journal(CONFIG, "subcluster_measurement", Wdir, DATA = DATA, THRESHOLDS = THRESHOLDS)
 	
 ### Analysis
 
-for _ in xrange(count):
+for whole in images(CONFIG, count, journal):
 	# Initializaing for the current image
 	
-	intensity = {}
-	
-	whole = IJ.getImage()
-	
-	channels = ChannelSplitter.split(whole)
-	
-	plvap_channel = channels[marker1_channel_number]
-	vwf_channel = channels[marker2_channel_number]
-	vessel_channel = channels[vessel_channel_number]
+	# The channels are projected straight from the image, plane by plane, without splitting them (see project_channel in image_tools)
 	
 	# Choosing the vessels
 	
-	vessels = ZProjector.run(vessel_channel,"max")
-	vwf = ZProjector.run(vwf_channel,"max")
-	plvap = ZProjector.run(plvap_channel,"max")
+	vessels = project_channel(whole, vessel_channel_number, "max")
+	vwf = project_channel(whole, marker2_channel_number, "max")
+	plvap = project_channel(whole, marker1_channel_number, "max")
 	ori_vessel = vessels.duplicate()
-	IJ.setAutoThreshold(vessels, "Moments dark")
+	threshold_vessels = set_auto_threshold(vessels, "Moments")
 	Prefs.blackBackground = True
 	IJ.run(vessels, "Convert to Mask", "")
-	IJ.run(vessels, "Despeckle", "")
-	IJ.run(vessels, "Despeckle", "")
-	IJ.run(vessels, "Despeckle", "")
-	IJ.run(vessels, "Options...", "iterations=1 count=1 black do=Dilate")
-	IJ.run(vessels, "Options...", "iterations=7 count=1 black do=Close")
-	IJ.run(vessels, "Analyze Particles...", "size=30-Infinity show=Nothing clear add")
+	# 3 x Despeckle, Dilate and Close x7 in one go (see binary_masks)
+	morphology(vessels, [("despeckle", 3), ("dilate", 1), ("close", 7)], black = True)
+	# The vessels are labeled while they are found: the ROIs go to the Roi Manager and the label image is kept for the measurements (see binary_masks)
+	vessel_labels = analyze_particles(vessels, rm, 30)[0]
 	show = False
 	#show = True #Decomment to follow vessel detection
-	list_vessels = define_ROI(vessels, ori_vessel, show)
+	show = show and CONFIG is None # no manual check in batch mode
+	vessel_rois = rm.getRoisAsArray()
+	n_vessels = define_ROI(ori_vessel)
 	threshold_plvap = set_threshold(plvap)
 	threshold_vwf = set_threshold(vwf)
-	for k in xrange(len(list_vessels)):
-		vessel = list_vessels[k]
-		v_title = vessel.getTitle()[-12:]+"_"+str(k)
-		DATA[v_title] = []
-		retrieve_data(vessel, plvap, v_title, threshold_plvap)
-		retrieve_data(vessel, vwf, v_title, threshold_vwf)
-		table = ResultsTable.getResultsTable()
-		vessel_area = [area for area in table.getColumn(0)][0]
-		vessel_intensities = [intensity for intensity in table.getColumn(1)]
-		DATA[v_title].append(vessel_area)
-		DATA[v_title] += vessel_intensities
-		IJ.run("Clear Results", "")
+	THRESHOLDS[whole.getTitle()] = {'vessels' : threshold_text(threshold_vessels), 'plvap' : threshold_plvap, 'vwf' : threshold_vwf}
+	# One scan of each marker image for all the vessels
+	stats_plvap = retrieve_data(vessel_labels, plvap, n_vessels, threshold_plvap)
+	stats_vwf = retrieve_data(vessel_labels, vwf, n_vessels, threshold_vwf)
+	for k in xrange(n_vessels):
+		if show:
+			# The vessel is only cropped for the manual check (see crop_vessels in image_tools)
+			for vessel in crop_vessels(ori_vessel, [vessel_rois[k]], True):
+				pass
+		v_title = rm.getName(k)
+		# [area, mean plvap, fraction above threshold plvap, mean vwf, fraction above threshold vwf]
+		DATA[v_title] = [stats_plvap[k]['area'], stats_plvap[k]['mean'], stats_plvap[k]['fraction'], stats_vwf[k]['mean'], stats_vwf[k]['fraction']]
 	
 	# Closing current image
 	
+	forget(vessels)
 	whole.close()
 
+# Results of the other worker processes (batch mode with workers only)
+DATA = gather(CONFIG, "DATA", DATA)
+THRESHOLDS = gather(CONFIG, "THRESHOLDS", THRESHOLDS)
+
 print(DATA)
 	
 # Saving the data
 
-results = open(Wdir+"/"+experiment_type+"_"+tumor_number+".txt", "w") 
-results.write(str(DATA))
-results.close()		
+# vessel -> [area, mean plvap, fraction above threshold plvap, mean vwf, fraction above threshold vwf], read by subcluster_graphs
+write_results(Wdir+"/"+experiment_type+"_"+tumor_number+".npz", DATA, "subcluster")
+
+results = open(Wdir+"/"+experiment_type+"_"+tumor_number+"_thresholds.txt", "w")
+results.write(str(THRESHOLDS))
+results.close()
 	
 	
 	
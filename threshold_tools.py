@@ -0,0 +1,231 @@
+###Introduction
+
+# Hi!
+
+# Characteristics
+	# written for Jython (Python 2.7 in ImageJ 2.9.0)
+	# contact for help: solenedeutsch@gmail.com
+
+# Aim of the script
+	# Auto-threshold engine shared by the Fiji scripts: gives the same thresholds as IJ.setAutoThreshold (Otsu, Moments, Li, Triangle, Shanbhag...)
+	# The histogram of an image is computed once, every method is then derived from it, and the thresholds are kept for the next request.
+	# This file is not meant to be run on its own: the other scripts import it.
+
+# Getting started
+	# copy this file into the Fiji.app/jars/Lib folder so that Fiji can find it, then restart Fiji
+
+# Code details for curious people
+	# like ImageJ, 16-bit and 32-bit images are thresholded on a 256 bins histogram going from their smallest to their largest value
+	# the histogram is built straight from the pixels (no 8-bit copy of the image for 16-bit images)
+	# the thresholds of an image are kept until forget(imp) is called: call it if the pixels of the image are modified in place
+	# for very big planes, streamed_histogram builds the same histogram tile by tile (several tiles at the same time) without any copy of the whole plane
+
+# Have fun!
+
+###Imports
+
+from ij.process import AutoThresholder, ImageProcessor, ByteProcessor, ShortProcessor
+from java.lang import System
+from image_tools import process_slices, bands, band_processor
+import math
+
+###Cache
+
+HISTOGRAMS = {} # (image, plane) -> (histogram, min, max)
+THRESHOLDS = {} # (image, plane, method, dark) -> (lower, upper)
+
+def image_key(imp):
+	'''
+	Identifies the current plane of imp (and its ROI) for the cache.
+	'''
+	ip = imp.getProcessor()
+	roi = ip.getRoi()
+	return (imp.getID(), imp.getCurrentSlice(), System.identityHashCode(ip.getPixels()), roi.x, roi.y, roi.width, roi.height)
+
+def forget(imp):
+	'''
+	Removes the histograms and thresholds of imp from the cache (to call when imp is closed or its pixels are modified).
+	'''
+	for cache in (HISTOGRAMS, THRESHOLDS):
+		for key in cache.keys():
+			if key[0] == imp.getID():
+				del cache[key]
+
+###Histogram
+
+def histogram(imp):
+	'''
+	Histogram used by the ImageJ auto-threshold methods for the current plane of imp (inside its ROI if there is one).
+	Returns (histogram, min, max): 256 bins, min and max are the values covered by the bins for 16-bit and 32-bit images (None for 8-bit images).
+	'''
+	key = image_key(imp)
+	if key in HISTOGRAMS:
+		return HISTOGRAMS[key]
+	ip = imp.getProcessor()
+	if isinstance(ip, ByteProcessor):
+		result = (list(ip.getHistogram()), None, None)
+	else:
+		# Same range as ImageJ, which resets the display range before converting to 8-bit
+		display = (ip.getMin(), ip.getMax())
+		ip.resetMinAndMax()
+		low, high = ip.getMin(), ip.getMax()
+		if isinstance(ip, ShortProcessor):
+			low, high = int(low), int(high)
+			counts = short_bins(ip.getHistogram(), low, high)
+		else:
+			# 32-bit: the 8-bit conversion is done by ImageJ, only one plane is converted
+			converted = ip.convertToByte(True)
+			converted.setRoi(ip.getRoi())
+			converted.setMask(ip.getMask())
+			counts = list(converted.getHistogram())
+		ip.setMinAndMax(display[0], display[1])
+		result = (counts, low, high)
+	HISTOGRAMS[key] = result
+	return result
+
+def short_bins(full, low, high):
+	'''
+	Gathers the 65536 bins histogram of a 16-bit image into 256 bins going from low to high, like the 8-bit conversion (scale = 256/(max-min+1)).
+	'''
+	scale = 256.0/(high-low+1)
+	counts = [0]*256
+	for value in xrange(low, high+1):
+		if full[value]:
+			counts[min(int((value-low)*scale+0.5), 255)] += full[value]
+	return counts
+
+def streamed_histogram(imp, size = 1024):
+	'''
+	Same as histogram(imp) for the whole current plane of imp (its ROI is removed), built from tiles of size rows (see bands in image_tools),
+	several tiles at the same time, so that a very big plane is never copied or converted at once.
+	The result is kept in the cache: auto_threshold(imp, ...) then uses it.
+	'''
+	imp.deleteRoi()
+	key = image_key(imp)
+	if key in HISTOGRAMS:
+		return HISTOGRAMS[key]
+	ip = imp.getProcessor()
+	parts = bands(ip.getHeight(), size)
+	tiles = [None]*len(parts)
+	if isinstance(ip, ByteProcessor) or isinstance(ip, ShortProcessor):
+		def tile_histogram(stack, index):
+			tiles[index] = band_processor(ip, parts[index][0], parts[index][1]).getHistogram()
+		process_slices(imp, tile_histogram, range(len(parts)))
+		full = [sum(column) for column in zip(*tiles)]
+		if isinstance(ip, ByteProcessor):
+			result = (full, None, None)
+		else:
+			used = [value for value in xrange(len(full)) if full[value]]
+			low, high = used[0], used[-1]
+			result = (short_bins(full, low, high), low, high)
+	else:
+		# 32-bit: the range of the whole plane is needed before converting the tiles to 8-bit like the plane
+		def tile_range(stack, index):
+			band = band_processor(ip, parts[index][0], parts[index][1])
+			tiles[index] = (band.getMin(), band.getMax())
+		process_slices(imp, tile_range, range(len(parts)))
+		low, high = min([tile[0] for tile in tiles]), max([tile[1] for tile in tiles])
+		def tile_histogram(stack, index):
+			band = band_processor(ip, parts[index][0], parts[index][1])
+			band.setMinAndMax(low, high)
+			tiles[index] = band.convertToByte(True).getHistogram()
+		process_slices(imp, tile_histogram, range(len(parts)))
+		result = ([sum(column) for column in zip(*tiles)], low, high)
+	HISTOGRAMS[key] = result
+	return result
+
+###Thresholds
+
+def auto_threshold(imp, method, dark = True):
+	'''
+	Thresholds that IJ.setAutoThreshold(imp, method+" dark") would set on the current plane of imp, without setting them.
+	method : name of an ImageJ method ("Otsu", "Moments", "Li", "Triangle", "Shanbhag"...)
+	dark : the objects are bright on a dark background
+	Returns (lower, upper) in pixel values.
+	'''
+	key = image_key(imp)+(method, dark)
+	if key in THRESHOLDS:
+		return THRESHOLDS[key]
+	counts, low, high = histogram(imp)
+	THRESHOLDS[key] = histogram_threshold(counts, low, high, method, dark, imp.getProcessor().isInvertedLut())
+	return THRESHOLDS[key]
+
+def histogram_threshold(counts, low, high, method, dark = True, inverted = False):
+	'''
+	Thresholds (lower, upper) given by method on a histogram (counts, low, high) of histogram or streamed_histogram, in pixel values.
+	inverted : the image has an inverted LUT
+	'''
+	level = AutoThresholder().getThreshold(AutoThresholder.Method.valueOf(method), counts)
+	if dark != inverted:
+		lower, upper = level+1.0, 255.0
+	else:
+		lower, upper = 0.0, float(level)
+	lower = min(lower, 255.0)
+	if low is not None:
+		# Back to the pixel values of the image
+		if high > low:
+			lower = low+(lower/255.0)*(high-low)
+			upper = low+(upper/255.0)*(high-low)
+		else:
+			lower = upper = low
+	return lower, upper
+
+def set_auto_threshold(imp, method, dark = True):
+	'''
+	Replaces IJ.setAutoThreshold(imp, method+" dark"): sets the threshold (red overlay) on imp, from the cache when it is already known.
+	Returns (lower, upper), to be recorded with the results (see threshold_text).
+	'''
+	lower, upper = auto_threshold(imp, method, dark)
+	imp.getProcessor().setThreshold(lower, upper, ImageProcessor.RED_LUT)
+	return lower, upper
+
+def threshold_text(thresholds):
+	'''
+	Writes thresholds (lower, upper) as in the result files: "lower/upper".
+	'''
+	return str(thresholds[0])+'/'+str(thresholds[1])
+
+###Sensitivity
+
+def threshold_curve(imp, roi):
+	'''
+	Area of the pixels of imp (current plane) inside roi that are kept by every possible lower threshold, from a single histogram of roi.
+	Shows how much an area measured with an auto-threshold (e.g. Area CD3 in area_TLS) depends on the threshold.
+	Returns a list of (lower threshold, area) for the 256 levels of the auto-threshold methods (the thresholds of auto_threshold are among them),
+	the area is calibrated (same unit as "Measure").
+	'''
+	counts, low, high = histogram(imp)
+	ip = imp.getProcessor()
+	previous = ip.getRoi()
+	previous_mask = ip.getMask()
+	ip.setRoi(roi)
+	raw = isinstance(ip, ByteProcessor) or isinstance(ip, ShortProcessor)
+	if raw:
+		inside = ip.getHistogram() # one bin per pixel value
+	else:
+		# 32-bit: the bins of the 8-bit conversion used by the auto-threshold methods
+		converted = ip.convertToByte(True)
+		converted.setRoi(roi)
+		inside = converted.getHistogram()
+	ip.setRoi(previous)
+	ip.setMask(previous_mask)
+	# Number of pixels at or above each bin, from the top
+	above = [0]*(len(inside)+1)
+	for value in xrange(len(inside)-1, -1, -1):
+		above[value] = above[value+1]+inside[value]
+	calibration = imp.getCalibration()
+	pixel_area = calibration.pixelWidth*calibration.pixelHeight
+	curve = []
+	for level in xrange(256):
+		if low is None:
+			lower = float(level)
+		elif high > low:
+			lower = low+(level/255.0)*(high-low)
+		else:
+			lower = float(low)
+		if raw:
+			first = min(int(math.ceil(lower)), len(inside)) # smallest pixel value kept
+		else:
+			first = level
+		curve.append((lower, above[first]*pixel_area))
+	return curve